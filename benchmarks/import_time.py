@@ -0,0 +1,56 @@
+"""
+Measure the import time of the madgui plugin.
+
+Usage:
+    python benchmarks/import_time.py [-n RUNS] [MODULE...]
+
+Each import is timed in a fresh interpreter. Prints the best and median
+time per module, and the heavy modules that were loaded as a side effect.
+"""
+
+from __future__ import print_function
+
+import sys
+import argparse
+import subprocess
+
+
+SCRIPT = """
+import sys, time
+t0 = time.time()
+import {module}
+t1 = time.time()
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(t1 - t0, ','.join(heavy))
+"""
+
+HEAVY = ['numpy', 'pint', 'PyQt5', 'pydicti', 'madgui.util.unit',
+         'hit_acs.beamoptikstub', 'hit_acs.offsets']
+
+
+def time_import(module, runs):
+    times, heavy = [], ''
+    for _ in range(runs):
+        out = subprocess.check_output([
+            sys.executable, '-c',
+            SCRIPT.format(module=module, heavy=HEAVY),
+        ]).decode('utf-8').split()
+        times.append(float(out[0]))
+        heavy = out[1] if len(out) > 1 else ''
+    times.sort()
+    return times[0], times[len(times)//2], heavy
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--runs', type=int, default=10)
+    parser.add_argument('modules', nargs='*', default=['hit_acs.plugin'])
+    opts = parser.parse_args(args)
+    for module in opts.modules:
+        best, median, heavy = time_import(module, opts.runs)
+        print('{}: best {:.1f} ms, median {:.1f} ms, loaded: {}'.format(
+            module, best * 1000, median * 1000, heavy or '-'))
+
+
+if __name__ == '__main__':
+    main()
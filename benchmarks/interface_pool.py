@@ -0,0 +1,73 @@
+"""
+Benchmark the read throughput of concurrent readers with the interface
+instance pool against the stub.
+
+Usage:
+    python benchmarks/interface_pool.py [-t THREADS] [-s SIZES] [-n READS]
+                                        [--call-latency SECONDS]
+
+Every thread reads parameters (uncached) in a loop. With pool size 1, all
+reads serialize on one reader instance, larger pools let them overlap. The
+call latency of the stub simulates the time spent in the DLL.
+"""
+
+from __future__ import print_function
+
+import time
+import argparse
+import threading
+
+from hit_acs.beamoptikstub import BeamOptikStub
+from hit_acs.plugin import _HitACS
+
+
+def make_backend(pool_size, call_latency):
+    settings = {
+        'seed': 0,
+        'pool_size': pool_size,
+        'param_cache_timeout': 0,
+        'faults': {'latency': {'GetFloatValue': call_latency}},
+    }
+    stub = BeamOptikStub(None, None, settings)
+    stub.set_float_values({'kl_{}'.format(i): i for i in range(100)})
+    backend = _HitACS(stub, {}, settings=settings)
+    backend.connect()
+    return backend
+
+
+def run(backend, threads, reads):
+    names = ['kl_{}'.format(i) for i in range(100)]
+
+    def reader():
+        for i in range(reads):
+            backend.read_param(names[i % len(names)])
+
+    workers = [threading.Thread(target=reader) for _ in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.time() - start
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-t', '--threads', type=int, default=8)
+    parser.add_argument('-s', '--sizes', default='1,2,4,8')
+    parser.add_argument('-n', '--reads', type=int, default=200)
+    parser.add_argument('--call-latency', type=float, default=0.001)
+    opts = parser.parse_args(args)
+
+    for size in map(int, opts.sizes.split(',')):
+        backend = make_backend(size, opts.call_latency)
+        elapsed = run(backend, opts.threads, opts.reads)
+        stats = backend.pool_stats()
+        backend.disconnect()
+        print('pool size {}: {:.0f} reads/s, {} instances, {} waits'.format(
+            size, opts.threads * opts.reads / elapsed,
+            stats['created'], stats['waits']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmark the MEFI sweep against the stub.
+
+Usage:
+    python benchmarks/mefi_sweep.py [-e ENERGIES] [-f FOCI] [-i INTENSITIES]
+                                    [-p PARAMS] [--error-rate RATE]
+                                    [--select-latency SECONDS]
+                                    [--interrupt-after COUNT]
+
+Sweeps the first channels of vAcc 1 and records the physical EFI values and
+the first PARAMS parameters of the parameter table. ``SelectMEFI`` fails at
+the given rate. With ``--interrupt-after``, the sweep is first interrupted
+after the given number of combinations, and then resumed from the
+checkpoint.
+"""
+
+from __future__ import print_function
+
+import os
+import time
+import argparse
+import tempfile
+
+from hit_acs.beamoptikstub import BeamOptikStub
+from hit_acs.plugin import _HitACS, load_dvm_parameters
+
+
+def make_backend(error_rate, select_latency):
+    settings = {
+        'seed': 0,
+        'faults': {
+            'seed': 0,
+            'latency': {'SelectMEFI': select_latency},
+            'errors': {'SelectMEFI': {7: error_rate}},
+        },
+    }
+    stub = BeamOptikStub(None, None, settings)
+    backend = _HitACS(stub, load_dvm_parameters, settings=settings)
+    backend.connect()
+    return backend
+
+
+class Interrupt(Exception):
+    pass
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-e', '--energies', type=int, default=50)
+    parser.add_argument('-f', '--foci', type=int, default=6)
+    parser.add_argument('-i', '--intensities', type=int, default=1)
+    parser.add_argument('-p', '--params', type=int, default=200)
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--select-latency', type=float, default=0.0)
+    parser.add_argument('--interrupt-after', type=int, default=0)
+    opts = parser.parse_args(args)
+
+    backend = make_backend(opts.error_rate, opts.select_latency)
+    params = [name for name, key in backend._param_keys][:opts.params]
+    channels = dict(
+        energy=range(1, opts.energies+1),
+        focus=range(1, opts.foci+1),
+        intensity=range(1, opts.intensities+1),
+        params=params,
+    )
+    checkpoint = os.path.join(tempfile.mkdtemp(), 'sweep.chk')
+
+    if opts.interrupt_after:
+        # Interrupt by failing the parameter reads after the given number of
+        # combinations:
+        read = backend.read_param_vector
+        count = [0]
+
+        def interrupting_read(names):
+            count[0] += 1
+            if count[0] > opts.interrupt_after:
+                raise Interrupt
+            return read(names)
+        backend.read_param_vector = interrupting_read
+        try:
+            backend.mefi_sweep(1, checkpoint=checkpoint, **channels)
+        except Interrupt:
+            pass
+        backend.read_param_vector = read
+
+    start = time.time()
+    sweep = backend.mefi_sweep(1, checkpoint=checkpoint, **channels)
+    elapsed = time.time() - start
+    total = sweep.status.size
+    print('{} combinations, {} params: {:.3f} s, {:.1f} combinations/s'
+          .format(total, len(params), elapsed, sweep.stats['done'] / elapsed))
+    print('this run: {done} done, {failed} failed'.format(**sweep.stats))
+    print('total: {} done, {} failed'.format(
+        int((sweep.status == 1).sum()), int((sweep.status == -1).sum())))
+
+
+if __name__ == '__main__':
+    main()
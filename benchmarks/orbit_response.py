@@ -0,0 +1,92 @@
+"""
+Benchmark the orbit response measurement against the stub.
+
+Usage:
+    python benchmarks/orbit_response.py [-k KNOBS] [-m MONITORS] [-n SHOTS]
+                                        [--shot-interval SECONDS]
+                                        [--execute-latency SECONDS]
+                                        [--call-latency SECONDS]
+
+Compares :func:`hit_acs.measure.measure_orbit_response` with a naive loop of
+``write_param``/``execute``/``read_monitor`` that restores every knob after
+each kick and sleeps one shot interval between shots. The stub runs without
+model, i.e. with fixed readouts plus jitter, and with a short shot interval.
+"""
+
+from __future__ import print_function
+
+import time
+import argparse
+
+from hit_acs.beamoptikstub import BeamOptikStub
+from hit_acs.plugin import _HitACS
+
+
+def make_backend(knobs, monitors, shot_interval, execute_latency,
+                 call_latency):
+    settings = {
+        'seed': 0,
+        'shot_interval': shot_interval,
+        'faults': {'latency': {
+            'default': call_latency,
+            'ExecuteChanges': execute_latency,
+        }},
+    }
+    stub = BeamOptikStub(None, None, settings)
+    stub.set_float_values({knob: 0.0 for knob in knobs})
+    stub.set_sd_values({
+        prefix + '_' + monitor: value
+        for monitor in monitors
+        for prefix, value in [('posx', 0.0), ('posy', 0.0),
+                              ('widthx', 0.002), ('widthy', 0.002)]
+    })
+    backend = _HitACS(stub, {}, settings=settings)
+    backend.connect()
+    return backend
+
+
+def naive(backend, monitors, knobs, kick, shots, shot_interval):
+    for knob in knobs:
+        base = backend.read_param(knob)
+        for sign in (+1, -1):
+            backend.write_param(knob, base + sign * kick)
+            backend.execute()
+            for _ in range(shots):
+                for monitor in monitors:
+                    backend.read_monitor(monitor)
+                time.sleep(shot_interval)
+            backend.write_param(knob, base)
+            backend.execute()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-k', '--knobs', type=int, default=20)
+    parser.add_argument('-m', '--monitors', type=int, default=30)
+    parser.add_argument('-n', '--shots', type=int, default=5)
+    parser.add_argument('--shot-interval', type=float, default=0.01)
+    parser.add_argument('--execute-latency', type=float, default=0.01)
+    parser.add_argument('--call-latency', type=float, default=0.0)
+    opts = parser.parse_args(args)
+
+    knobs = ['ax_k{}'.format(i) for i in range(opts.knobs)]
+    monitors = ['m{}'.format(i) for i in range(opts.monitors)]
+    backend = make_backend(
+        knobs, monitors, opts.shot_interval,
+        opts.execute_latency, opts.call_latency)
+
+    start = time.time()
+    naive(backend, monitors, knobs, 1e-4, opts.shots, opts.shot_interval)
+    naive_time = time.time() - start
+
+    result = backend.measure_orbit_response(
+        monitors, knobs, 1e-4, shots=opts.shots)
+    stats = result.stats
+    print('naive:   {:.3f} s, {} executes'.format(naive_time, 4*len(knobs)))
+    print('batched: {:.3f} s, {} executes, {:.1f} settings/s'.format(
+        stats['time'], stats['executes'],
+        stats['settings'] / stats['time']))
+
+
+if __name__ == '__main__':
+    main()
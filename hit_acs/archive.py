@@ -0,0 +1,508 @@
+"""
+Append-only binary archive for continuous logging of parameters and monitor
+readouts.
+
+An archive is a folder with segment files and an ``index.json``. Every
+segment holds a fixed number of fixed-width records (as many as fit into
+``segment_bytes``)::
+
+    time        float64, seconds since epoch
+    epoch       int64, shot counter of the monitor readouts
+    vacc        int32, selected vAcc
+    mefi        int32[4], MEFI channels (energy, focus, intensity, gantry)
+    params      float32/float64[P], parameter values
+    monitors    float32/float64[M, 4], posx/posy/envx/envy
+
+Missing values are NaN (or -1 for vAcc and channels). A segment file starts
+with a magic string, the number of records written so far and a JSON
+header, followed by the records (aligned to 64 bytes), which are written
+through a memory map. When a segment is full (or too old), a new segment is
+started. Closed segments are optionally compressed, but never truncated,
+because readers may still have them mapped (the prefix and the index have
+the number of used records).
+
+The index lists for every segment its time range and the runs of records
+with the same vAcc and MEFI combination. Queries use it to skip segments
+and records, and locate time ranges by binary search within a segment, so
+that files are never scanned as a whole.
+"""
+
+import os
+import gzip
+import json
+import time
+import struct
+import logging
+import threading
+
+import numpy as np
+
+
+__all__ = [
+    'ArchiveWriter',
+    'ArchiveReader',
+]
+
+
+MAGIC = b'HITARCH\x01'
+ALIGN = 64
+PREFIX = struct.Struct('<8sQQ')         # magic, count, header size
+INDEX = 'index.json'
+MONITOR_COLUMNS = ('posx', 'posy', 'envx', 'envy')
+
+
+def _align(offset):
+    return -(-offset // ALIGN) * ALIGN
+
+
+def record_dtype(num_params, num_monitors, dtype='<f4'):
+    """Return the numpy dtype of a record."""
+    return np.dtype([
+        ('time', '<f8'),
+        ('epoch', '<i8'),
+        ('vacc', '<i4'),
+        ('mefi', '<i4', (4,)),
+        ('params', dtype, (num_params,)),
+        ('monitors', dtype, (num_monitors, 4)),
+    ])
+
+
+def _segment_name(number):
+    return 'seg-{:06d}.bin'.format(number)
+
+
+def _write_json(filename, data):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, filename)
+
+
+def _runs(records, start=0):
+    """Return ``[[first, vacc, e, f, i, g], ...]`` for the runs of records
+    with the same vAcc and MEFI combination."""
+    if not len(records):
+        return []
+    combo = np.column_stack((records['vacc'], records['mefi']))
+    first = np.flatnonzero(np.any(combo[1:] != combo[:-1], axis=1)) + 1
+    first = np.concatenate(([0], first))
+    return [[int(i) + start] + combo[i].tolist() for i in first]
+
+
+class _Segment(object):
+
+    """Memory mapped segment file opened for writing."""
+
+    def __init__(self, filename, header, dtype, capacity):
+        self.filename = filename
+        if not os.path.exists(filename):
+            blob = json.dumps(header).encode('utf-8')
+            start = _align(PREFIX.size + len(blob))
+            with open(filename, 'wb') as f:
+                f.write(PREFIX.pack(MAGIC, 0, len(blob)))
+                f.write(blob)
+                f.truncate(start + capacity * dtype.itemsize)
+        _, size = _read_prefix(filename)
+        start = _align(PREFIX.size + size)
+        self._raw = np.memmap(filename, dtype=np.uint8, mode='r+')
+        self._count = self._raw[8:16].view('<u8')
+        self.records = self._raw[start:].view(dtype)
+        self.data_start = start
+        self.capacity = len(self.records)
+
+    @property
+    def count(self):
+        return int(self._count[0])
+
+    def append(self):
+        """Return the next record. The caller must fill it, and then call
+        :meth:`commit`."""
+        return self.records[self.count]
+
+    def commit(self):
+        self._count[0] += 1
+
+    def close(self, compress=False):
+        """Unmap the file, and compress its used part if `compress`. Returns
+        the final file name."""
+        count = self.count
+        end = self.data_start + count * self.records.dtype.itemsize
+        self._raw.flush()
+        self.records = self._count = None
+        self._raw = None
+        if not compress:
+            return self.filename
+        try:
+            with open(self.filename, 'rb') as src:
+                with gzip.open(self.filename + '.gz', 'wb') as dst:
+                    dst.write(src.read(end))
+        except (IOError, OSError) as e:
+            logging.error("Cannot compress {!r}: {}".format(self.filename, e))
+            return self.filename
+        try:
+            os.remove(self.filename)
+        except OSError as e:
+            # e.g. on Windows, while a reader has it mapped:
+            logging.warning("Cannot remove {!r}: {}".format(self.filename, e))
+        return self.filename + '.gz'
+
+
+def _read_prefix(filename):
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as f:
+        magic, count, size = PREFIX.unpack(f.read(PREFIX.size))
+    if magic != MAGIC:
+        raise ValueError("Not an archive segment: {!r}".format(filename))
+    return count, size
+
+
+class ArchiveWriter(object):
+
+    """
+    Appends records to the archive in the folder `path`, which is created if
+    needed. An existing archive is continued, if it has the same parameter
+    and monitor names and data type.
+
+    :param list params: parameter names
+    :param list monitors: monitor names
+    :param str dtype: ``'f4'`` or ``'f8'``, for the values and readouts
+    :param int segment_bytes: size of the records of a segment, which is
+        allocated when the segment is started
+    :param float segment_seconds: maximum time span of a segment
+    :param bool compress: gzip closed segments
+    :param backend: :class:`~hit_acs.plugin._HitACS` for :meth:`record`
+    """
+
+    def __init__(self, path, params, monitors=(), dtype='f4',
+                 segment_bytes=32 * 2**20, segment_seconds=None,
+                 compress=False, backend=None):
+        self.path = path
+        self.params = list(params)
+        self.monitors = list(monitors)
+        self.dtype = record_dtype(
+            len(self.params), len(self.monitors), np.dtype(dtype).str)
+        self.segment_records = max(1, segment_bytes // self.dtype.itemsize)
+        self.segment_seconds = segment_seconds
+        self.compress = compress
+        self.backend = backend
+        self._param_index = {
+            name.lower(): i for i, name in enumerate(self.params)}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._index_file = os.path.join(path, INDEX)
+        if os.path.exists(self._index_file):
+            with open(self._index_file) as f:
+                self.index = json.load(f)
+            if (self.index['params'] != self.params or
+                    self.index['monitors'] != self.monitors or
+                    self.index['dtype'] != self.dtype.descr[-1][1]):
+                raise ValueError(
+                    "Archive {!r} has a different layout".format(path))
+        else:
+            self.index = {
+                'params': self.params,
+                'monitors': self.monitors,
+                'dtype': self.dtype.descr[-1][1],
+                'segments': [],
+            }
+        self._segment = None
+        self._entry = None
+        segments = self.index['segments']
+        if segments and segments[-1]['open']:
+            self._open_segment(segments[-1])
+
+    def _open_segment(self, entry=None):
+        if entry is None:
+            entry = {
+                'file': _segment_name(len(self.index['segments'])),
+                'open': True,
+                'count': 0,
+                't0': None,
+                't1': None,
+                'runs': [],
+            }
+            self.index['segments'].append(entry)
+        self._segment = _Segment(
+            os.path.join(self.path, entry['file']),
+            {'params': self.params, 'monitors': self.monitors},
+            self.dtype, self.segment_records)
+        # Recover the index entry of a segment that was not closed:
+        records = self._segment.records[:self._segment.count]
+        entry['count'] = len(records)
+        entry['runs'] = _runs(records)
+        if len(records):
+            entry['t0'] = float(records['time'][0])
+            entry['t1'] = float(records['time'][-1])
+        self._entry = entry
+        _write_json(self._index_file, self.index)
+
+    def _close_segment(self):
+        filename = self._segment.close(self.compress)
+        self._entry['file'] = os.path.basename(filename)
+        self._entry['open'] = False
+        self._segment = self._entry = None
+        _write_json(self._index_file, self.index)
+
+    def close(self):
+        """Stop recording, and close the current segment."""
+        self.stop()
+        with self._lock:
+            if self._segment is not None:
+                self._close_segment()
+
+    def rotate(self):
+        """Close the current segment, so that the next record starts a new
+        one."""
+        with self._lock:
+            if self._segment is not None:
+                self._close_segment()
+
+    def append(self, params=None, monitors=None, timestamp=None, epoch=-1,
+               vacc=-1, mefi=None):
+        """
+        Append a record. `params` is a dict or an array in the order of
+        :attr:`params`, `monitors` a dict of readouts as returned by
+        ``read_monitors`` or a ``(monitors, 4)`` array, `mefi` the channel
+        numbers (energy, focus, intensity, gantry angle).
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        mefi = [-1, -1, -1, -1] if mefi is None else list(mefi)
+        with self._lock:
+            if self._segment is not None and self._full(timestamp):
+                self._close_segment()
+            if self._segment is None:
+                self._open_segment()
+            entry = self._entry
+            record = self._segment.append()
+            record['time'] = timestamp
+            record['epoch'] = epoch
+            record['vacc'] = vacc
+            record['mefi'] = mefi
+            record['params'] = self._param_vector(params)
+            record['monitors'] = self._monitor_array(monitors)
+            self._segment.commit()
+            if entry['t0'] is None:
+                entry['t0'] = timestamp
+            entry['t1'] = timestamp
+            entry['count'] += 1
+            combo = [vacc] + mefi
+            if not entry['runs'] or entry['runs'][-1][1:] != combo:
+                entry['runs'].append([entry['count'] - 1] + combo)
+                # The index is rewritten only when the combination changes,
+                # readers get the current count from the segment file:
+                _write_json(self._index_file, self.index)
+
+    def _full(self, timestamp):
+        segment, t0 = self._segment, self._entry['t0']
+        return segment.count >= segment.capacity or (
+            self.segment_seconds is not None and t0 is not None and
+            timestamp - t0 >= self.segment_seconds)
+
+    def _param_vector(self, params):
+        if params is None:
+            return np.nan
+        if isinstance(params, dict):
+            values = np.full(len(self.params), np.nan)
+            index = self._param_index
+            for name, value in params.items():
+                i = index.get(name.lower())
+                if i is not None:
+                    values[i] = value
+            return values
+        return params
+
+    def _monitor_array(self, monitors):
+        if monitors is None:
+            return np.nan
+        if isinstance(monitors, dict):
+            readouts = np.full((len(self.monitors), 4), np.nan)
+            for i, name in enumerate(self.monitors):
+                readout = monitors.get(name)
+                if readout:
+                    readouts[i] = [readout[col] for col in MONITOR_COLUMNS]
+            return readouts
+        return monitors
+
+    def record(self):
+        """Read the parameters, monitors, vAcc and MEFI channels from the
+        backend and append them as one record."""
+        backend = self.backend
+        params = backend.read_params(self.params, warn=False)
+        epoch, monitors = -1, None
+        if self.monitors:
+            epoch, monitors = backend.read_monitors(self.monitors)
+        call = backend._call_writer
+        channels = call('GetMEFIValue')[1]
+        self.append(params, monitors, epoch=epoch,
+                    vacc=call('GetSelectedVAcc'), mefi=channels)
+
+    @property
+    def running(self):
+        """Whether the background thread is running."""
+        return self._thread is not None
+
+    def start(self, interval=1.0):
+        """Call :meth:`record` every `interval` seconds in a background
+        thread."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(interval,), name='ArchiveWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread (if running)."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.is_set():
+            started = time.time()
+            try:
+                self.record()
+            except Exception:
+                logging.exception("Error while archiving")
+            self._stop.wait(max(0.0, interval - (time.time() - started)))
+
+
+class ArchiveReader(object):
+
+    """
+    Queries the archive in the folder `path`. Can be used while a writer
+    (also in another process) appends to it; call :meth:`refresh` to see
+    new segments.
+    """
+
+    def __init__(self, path, cache_size=2):
+        self.path = path
+        self.cache_size = cache_size
+        self._cache = []
+        self.refresh()
+
+    def refresh(self):
+        """Reload the index."""
+        with open(os.path.join(self.path, INDEX)) as f:
+            self.index = json.load(f)
+        self.params = self.index['params']
+        self.monitors = self.index['monitors']
+        self.dtype = record_dtype(
+            len(self.params), len(self.monitors), self.index['dtype'])
+        self._param_index = {
+            name.lower(): i for i, name in enumerate(self.params)}
+        self._monitor_index = {
+            name.lower(): i for i, name in enumerate(self.monitors)}
+
+    @property
+    def segments(self):
+        """Index entries of the segments."""
+        return self.index['segments']
+
+    def _records(self, entry):
+        """Return the records of a segment, memory mapped if uncompressed."""
+        filename = os.path.join(self.path, entry['file'])
+        if entry['open']:
+            count, size = _read_prefix(filename)
+        else:
+            count, size = entry['count'], None
+        for key, records in self._cache:
+            if key == (filename, count):
+                return records
+        if size is None:
+            _, size = _read_prefix(filename)
+        start = _align(PREFIX.size + size)
+        if filename.endswith('.gz'):
+            with gzip.open(filename, 'rb') as f:
+                data = f.read()
+            records = np.frombuffer(data, self.dtype, count, start)
+        elif count == 0:
+            records = np.zeros(0, self.dtype)
+        else:
+            records = np.memmap(filename, self.dtype, 'r', start, (count,))
+        self._cache.insert(0, ((filename, count), records))
+        del self._cache[self.cache_size:]
+        return records
+
+    def query(self, t0=None, t1=None, vacc=None, mefi=None, params=None,
+              monitors=None):
+        """
+        Return the records in the time range ``t0 <= time <= t1`` that match
+        `vacc` and `mefi` (tuple of channel numbers, with ``None`` matching
+        any channel) as dict of arrays::
+
+            time        (N,)
+            epoch       (N,)
+            vacc        (N,)
+            mefi        (N, 4)
+            params      (N, P) for the given parameter names (default all)
+            monitors    (N, M, 4) for the given monitor names (default all)
+
+        Unknown names are ignored.
+        """
+        pcols = self._columns(self._param_index, params)
+        mcols = self._columns(self._monitor_index, monitors)
+        chunks = []
+        for entry in self.segments:
+            if not self._overlaps(entry, t0, t1):
+                continue
+            records = None
+            for start, stop in self._ranges(entry, vacc, mefi):
+                if records is None:
+                    records = self._records(entry)
+                    times = records['time']
+                    lo = 0 if t0 is None else np.searchsorted(times, t0)
+                    hi = (len(records) if t1 is None else
+                          np.searchsorted(times, t1, side='right'))
+                start, stop = max(start, lo), min(stop, hi, len(records))
+                if start < stop:
+                    chunks.append(records[start:stop])
+        records = (np.concatenate(chunks) if chunks else
+                   np.zeros(0, self.dtype))
+        return {
+            'time': records['time'],
+            'epoch': records['epoch'],
+            'vacc': records['vacc'],
+            'mefi': records['mefi'],
+            'params': records['params'][:, pcols],
+            'monitors': records['monitors'][:, mcols],
+        }
+
+    def _columns(self, index, names):
+        if names is None:
+            return np.arange(len(index))
+        return np.array([index[name.lower()] for name in names
+                         if name.lower() in index], dtype=int)
+
+    def _overlaps(self, entry, t0, t1):
+        if entry['t0'] is None and not entry['open']:
+            return False
+        if t0 is not None and entry['t1'] is not None and entry['t1'] < t0:
+            # The open segment may have grown since the index was written:
+            return entry['open']
+        return t1 is None or entry['t0'] is None or entry['t0'] <= t1
+
+    def _ranges(self, entry, vacc, mefi):
+        """Generate ``(start, stop)`` record ranges of a segment with
+        matching vAcc and MEFI channels."""
+        runs = entry['runs']
+        if not runs:
+            if entry['open']:
+                yield 0, float('inf')
+            return
+        for i, run in enumerate(runs):
+            if vacc is not None and run[1] != vacc:
+                continue
+            if mefi is not None and any(
+                    want is not None and want != have
+                    for want, have in zip(mefi, run[2:])):
+                continue
+            last = i + 1 == len(runs)
+            yield run[0], float('inf') if last else runs[i+1][0]
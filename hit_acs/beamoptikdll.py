@@ -95,6 +95,11 @@ class BeamOptikDLL(object):
 
     filename = 'BeamOptikDLL64.dll' if is_64bit else 'BeamOptikDLL.dll'
 
+    #: Optional hook to record DLL calls: an object with an ``enabled`` flag
+    #: and a ``span(name, category)`` context manager, such as
+    #: :data:`hit_acs.trace.TRACER` (set by the plugin).
+    tracer = None
+
     def __init__(self, lib=filename, variant='HIT'):
         """
         Load library and initialize member variables.
@@ -116,6 +121,13 @@ class BeamOptikDLL(object):
 
     __nonzero__ = __bool__
 
+    def new_client(self):
+        """
+        Create a separate wrapper object for the same library, which can get
+        its own interface instance (see :class:`~hit_acs.pool.InterfacePool`).
+        """
+        return self.__class__(self.lib, self._variant)
+
     @property
     def iid(self):
         """Interface instance ID."""
@@ -157,6 +169,24 @@ class BeamOptikDLL(object):
         self._call('FreeInterfaceInstance', self.iid)
         self._iid = None
 
+    def reconnect(self):
+        """
+        Replace the interface instance by a new one, e.g. after the DLL
+        reported an invalid interface ID. Errors while freeing the old
+        instance are ignored.
+
+        :return: new instance id
+        :rtype: int
+        :raises RuntimeError: if the exit code indicates any error
+        """
+        if self._iid is not None:
+            try:
+                self.FreeInterfaceInstance()
+            except RuntimeError:
+                pass
+            self._iid = None
+        return self.GetInterfaceInstance()
+
     def GetDVMStatus(self):
         """
         Get current status of selected virtual accelerator.
@@ -367,7 +397,12 @@ class BeamOptikDLL(object):
         if function != 'GetFloatValueSD':
             logging.debug('{}{}'.format(function, tuple(params)))
         func = self._funcs[function]
-        func(*params)
+        tracer = self.tracer
+        if tracer is not None and tracer.enabled:
+            with tracer.span(function, 'dll'):
+                func(*params)
+        else:
+            func(*params)
         self.check_return(done.value)
 
     @classmethod
@@ -4,31 +4,371 @@ Fake implementation of BeamOptikDLL wrapper. Emulates the API of
 offline testing of the basic functionality.
 """
 
+import os
+import time
+import numbers
 import logging
 import functools
-from random import gauss, gammavariate as gamma
+import itertools
+import threading
+from collections import OrderedDict
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:     # py2
+    from collections import MutableMapping
+
+import numpy as np
 from pydicti import dicti
 
-from .beamoptikdll import DVMStatus, GetOptions, ExecOptions, GetSDOptions, EFI
-from .util import TimeoutCache
+from .beamoptikdll import (
+    BeamOptikDLL, DVMStatus, GetOptions, ExecOptions, GetSDOptions, EFI)
+from .rampdata import RampDataGenerator
+from .linoptics import LinearOptics
+from .mefi import MEFITable
+from .checkpoint import write_checkpoint, read_checkpoint
+from .util import KeyRegistry
+from .trace import TRACER
 
 
 __all__ = [
     'BeamOptikStub',
+    'StubClient',
+    'FaultProfile',
+    'ParamStore',
 ]
 
 
 def _api_meth(func):
     """Decorator for tracing calls to BeamOptikDLL API methods."""
+    name = func.__name__
+
     @functools.wraps(func)
     def wrapper(self, *args):
-        if func.__name__ != 'GetFloatValueSD':
-            logging.debug('{}{}'.format(func.__name__, args))
-        return func(self, *args)
+        if name != 'GetFloatValueSD':
+            logging.debug('{}{}'.format(name, args))
+        if TRACER.enabled:
+            with TRACER.span(name, 'stub'):
+                return _call(self, args)
+        return _call(self, args)
+
+    def _call(self, args):
+        faults = self.faults
+        if faults.enabled:
+            faults.before_call(name)
+        result = func(self, *args)
+        if faults.enabled:
+            faults.after_call(name)
+        return result
+    wrapper.api_meth = True
     return wrapper
 
 
+_MISSING = object()
+_DELETED = object()
+_REMOVED = object()     # removed from an _ArrayDelta
+
+
+class ParamStore(MutableMapping):
+
+    """
+    Case-insensitive copy-on-write parameter store.
+
+    Reads fall through to the ``parent`` store, while writes and deletions
+    are recorded in :attr:`delta`. Stacking stores therefore needs memory
+    proportional to the number of changes, not to the size of the table.
+
+    Names are normalized through a :class:`~hit_acs.util.KeyRegistry` that
+    is shared by the whole stack, so :attr:`delta` is a dict with canonical
+    (lowercase) keys, and lookups with a canonical key can use
+    :meth:`get_key` without normalizing again.
+    """
+
+    def __init__(self, parent=None, keys=None):
+        if keys is None:
+            keys = KeyRegistry() if parent is None else parent.keys
+        self.parent = parent
+        self.keys = keys
+        self.delta = {}
+
+    def get_key(self, key, default=None):
+        """Get value by canonical key."""
+        store = self
+        while store is not None:
+            value = store.delta.get(key, _MISSING)
+            if value is _DELETED:
+                return default
+            if value is not _MISSING:
+                return value
+            store = store.parent
+        return default
+
+    def __getitem__(self, name):
+        value = self.get_key(self.keys.key(name), _MISSING)
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        self.delta[self.keys.key(name)] = value
+
+    def __delitem__(self, name):
+        key = self.keys.key(name)
+        if key not in self:
+            raise KeyError(name)
+        if self.parent is not None and key in self.parent:
+            self.delta[key] = _DELETED
+        else:
+            del self.delta[key]
+
+    def __contains__(self, name):
+        return self.get_key(self.keys.key(name), _MISSING) is not _MISSING
+
+    def __iter__(self):
+        delta = self.delta
+        if self.parent is not None:
+            for key in self.parent:
+                if key not in delta:
+                    yield key
+        for key, value in list(delta.items()):
+            if value is not _DELETED:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def clear(self):
+        if self.parent is None:
+            self.delta.clear()
+        else:
+            self.delta = {key: _DELETED for key in self.parent}
+
+    def commit(self):
+        """
+        Apply the local changes to the parent store and forget them.
+        Returns the list of changed names (canonical keys).
+        """
+        parent = self.parent
+        for key, value in self.delta.items():
+            if value is _DELETED:
+                parent.pop(key, None)
+            else:
+                parent.delta[key] = value
+        changed = list(self.delta)
+        self.delta.clear()
+        return changed
+
+    def rollback(self):
+        """Discard all local changes."""
+        self.delta.clear()
+
+
+def _pack_delta(delta, arrays, key):
+    """Split the `delta` of a store into a float array (stored in `arrays`
+    under `key`) and a JSON serializable header entry."""
+    names, values, deleted, other = [], [], [], {}
+    for name, value in delta.items():
+        if value is _DELETED:
+            deleted.append(name)
+        elif isinstance(value, numbers.Real) and not isinstance(value, bool):
+            names.append(name)
+            values.append(value)
+        else:
+            other[name] = value
+    arrays[key] = np.array(values, dtype=float)
+    return {'names': names, 'deleted': deleted, 'other': other}
+
+
+def _unpack_delta(entry, values, keys):
+    """Inverse of :func:`_pack_delta`, with keys normalized by `keys`. The
+    float values stay in the (memory mapped) array `values`."""
+    key = keys.key
+    delta = _ArrayDelta(map(key, entry['names']), values)
+    delta.update((key(name), value) for name, value in entry['other'].items())
+    delta.update((key(name), _DELETED) for name in entry['deleted'])
+    return delta
+
+
+class _ArrayDelta(MutableMapping):
+
+    """
+    Dict-like :attr:`ParamStore.delta` restored from a checkpoint. Values are
+    read from the array on access, so that restoring a state only touches
+    the pages that are actually used. Changes are kept in a dict on top.
+    """
+
+    def __init__(self, keys, values):
+        self._index = {k: i for i, k in enumerate(keys)}
+        self._values = values
+        self._changes = {}
+
+    def get(self, key, default=None):
+        value = self._changes.get(key, _MISSING)
+        if value is _MISSING:
+            index = self._index.get(key)
+            return default if index is None else float(self._values[index])
+        return default if value is _REMOVED else value
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __setitem__(self, key, value):
+        self._changes[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self._index:
+            self._changes[key] = _REMOVED
+        else:
+            del self._changes[key]
+
+    def __iter__(self):
+        changes = self._changes
+        for key in self._index:
+            if changes.get(key) is not _REMOVED:
+                yield key
+        for key in list(changes):
+            if key not in self._index:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def clear(self):
+        self._index = {}
+        self._changes = {}
+
+    def detach(self):
+        """Copy the values into memory, so the file can be overwritten."""
+        self._values = np.array(self._values)
+
+
+def _jitter(values, is_pos, is_width, rng):
+    """Return `values` with random noise added to the valid positions and
+    widths (selected by the boolean arrays `is_pos` and `is_width`)."""
+    result = values.copy()
+    stddev = 1e-4       # 0.1 mm
+    valid = values != -9999
+    pos = is_pos & valid
+    result[pos] = values[pos] + stddev * rng.standard_normal(pos.sum())
+    width = is_width & valid & (values > 0)
+    mean = values[width]
+    result[width] = rng.standard_gamma(mean**2/stddev**2) * (
+        stddev**2/mean)
+    return result
+
+
+class _Instance(object):
+
+    """State of one interface instance."""
+
+    def __init__(self, vacc, efia, params):
+        self.vacc = vacc
+        self.EFIA = efia
+        self.params = params
+
+
+def _latency_sampler(spec):
+    """Create a function ``rng -> seconds`` from a latency specification."""
+    if isinstance(spec, (int, float)):
+        spec = {'dist': 'fixed', 'value': spec}
+    dist = spec.get('dist', 'fixed')
+    if dist == 'fixed':
+        value = float(spec['value'])
+        return lambda rng: value
+    if dist == 'normal':
+        mean, stddev = float(spec['mean']), float(spec['stddev'])
+        return lambda rng: max(0.0, rng.normal(mean, stddev))
+    if dist == 'lognormal':
+        mu, sigma = np.log(float(spec['median'])), float(spec['sigma'])
+        return lambda rng: rng.lognormal(mu, sigma)
+    if dist == 'pareto':
+        scale, shape = float(spec['scale']), float(spec['shape'])
+        return lambda rng: scale * (1 + rng.pareto(shape))
+    raise ValueError("Unknown latency distribution: {!r}".format(dist))
+
+
+def _error_code(code):
+    """Get error code from code number or message."""
+    if isinstance(code, int):
+        return code
+    return BeamOptikDLL.error_messages.index(code)
+
+
+class FaultProfile(object):
+
+    """
+    Latency and error injection for :class:`BeamOptikStub`. It is configured
+    by a dict (e.g. the ``faults`` entry in the settings) such as::
+
+        seed: 0
+        latency:                # per function, or 'default'
+          default: 0.001        # fixed, in seconds
+          GetFloatValueSD: {dist: normal, mean: 0.005, stddev: 0.001}
+          ExecuteChanges: {dist: pareto, scale: 0.05, shape: 2.5}
+          SelectMEFI: {dist: lognormal, median: 0.5, sigma: 1.0}
+        errors:                 # per function, or 'default'
+          GetFloatValue: {"GetValue failed.": 0.01}
+          default: {6: 0.0001}  # 6 = "Memory error."
+        busy_after_execute: 0.5
+
+    Errors are error codes of :attr:`BeamOptikDLL.error_messages` (number or
+    message) with their rate per call, and are raised exactly like the DLL
+    wrapper does. After ``ExecuteChanges``, ``GetDVMStatus`` reports
+    ``DVMStatus.Busy`` for ``busy_after_execute`` seconds.
+    """
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.config = config
+        self.seed = config.get('seed')
+        self.rng = np.random.default_rng(self.seed)
+        self.latency = {
+            name: _latency_sampler(spec)
+            for name, spec in (config.get('latency') or {}).items()
+        }
+        self.errors = {
+            name: [(_error_code(code), float(rate))
+                   for code, rate in rates.items()]
+            for name, rates in (config.get('errors') or {}).items()
+        }
+        self.busy_after_execute = float(config.get('busy_after_execute', 0))
+        self.busy_until = 0
+        self.sleep = time.sleep
+        self.enabled = bool(
+            self.latency or self.errors or self.busy_after_execute)
+
+    def before_call(self, name):
+        """Sleep for a random latency, then maybe raise an injected error."""
+        latency = self.latency.get(name, self.latency.get('default'))
+        if latency is not None:
+            delay = latency(self.rng)
+            if delay > 0:
+                self.sleep(delay)
+        errors = self.errors.get(name, self.errors.get('default'))
+        if errors:
+            r = self.rng.random()
+            for code, rate in errors:
+                if r < rate:
+                    BeamOptikDLL.check_return(code)
+                r -= rate
+
+    def after_call(self, name):
+        if name == 'ExecuteChanges' and self.busy_after_execute:
+            self.busy_until = time.time() + self.busy_after_execute
+
+    def busy(self):
+        """Check whether we are in a simulated busy window."""
+        return time.time() < self.busy_until
+
+
 class BeamOptikStub(object):
 
     """
@@ -45,16 +385,41 @@ class BeamOptikStub(object):
         """Initialize new library instance with no interface instances."""
         if settings is None:
             settings = {}
-        self.params = dicti()
-        self.sd_values = dicti()
-        self.sd_cache = TimeoutCache(
-            self._get_jittered_sd,
-            timeout=settings.get('shot_interval', 1.0))
+        # Parameter database: the table loaded by `set_float_values`, with
+        # copy-on-write overlays per vAcc, and pending (not yet executed)
+        # changes per interface instance on top of that. All of them share
+        # one key registry, which is also used for the SD values:
+        self._keys = KeyRegistry()
+        self._base = ParamStore(keys=self._keys)
+        self._vacc_params = {}
+        self._instances = {}
+        self._iids = itertools.count(1337)
+        self._iid = None
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._executed_store = None
+        self.sd_values = {}
+        self.shot_interval = settings.get('shot_interval', 1.0)
+        self._jitter_shot = None
+        self.reseed(settings.get('seed'))
+        self._jittered_sd = {}
+        self._sd_layout = None
+        self._monitor_cache = None
+        self._dirty = set()         # params changed since last execute
+        self._executed = {}         # param values at last execute
+        self._optics = {}           # values pushed into the model globals
+        self._sd_memo = OrderedDict()
+        self._sd_memo_size = settings.get('sd_memo_size', 128)
         self.model = model
         self.offsets = {} if offsets is None else offsets
         self.settings = settings
         self.jitter = settings.get('jitter', True)
         self.auto_sd = settings.get('auto_sd', True)
+        self.faults = FaultProfile(settings.get('faults'))
+        self.ramps = RampDataGenerator(settings.get('ramp'))
+        self.optics = None
+        self._mefi_config = settings.get('mefi') or {}
+        self._mefi_tables = {}
         self._variant = variant
 
     _aberration_magnitude = {
@@ -65,27 +430,269 @@ class BeamOptikStub(object):
         'kl':  5e-3,    # 0.005
     }
 
+    @property
+    def params(self):
+        """Parameter values as seen by the current interface instance."""
+        inst = self._instances.get(self._current_iid())
+        return self._base if inst is None else inst.params
+
+    @property
+    def vacc(self):
+        return self._instance().vacc
+
+    @property
+    def EFIA(self):
+        return self._instance().EFIA
+
+    def _current_iid(self):
+        return getattr(self._local, 'iid', self._iid)
+
+    def _instance(self):
+        inst = self._instances.get(self._current_iid())
+        if inst is None:
+            raise RuntimeError(
+                "GetInterfaceInstance must be called "
+                "before using other methods.")
+        return inst
+
+    def _vacc_store(self, vacc):
+        store = self._vacc_params.get(vacc)
+        if store is None:
+            store = self._vacc_params[vacc] = ParamStore(self._base)
+        return store
+
+    def new_client(self):
+        """
+        Create a separate wrapper object for the same simulated DVM, e.g. to
+        simulate concurrent clients. Like for the real DLL, the client must
+        call ``GetInterfaceInstance`` on its own.
+        """
+        return StubClient(self)
+
+    def reseed(self, seed=None):
+        """
+        Restart the random streams for readout jitter and magnet aberrations
+        from `seed` (a new random seed if ``None``). The same seed reproduces
+        the same sequence of shots and aberrations.
+        """
+        if seed is None:
+            seed = int(np.random.SeedSequence().generate_state(1)[0])
+        self.seed = seed
+        jitter, aberrations = np.random.SeedSequence(seed).spawn(2)
+        # Every shot gets its own child stream, so that a shot's jitter does
+        # not depend on how many values previous shots have drawn:
+        self._jitter_seq = jitter
+        self._aberration_rng = np.random.default_rng(aberrations)
+        self._jitter_shot = None
+
+    def export_settings(self):
+        """Settings needed to reproduce the current simulation."""
+        return {
+            'seed': self.seed,
+            'shot_interval': self.shot_interval,
+            'jitter': self.jitter,
+            'auto_sd': self.auto_sd,
+        }
+
+    def save_state(self, filename):
+        """
+        Save the simulation state (parameters of all vAccs and interface
+        instances, SD values, vAcc/EFIA selection and random streams) to a
+        binary checkpoint file, see :meth:`load_state`. The file is
+        replaced atomically, and may be the one the state was loaded from.
+        """
+        arrays = {}
+        with self._lock:
+            self._detach_state()
+            next_iid = next(self._iids)
+            self._iids = itertools.count(next_iid)
+            executed = self._executed_store
+            header = {
+                'version': 1,
+                'base': _pack_delta(self._base.delta, arrays, 'base'),
+                'vaccs': [
+                    dict(vacc=vacc, params=_pack_delta(
+                        store.delta, arrays, 'vacc_{}'.format(vacc)))
+                    for vacc, store in self._vacc_params.items()
+                ],
+                'instances': [
+                    dict(iid=iid, vacc=inst.vacc,
+                         efia=inst.EFIA and list(inst.EFIA),
+                         params=_pack_delta(inst.params.delta, arrays,
+                                            'inst_{}'.format(iid)))
+                    for iid, inst in self._instances.items()
+                ],
+                'iid': self._iid,
+                'next_iid': next_iid,
+                'executed_vacc': next((
+                    vacc for vacc, store in self._vacc_params.items()
+                    if store is executed), None),
+                'dirty': sorted(self._dirty),
+                'sd_values': _pack_delta(self.sd_values, arrays, 'sd'),
+                'seed': self.seed,
+                'jitter_spawned': self._jitter_seq.n_children_spawned,
+                'aberration_rng': self._aberration_rng.bit_generator.state,
+                'shot_interval': self.shot_interval,
+                'jitter': self.jitter,
+                'auto_sd': self.auto_sd,
+            }
+        tmp = filename + '.tmp'
+        write_checkpoint(tmp, header, arrays)
+        os.replace(tmp, filename)
+
+    def _detach_state(self):
+        """Stop using the memory maps of a checkpoint loaded previously."""
+        deltas = [self._base.delta, self.sd_values]
+        deltas.extend(store.delta for store in self._vacc_params.values())
+        deltas.extend(inst.params.delta for inst in self._instances.values())
+        for delta in deltas:
+            if isinstance(delta, _ArrayDelta):
+                delta.detach()
+
+    def load_state(self, filename):
+        """
+        Restore the state saved by :meth:`save_state`. The arrays are memory
+        mapped, and the SD values are taken from the file rather than being
+        recomputed, so this does not need a twiss. The model (if any) is not
+        part of the checkpoint and only receives the changed globals.
+        """
+        header, arrays = read_checkpoint(filename)
+        if header.get('version') != 1:
+            raise ValueError(
+                "Unsupported checkpoint version: {!r}".format(
+                    header.get('version')))
+        with self._lock:
+            self._mefi_tables.clear()
+            keys = self._keys
+            self._base = ParamStore(keys=keys)
+            self._base.delta = _unpack_delta(
+                header['base'], arrays['base'], keys)
+            self._vacc_params = {}
+            for entry in header['vaccs']:
+                store = self._vacc_store(entry['vacc'])
+                store.delta = _unpack_delta(
+                    entry['params'], arrays['vacc_{}'.format(entry['vacc'])],
+                    keys)
+            self._instances = {}
+            for entry in header['instances']:
+                params = ParamStore(self._vacc_store(entry['vacc']))
+                params.delta = _unpack_delta(
+                    entry['params'], arrays['inst_{}'.format(entry['iid'])],
+                    keys)
+                self._instances[entry['iid']] = _Instance(
+                    entry['vacc'], entry['efia'] and tuple(entry['efia']),
+                    params)
+            self._iid = header['iid']
+            self._iids = itertools.count(header['next_iid'])
+            vacc = header['executed_vacc']
+            store = self._base if vacc is None else self._vacc_store(vacc)
+            self._executed_store = store
+            self._dirty = set(keys.keys(header['dirty']))
+
+            self.reseed(header['seed'])
+            seq = self._jitter_seq
+            self._jitter_seq = np.random.SeedSequence(
+                seq.entropy, spawn_key=seq.spawn_key,
+                pool_size=seq.pool_size,
+                n_children_spawned=header['jitter_spawned'])
+            self._aberration_rng.bit_generator.state = \
+                header['aberration_rng']
+            self.shot_interval = header['shot_interval']
+            self.jitter = header['jitter']
+            self.auto_sd = header['auto_sd']
+
+            # Bring the model in line with the executed parameters. Only
+            # model globals are tracked (see _apply_changes), and set_model
+            # starts over anyway, so the other values are never read here:
+            self._executed = {}
+            if self.model:
+                dirty = self._dirty
+                for name in self.model.globals:
+                    key = keys.key(name)
+                    value = store.get_key(key, _MISSING)
+                    if value is not _MISSING and key not in dirty:
+                        self._executed[key] = value
+                optics = {
+                    name: value for name, value in self._executed.items()
+                    if self._optics.get(name) != value
+                }
+                if optics:
+                    self._optics.update(optics)
+                    self.model.update_globals(optics)
+            self.sd_values = _unpack_delta(
+                header['sd_values'], arrays['sd'], keys)
+
     def _aberrate_strengths(self):
-        for k in self.params:
-            prefix = k.lower().split('_')[0]
-            sigma = self._aberration_magnitude.get(prefix)
-            if sigma is not None:
-                self.params[k] += gauss(0, sigma)
+        params = self.params
+        names = [k for k in params
+                 if k.split('_')[0] in self._aberration_magnitude]
+        sigma = np.array([
+            self._aberration_magnitude[k.split('_')[0]]
+            for k in names])
+        deltas = self._aberration_rng.normal(0, sigma)
+        for k, delta in zip(names, deltas.tolist()):
+            params[k] += delta
+            self._dirty.add(k)
         self.ExecuteChanges()
 
+    def set_fault_profile(self, config):
+        """Replace the latency and error injection profile."""
+        self.faults = FaultProfile(config)
+
     def set_sd_values(self, data):
-        self.sd_values = dicti(data)
+        key = self._keys.key
+        self.sd_values = {key(name): value for name, value in data.items()}
         self.auto_sd = False
+        self._jitter_shot = None
 
-    def set_model(self, model):
+    def set_model(self, model, compute=True):
+        """Use `model` for the simulation. With ``compute=False``, the
+        parameters and SD values are left alone rather than reset to the
+        model, e.g. if the caller restores them with :meth:`load_state`."""
         self.model = model
-        if model:
+        self._monitor_cache = None
+        self._executed.clear()
+        self._optics.clear()
+        self._sd_memo.clear()
+        self.optics = model and self._load_linear_optics(model)
+        if model and compute:
             self.set_float_values(model.globals)
             self.update_sd_values()
 
+    def _load_linear_optics(self, model):
+        """Create the linear optics engine if enabled in the settings. The
+        ``linear_optics`` setting can be ``true`` to extract the maps from
+        the model, or the name of a ``.npz`` file saved previously."""
+        source = self.settings.get('linear_optics')
+        if not source:
+            return None
+        if source is True:
+            return LinearOptics.from_model(model)
+        return LinearOptics.load(source)
+
+    def _mefi_table(self, vacc):
+        """Get the MEFI table of a vAcc. It is loaded from the file given in
+        the ``mefi.files`` setting, or generated from its parameters."""
+        table = self._mefi_tables.get(vacc)
+        if table is None:
+            filename = (self._mefi_config.get('files') or {}).get(vacc)
+            if filename:
+                table = MEFITable.load(filename)
+            else:
+                table = MEFITable.generate(
+                    self._vacc_store(vacc), self._mefi_config)
+            self._mefi_tables[vacc] = table
+        return table
+
     def set_float_values(self, data):
-        self.params.clear()
-        self.params.update({
+        # Loading a new table resets the changes of all vAccs/instances:
+        self._mefi_tables.clear()
+        for store in self._vacc_params.values():
+            store.rollback()
+        for inst in self._instances.values():
+            inst.params.rollback()
+        self._base.clear()
+        self._base.update({
             'A_POSTSTRIP':  1.007281417537080e+00,
             'Q_POSTSTRIP':  1.000000000000000e+00,
             'Z_POSTSTRIP':  1.000000000000000e+00,
@@ -94,7 +701,8 @@ class BeamOptikStub(object):
             'E_SOURCE':     2.034800000000000e+02,
             'E_MEBT':       2.034800000000000e+02,
         })
-        self.params.update(data)
+        self._base.update(data)
+        self._dirty.update(self._base)
         self.ExecuteChanges()
 
     @_api_meth
@@ -105,39 +713,73 @@ class BeamOptikStub(object):
     @_api_meth
     def GetInterfaceInstance(self):
         """Create a new interface instance."""
-        self.vacc = 3
-        self.EFIA = (1, 1, 1, 1)
-        return 1337
+        with self._lock:
+            iid = next(self._iids)
+            vacc = 3
+            # No MEFI selected yet, see GetMEFIValue:
+            self._instances[iid] = _Instance(
+                vacc, None, ParamStore(self._vacc_store(vacc)))
+        if not hasattr(self._local, 'iid'):
+            self._iid = iid
+        return iid
 
     @_api_meth
     def FreeInterfaceInstance(self):
         """Destroy a previously created interface instance."""
-        del self.vacc
-        del self.EFIA
+        iid = self._current_iid()
+        with self._lock:
+            if self._instances.pop(iid, None) is None:
+                BeamOptikDLL.check_return(1)    # Invalid Interface ID.
+        if iid == self._iid:
+            self._iid = None
+
+    def reconnect(self):
+        """Replace the interface instance by a new one, see
+        :meth:`BeamOptikDLL.reconnect`."""
+        try:
+            self.FreeInterfaceInstance()
+        except RuntimeError:
+            pass
+        self._iid = None
+        return self.GetInterfaceInstance()
 
     @_api_meth
-    def GetDVMStatus(self, status):
+    def GetDVMStatus(self, status=None):
         """Get DVM ready status."""
-        # The test lib has no advanced status right now.
-        return DVMStatus.Ready
+        # Busy only within the simulated window after ExecuteChanges:
+        return DVMStatus.Busy if self.faults.busy() else DVMStatus.Ready
 
     @_api_meth
     def SelectVAcc(self, vaccnum):
         """Set virtual accelerator number."""
-        self.vacc = vaccnum
+        inst = self._instance()
+        inst.vacc = vaccnum
+        # pending changes are carried over to the new vAcc:
+        inst.params.parent = self._vacc_store(vaccnum)
 
     @_api_meth
     def SelectMEFI(self, vaccnum, energy, focus, intensity, gantry_angle=0):
         """Set MEFI in current VAcc."""
         # The real DLL requires SelectVAcc to be called in advance, so we
         # enforce this constraint here as well:
-        assert self.vacc == vaccnum
-        self.EFIA = (energy, focus, intensity, gantry_angle)
-        return EFI(
-            float(energy),
-            float(focus),
-            float(intensity),
-            float(self.params.get('gantry_angle', gantry_angle)))
+        inst = self._instance()
+        assert inst.vacc == vaccnum
+        table = self._mefi_table(vaccnum)
+        values = table.physical(energy, focus, intensity)
+        key = self._keys.key
+        setpoint = {key(name): value
+                    for name, value in table.params(energy, focus).items()}
+        inst.EFIA = (energy, focus, intensity, gantry_angle)
+        # Apply the whole parameter set of the setpoint at once. Pending
+        # changes of other parameters stay pending until ExecuteChanges:
+        with self._lock:
+            for name in setpoint:
+                inst.params.delta.pop(name, None)
+            store = self._vacc_store(vaccnum)
+            store.delta.update(setpoint)
+            self._apply_changes(store, set(setpoint))
+        return values._replace(gantry_angle=float(
+            self.params.get('gantry_angle', gantry_angle)))
 
     @_api_meth
     def GetSelectedVAcc(self):
@@ -147,18 +789,64 @@ class BeamOptikStub(object):
     @_api_meth
     def GetFloatValue(self, name, options=GetOptions.Current):
         """Get a float value from the "database"."""
-        return float(self.params.get(name, 0))
+        return float(self.params.get_key(self._keys.key(name), 0))
 
     @_api_meth
     def SetFloatValue(self, name, value, options=0):
         """Store a float value to the "database"."""
-        self.params[name] = value
+        key = self._keys.key(name)
+        self.params.delta[key] = value
+        self._dirty.add(key)
 
     @_api_meth
     def ExecuteChanges(self, options=ExecOptions.CalcDif):
-        """Compute new measurements based on current model."""
-        if self.model:
-            self.model.update_globals(self.params)
+        """
+        Compute new measurements based on current model.
+
+        Pending changes of the interface instance are committed to its vAcc.
+        Only parameters that changed since the last call are passed to the
+        model, and the twiss is skipped unless one of them is a model global.
+        ``ExecOptions.CalcAll`` forces passing all parameters.
+        """
+        with self._lock:
+            self._execute_changes(options)
+
+    def _execute_changes(self, options):
+        inst = self._instances.get(self._current_iid())
+        if inst is not None:
+            self._dirty.update(inst.params.commit())
+            store = inst.params.parent
+        else:
+            store = self._base
+        if options == ExecOptions.CalcAll:
+            self._executed.clear()
+            self._dirty.update(store)
+        dirty, self._dirty = self._dirty, set()
+        self._apply_changes(store, dirty)
+
+    def _apply_changes(self, store, dirty):
+        """Push the `dirty` parameters of the vAcc `store` to the model."""
+        # The model simulates the vAcc that was executed last. When that
+        # changes, all parameters that differ between the vAccs are dirty:
+        if store is not self._executed_store:
+            for prev in (self._executed_store, store):
+                if prev is not None and prev is not self._base:
+                    dirty.update(prev.delta)
+            self._executed_store = store
+        if not self.model:
+            return
+        params, executed = store, self._executed
+        deltas = {
+            name: params[name]
+            for name in dirty
+            if name in params and executed.get(name) != params[name]
+        }
+        executed.update(deltas)
+        model_globals = self.model.globals
+        optics = {k: v for k, v in deltas.items() if k in model_globals}
+        if optics:
+            self._optics.update(optics)
+            self.model.update_globals(optics)
             self.update_sd_values()
 
     @_api_meth
@@ -169,42 +857,89 @@ class BeamOptikStub(object):
     @_api_meth
     def GetFloatValueSD(self, name, options=GetSDOptions.Current):
         """Get beam diagnostic value."""
-        try:
-            storage = self.sd_cache if self.jitter else self.sd_values
-            return storage[name] * 1000
-        except KeyError:
-            return -9999.0
-
-    def _get_jittered_sd(self, name):
-        value = self.sd_values[name]
-        prefix = name.lower().split('_')[0]
-        if value != -9999:
-            mean, stddev = value, 1e-4      # 0.1 mm
-            if prefix in ('posx', 'posy'):
-                return gauss(mean, stddev)
-            if prefix in ('widthx', 'widthy'):
-                return gamma(mean**2/stddev**2, stddev**2/mean)
-        return value
+        key = self._keys.key(name)
+        if not self.jitter:
+            value = self.sd_values.get(key)
+        elif self.shot_interval == 0:
+            value = self._jitter_sd_value(key)
+        else:
+            value = self._get_jittered_sd().get(key)
+        return -9999.0 if value is None else value * 1000
+
+    def _get_jittered_sd(self):
+        """Return jittered SD values for the current shot. The values for all
+        monitors are drawn at once on the first access during each shot."""
+        interval = self.shot_interval
+        shot = int(time.time() // interval) if interval > 0 else 0
+        if shot != self._jitter_shot:
+            self._jittered_sd = self._jitter_sd_values()
+            self._jitter_shot = shot
+        return self._jittered_sd
+
+    def _jitter_sd_value(self, key):
+        """Return a new jittered value for a single monitor readout (every
+        read is a new shot if ``shot_interval`` is 0)."""
+        value = self.sd_values.get(key)
+        if value is None:
+            return None
+        prefix = key.split('_')[0]
+        rng = np.random.default_rng(self._jitter_seq.spawn(1)[0])
+        return _jitter(
+            np.array([value], dtype=float),
+            np.array([prefix in ('posx', 'posy')]),
+            np.array([prefix in ('widthx', 'widthy')]),
+            rng)[0].item()
+
+    def _jitter_sd_values(self):
+        names = list(self.sd_values.keys())
+        layout = self._sd_layout
+        if layout is None or layout[0] != names:
+            prefixes = [name.split('_')[0] for name in names]
+            layout = self._sd_layout = (names, np.array([
+                p in ('posx', 'posy') for p in prefixes], dtype=bool),
+                np.array([p in ('widthx', 'widthy') for p in prefixes],
+                         dtype=bool))
+        names, is_pos, is_width = layout
+        rng = np.random.default_rng(self._jitter_seq.spawn(1)[0])
+        values = np.array(list(self.sd_values.values()), dtype=float)
+        result = _jitter(values, is_pos, is_width, rng)
+        return dict(zip(names, result.tolist()))
 
     def update_sd_values(self):
         """Compute new measurements based on current model."""
         model = self.model
         if not model or not self.auto_sd:
             return
-        model.twiss()
-        for elem in self._monitors():
-            dx, dy = self.offsets.get(elem.name, (0, 0))
-            twiss = model.get_elem_twiss(elem.name)
-            values = {
-                'widthx': twiss.envx,
-                'widthy': twiss.envy,
-                'posx': -twiss.x - dx,
-                'posy': twiss.y - dy,
-            }
-            self.sd_values.update({
-                key + '_' + elem.name: val
-                for key, val in values.items()
-            })
+        names, indices = self._monitors()
+        state = self._optics_key()
+        twiss = self._sd_memo.pop(state, None)
+        if twiss is None and self._has_linear_optics(names):
+            twiss = self._linear_twiss(
+                names, self.optics.deltas(self._optics))
+            twiss = {col: vals[0] for col, vals in twiss.items()}
+        if twiss is None:
+            table = model.twiss()
+            rows = np.array([model.indices[i].stop for i in indices],
+                            dtype=int)
+            twiss = {col: np.asarray(table[col])[rows]
+                     for col in ('x', 'y', 'envx', 'envy')}
+        self._sd_memo[state] = twiss
+        while len(self._sd_memo) > self._sd_memo_size:
+            self._sd_memo.popitem(last=False)
+        dx, dy = self._monitor_offsets(names)
+        values = {
+            'widthx': twiss['envx'],
+            'widthy': twiss['envy'],
+            'posx': -twiss['x'] - dx,
+            'posy': twiss['y'] - dy,
+        }
+        key = self._keys.key
+        self.sd_values.update({
+            key(prefix + '_' + name): val
+            for prefix, vals in values.items()
+            for name, val in zip(names, vals.tolist())
+        })
+        self._jitter_shot = None
 
     @_api_meth
     def GetLastFloatValueSD(self, name, vaccnum,
@@ -217,14 +952,17 @@ class BeamOptikStub(object):
 
     @_api_meth
     def StartRampDataGeneration(self, vaccnum, energy, focus, intensity):
-        """Not implemented."""
-        raise NotImplementedError
+        """Precompute ramps for the magnets of a vAcc. Return order number."""
+        self._instance()
+        return self.ramps.start(
+            self._vacc_store(vaccnum), EFI(energy, focus, intensity, 0))
 
     @_api_meth
     def GetRampDataValue(self, order_num, event_num, delay,
                          parameter_name, device_name):
-        """Not implemented."""
-        raise NotImplementedError
+        """Get ramp value of the parameter ``<parameter>_<device>``."""
+        return self.ramps.get(order_num, event_num, delay,
+                              parameter_name + '_' + device_name)
 
     @_api_meth
     def SetIPC_DVM_ID(self, name):
@@ -233,15 +971,134 @@ class BeamOptikStub(object):
 
     @_api_meth
     def GetMEFIValue(self):
-        """Get current MEFI combination."""
-        channels = EFI(*self.EFIA)
-        values = EFI(
-            float(channels.energy),
-            float(channels.focus),
-            float(channels.intensity),
-            float(self.params.get('gantry_angle', channels.gantry_angle)))
+        """Get current MEFI combination. Before the first SelectMEFI, this
+        is the reference channel of the table, i.e. the one that matches the
+        loaded parameters."""
+        table = self._mefi_table(self.vacc)
+        channels = EFI(*(self.EFIA or table.reference + (1, 1)))
+        values = table.physical(
+            channels.energy, channels.focus, channels.intensity,
+            self.params.get('gantry_angle', channels.gantry_angle))
         return (values, channels)
 
+    def _has_linear_optics(self, names):
+        optics = self.optics
+        return optics is not None and all(
+            name in optics.monitor_index for name in names)
+
+    def _linear_twiss(self, names, deltas):
+        optics = self.optics
+        cols = [optics.monitor_index[name] for name in names]
+        return {col: vals[:, cols]
+                for col, vals in optics.compute(deltas).items()}
+
+    def batch_sd_values(self, settings):
+        """
+        Compute readouts for a batch of hypothetical settings (list of dicts
+        with parameter changes relative to the current state) using the
+        linear optics engine, without modifying the state. Returns a list of
+        dicts with values as returned by ``GetFloatValueSD`` (no jitter).
+        """
+        names, indices = self._monitors()
+        if not self._has_linear_optics(names):
+            raise RuntimeError(
+                "Linear optics engine not available (see 'linear_optics' "
+                "setting).")
+        optics = self.optics
+        deltas = []
+        for changes in settings:
+            values = dict(self._optics)
+            values.update((k.lower(), v) for k, v in changes.items())
+            deltas.append(optics.deltas(values))
+        twiss = self._linear_twiss(names, np.array(deltas))
+        dx, dy = self._monitor_offsets(names)
+        values = {
+            'widthx': twiss['envx'],
+            'widthy': twiss['envy'],
+            'posx': -twiss['x'] - dx,
+            'posy': twiss['y'] - dy,
+        }
+        return [
+            dicti({
+                key + '_' + name: val * 1000
+                for key, vals in values.items()
+                for name, val in zip(names, vals[b].tolist())
+            })
+            for b in range(len(deltas))
+        ]
+
+    def _monitor_offsets(self, names):
+        offsets = self.offsets
+        return np.array([
+            offsets.get(name, (0, 0)) for name in names
+        ], dtype=float).reshape(-1, 2).T
+
+    def _optics_key(self):
+        """Hashable key for the optics state, used to memoize SD values."""
+        model = self.model
+        return (
+            frozenset(self._optics.items()),
+            repr(sorted(getattr(model, 'beam', {}).items())),
+            repr(sorted(getattr(model, 'twiss_args', {}).items())),
+        )
+
     def _monitors(self):
-        return [elem for elem in self.model.elements
-                if elem.base_name.endswith('monitor')]
+        """Return names and element indices of all monitors (cached)."""
+        if self._monitor_cache is None:
+            elements = self.model.elements
+            monitors = [elem for elem in elements
+                        if elem.base_name.endswith('monitor')]
+            self._monitor_cache = (
+                [elem.name for elem in monitors],
+                [elements.index(elem) for elem in monitors])
+        return self._monitor_cache
+
+
+class StubClient(object):
+
+    """
+    Separate wrapper object for a shared :class:`BeamOptikStub`, with its
+    own interface instance. API calls are forwarded to the stub in the
+    context of this client's instance, all other attributes are shared.
+    """
+
+    def __init__(self, stub):
+        self._stub = stub
+        self._iid = None
+        self._variant = stub._variant
+
+    def __bool__(self):
+        return self._iid is not None
+
+    __nonzero__ = __bool__
+
+    def reconnect(self):
+        """Replace the interface instance by a new one, see
+        :meth:`BeamOptikDLL.reconnect`."""
+        if self._iid is not None:
+            try:
+                self.FreeInterfaceInstance()
+            except RuntimeError:
+                pass
+            self._iid = None
+        return self.GetInterfaceInstance()
+
+    def __getattr__(self, name):
+        attr = getattr(self._stub, name)
+        if not getattr(attr, 'api_meth', False):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args):
+            local = self._stub._local
+            local.iid = self._iid
+            try:
+                result = attr(*args)
+            finally:
+                del local.iid
+            if name == 'GetInterfaceInstance':
+                self._iid = result
+            elif name == 'FreeInterfaceInstance':
+                self._iid = None
+            return result
+        return call
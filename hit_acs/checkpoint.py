@@ -0,0 +1,70 @@
+"""
+Simple binary container for state snapshots.
+
+A file consists of a magic string, a JSON header and a number of float64
+arrays, each aligned to 64 bytes. The arrays are accessed via memory maps,
+so reading a file does not parse or copy anything except the header.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+
+__all__ = [
+    'write_checkpoint',
+    'read_checkpoint',
+]
+
+
+MAGIC = b'HITACS\x00\x01'
+ALIGN = 64
+
+
+def _align(offset):
+    return -(-offset // ALIGN) * ALIGN
+
+
+def write_checkpoint(filename, header, arrays):
+    """
+    Write `header` (JSON serializable dict) and `arrays` (dict of 1D float
+    arrays) to `filename`.
+    """
+    arrays = {name: np.ascontiguousarray(data, dtype='<f8')
+              for name, data in arrays.items()}
+    layout = {}
+    offset = 0
+    for name, data in arrays.items():
+        layout[name] = [offset, len(data)]
+        offset = _align(offset + data.nbytes)
+    blob = json.dumps({'header': header, 'arrays': layout}).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(blob))
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(blob)))
+        f.write(blob)
+        for name, data in arrays.items():
+            f.seek(data_start + layout[name][0])
+            f.write(data.tobytes())
+        f.truncate(data_start + offset)
+
+
+def read_checkpoint(filename):
+    """
+    Read a file written by :func:`write_checkpoint`. Returns the header and
+    a dict of read-only memory mapped arrays.
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a checkpoint file: {!r}".format(filename))
+        size, = struct.unpack('<Q', f.read(8))
+        meta = json.loads(f.read(size).decode('utf-8'))
+    data_start = _align(len(MAGIC) + 8 + size)
+    arrays = {
+        name: np.memmap(filename, dtype='<f8', mode='r',
+                        offset=data_start + offset, shape=(length,))
+        if length else np.zeros(0)
+        for name, (offset, length) in meta['arrays'].items()
+    }
+    return meta['header'], arrays
@@ -0,0 +1,207 @@
+"""
+Linear optics engine for fast SD readouts in
+:class:`~hit_acs.beamoptikstub.BeamOptikStub`.
+
+The first order transfer maps of all elements and their derivatives with
+respect to the knobs are extracted once from a madgui model (this needs
+MAD-X). Afterwards, orbit and beam envelope at the monitors are propagated
+with NumPy matrix products only, for many knob settings at once. Since the
+knob dependence is linearized, results are exact for kickers and a first
+order approximation for quadrupoles and other elements.
+
+The extracted data can be saved to and loaded from a ``.npz`` file, so that
+MAD-X is not needed at all in later sessions.
+"""
+
+import numpy as np
+
+
+__all__ = [
+    'LinearOptics',
+]
+
+
+def _sectormaps(model):
+    """Get the 7x7 transfer maps of all elements as ``(N, 7, 7)`` array."""
+    table = model.sector()
+    return np.array(model.madx.sectortable(table._name))
+
+
+class LinearOptics(object):
+
+    """
+    Propagates orbit and sigma matrix through a beamline with linearized
+    knob dependence.
+
+    :ivar list knobs: knob names (lowercase)
+    :ivar np.ndarray knob_values: reference values of the knobs
+    :ivar list monitors: monitor names, in beamline order
+    """
+
+    def __init__(self, maps, knobs, knob_values, deriv_elems, deriv_knobs,
+                 deriv_maps, monitors, monitor_elems, orbit0, sigma0):
+        self.maps = np.asarray(maps, dtype=float)
+        self.knobs = [knob.lower() for knob in knobs]
+        self.knob_index = {knob: i for i, knob in enumerate(self.knobs)}
+        self.knob_values = np.asarray(knob_values, dtype=float)
+        self.deriv_elems = np.asarray(deriv_elems, dtype=int)
+        self.deriv_knobs = np.asarray(deriv_knobs, dtype=int)
+        self.deriv_maps = np.asarray(deriv_maps, dtype=float).reshape(-1, 7, 7)
+        self.monitors = list(monitors)
+        self.monitor_index = {name: i for i, name in enumerate(self.monitors)}
+        self.monitor_elems = np.asarray(monitor_elems, dtype=int)
+        self.orbit0 = np.asarray(orbit0, dtype=float)
+        self.sigma0 = np.asarray(sigma0, dtype=float)
+        self._compile()
+
+    @classmethod
+    def from_model(cls, model, knobs=None, step=1e-4):
+        """
+        Extract the transfer maps from a madgui model. The derivatives are
+        computed by central differences of ``step`` for each knob, so this
+        needs two SECTORMAP calls per knob.
+        """
+        elements = model.elements
+        knob_elems = {}
+        for i, elem in enumerate(elements):
+            for knob in model.get_elem_knobs(elem):
+                knob_elems.setdefault(knob.lower(), set()).add(i)
+        if knobs is None:
+            knobs = sorted(knob_elems)
+        knobs = [knob.lower() for knob in knobs]
+
+        madx = model.madx
+        maps = _sectormaps(model)
+        knob_values = []
+        deriv_elems, deriv_knobs, deriv_maps = [], [], []
+        for k, knob in enumerate(knobs):
+            value = madx.globals[knob]
+            knob_values.append(value)
+            elems = sorted(knob_elems.get(knob, ()))
+            if not elems:
+                continue
+            try:
+                madx.globals[knob] = value + step
+                model.invalidate()
+                maps_hi = _sectormaps(model)
+                madx.globals[knob] = value - step
+                model.invalidate()
+                maps_lo = _sectormaps(model)
+            finally:
+                madx.globals[knob] = value
+                model.invalidate()
+            for i in elems:
+                deriv_elems.append(i)
+                deriv_knobs.append(k)
+                deriv_maps.append((maps_hi[i] - maps_lo[i]) / (2 * step))
+
+        monitors = [(i, elem.name) for i, elem in enumerate(elements)
+                    if elem.base_name.endswith('monitor')]
+        twiss0 = model.get_elem_twiss(elements[0])
+        orbit0 = [twiss0.x, twiss0.px, twiss0.y, twiss0.py, 0, 0, 1]
+        sigma0 = model.get_elem_sigma(elements[0])
+        return cls(maps, knobs, knob_values,
+                   deriv_elems, deriv_knobs, deriv_maps,
+                   [name for i, name in monitors],
+                   [i for i, name in monitors],
+                   orbit0, sigma0)
+
+    @classmethod
+    def load(cls, filename):
+        """Load from a file written by :meth:`save`."""
+        with np.load(filename) as data:
+            return cls(**{
+                key: data[key].tolist() if key in ('knobs', 'monitors')
+                else data[key]
+                for key in data.files
+            })
+
+    def save(self, filename):
+        """Save all data to a ``.npz`` file."""
+        np.savez(
+            filename,
+            maps=self.maps,
+            knobs=np.array(self.knobs),
+            knob_values=self.knob_values,
+            deriv_elems=self.deriv_elems,
+            deriv_knobs=self.deriv_knobs,
+            deriv_maps=self.deriv_maps,
+            monitors=np.array(self.monitors),
+            monitor_elems=self.monitor_elems,
+            orbit0=self.orbit0,
+            sigma0=self.sigma0)
+
+    def _compile(self):
+        """
+        Group the elements that do not depend on any knob into precomputed
+        segment maps, so that propagation only needs one matrix product per
+        segment, knob dependent element, and monitor.
+        """
+        variable = sorted(set(self.deriv_elems.tolist()))
+        self._var_elems = np.array(variable, dtype=int)
+        var_pos = {elem: j for j, elem in enumerate(variable)}
+        self._deriv_pos = np.array(
+            [var_pos[i] for i in self.deriv_elems.tolist()], dtype=int)
+        outputs = {elem: m for m, elem in enumerate(self.monitor_elems)}
+        steps = []
+        segment = None
+        # Element 0 is the start marker, the initial state refers to its
+        # exit:
+        for i in range(1, len(self.maps)):
+            if i in var_pos:
+                if segment is not None:
+                    steps.append(('fixed', segment))
+                    segment = None
+                steps.append(('var', var_pos[i]))
+            else:
+                segment = self.maps[i] if segment is None else np.dot(
+                    self.maps[i], segment)
+            if i in outputs:
+                if segment is not None:
+                    steps.append(('fixed', segment))
+                    segment = None
+                steps.append(('out', outputs[i]))
+        self._steps = steps
+
+    def deltas(self, values):
+        """Get the knob deviations from the reference for a dict of knob
+        values. Unknown keys are ignored."""
+        delta = np.zeros(len(self.knobs))
+        for name, value in values.items():
+            k = self.knob_index.get(name.lower())
+            if k is not None:
+                delta[k] = value - self.knob_values[k]
+        return delta
+
+    def compute(self, deltas):
+        """
+        Compute monitor readouts for a batch of knob deviations.
+
+        :param deltas: ``(B, K)`` array of knob deviations from the reference
+        :returns: dict with ``(B, M)`` arrays for x/y/envx/envy
+        """
+        deltas = np.atleast_2d(np.asarray(deltas, dtype=float))
+        batch = len(deltas)
+        var_maps = np.repeat(
+            self.maps[self._var_elems][:, None], batch, axis=1)
+        contrib = (deltas[:, self.deriv_knobs].T[:, :, None, None] *
+                   self.deriv_maps[:, None])
+        np.add.at(var_maps, self._deriv_pos, contrib)
+
+        orbit = np.tile(self.orbit0, (batch, 1))
+        sigma = np.tile(self.sigma0, (batch, 1, 1))
+        monitors = len(self.monitors)
+        result = {col: np.zeros((batch, monitors))
+                  for col in ('x', 'y', 'envx', 'envy')}
+        for kind, arg in self._steps:
+            if kind == 'out':
+                result['x'][:, arg] = orbit[:, 0]
+                result['y'][:, arg] = orbit[:, 2]
+                result['envx'][:, arg] = np.sqrt(sigma[:, 0, 0])
+                result['envy'][:, arg] = np.sqrt(sigma[:, 2, 2])
+                continue
+            rmat = arg if kind == 'fixed' else var_maps[arg]
+            orbit = np.matmul(rmat, orbit[..., None])[..., 0]
+            r6 = rmat[..., :6, :6]
+            sigma = np.matmul(np.matmul(r6, sigma), np.swapaxes(r6, -1, -2))
+        return result
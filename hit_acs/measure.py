@@ -0,0 +1,311 @@
+"""
+Measurement procedures that run on top of a :class:`~hit_acs.plugin._HitACS`
+backend (real or simulated).
+"""
+
+import time
+import logging
+import warnings
+from collections import namedtuple
+
+import numpy as np
+
+
+__all__ = [
+    'Settling',
+    'SettlingDetector',
+    'OrbitResponse',
+    'measure_orbit_response',
+]
+
+
+Settling = namedtuple('Settling', ['settled', 'time', 'shots', 'drift'])
+Settling.__doc__ = """
+Result of :meth:`SettlingDetector.wait`: whether the beam settled before the
+timeout, the time (s) and number of shots it took, and the final drift
+(relative to the threshold, i.e. <= 1 means settled).
+"""
+
+
+class SettlingDetector(object):
+
+    """
+    Waits until the monitor readouts are stable after a change, instead of
+    sleeping for a fixed time.
+
+    Shots are read one by one, and the mean of the last `window` shots is
+    compared with the mean of the `window` shots before. The beam is
+    considered settled when for every monitor and column (posx/posy/envx/
+    envy) the difference is below `threshold` standard errors, or below the
+    absolute `tolerance` (m). Gives up after `timeout` seconds.
+
+    The shot noise must be known from a quiet period, because the shots
+    after a change contain the transient: :meth:`calibrate` reads
+    `noise_shots` shots before the change and takes the scatter about a
+    linear fit. For monitors that were not calibrated, only the `tolerance`
+    is used.
+
+    Instances can be passed as ``settle`` argument to the measurement
+    procedures (which calibrate them before the first change), or used
+    around any ``execute``::
+
+        detector = SettlingDetector(window=3, threshold=3.0)
+        detector.calibrate(backend, monitors)
+        backend.execute()
+        result = detector.wait(backend, monitors)
+
+    :ivar dict noise: shot noise per column (standard deviation) by monitor
+    :ivar Settling last: result of the most recent :meth:`wait`
+    """
+
+    def __init__(self, window=3, threshold=3.0, tolerance=1e-5,
+                 timeout=10.0, noise_shots=20):
+        self.window = window
+        self.threshold = threshold
+        self.tolerance = tolerance
+        self.timeout = timeout
+        self.noise_shots = noise_shots
+        self.noise = {}
+        self.last = None
+
+    def __call__(self, backend, monitors):
+        return self.wait(backend, monitors)
+
+    def calibrate(self, backend, monitors, timeout=None):
+        """Measure the shot noise of `monitors` while the beam is stable.
+        Monitors that are already calibrated are skipped."""
+        monitors = [m for m in monitors if m not in self.noise]
+        if monitors:
+            shots = backend.read_shots(monitors, self.noise_shots, timeout)
+            self.noise.update(zip(monitors, _detrended_std(shots)))
+
+    def wait(self, backend, monitors):
+        """Read shots until the readouts of `monitors` are stable. Returns
+        a :class:`Settling`."""
+        started = time.time()
+        keep = 2 * self.window
+        shots = []
+        noise = None
+        count = 0
+        drift = float('inf')
+        settled = False
+        try:
+            for shot in backend.iter_shots(monitors, self.timeout):
+                if noise is None:
+                    unknown = np.full(shot.shape[1:], np.nan)
+                    noise = np.array([
+                        self.noise.get(m, unknown) for m in monitors])
+                shots.append(shot)
+                del shots[:-keep]
+                count += 1
+                if len(shots) >= keep:
+                    drift = self.drift(np.array(shots), noise)
+                    if drift <= 1:
+                        settled = True
+                        break
+        except RuntimeError:        # no new shot before the timeout
+            pass
+        result = self.last = Settling(
+            settled, time.time() - started, count, drift)
+        if not settled:
+            logging.warning(
+                "Beam not settled after {:.1f} s ({} shots, drift {:.2f})"
+                .format(result.time, result.shots, drift))
+        return result
+
+    def drift(self, shots, noise):
+        """
+        Get the drift between the means of the last two windows of
+        ``(shots, monitors, columns)`` readouts, relative to the threshold,
+        given the ``(monitors, columns)`` shot `noise` (NaN if unknown).
+        Values <= 1 mean settled. Readouts that are NaN are ignored.
+        """
+        w = self.window
+        old, new = shots[-2*w:-w], shots[-w:]
+        with warnings.catch_warnings():
+            # all-NaN readouts are handled below:
+            warnings.simplefilter('ignore', RuntimeWarning)
+            diff = np.abs(np.nanmean(new, axis=0) - np.nanmean(old, axis=0))
+            sigma = np.asarray(noise) * np.sqrt(2.0 / w)
+            ratio = diff / np.fmax(self.threshold * sigma, self.tolerance)
+        ratio = ratio[~np.isnan(ratio)]
+        return float(ratio.max()) if ratio.size else 0.0
+
+
+def _detrended_std(shots):
+    """
+    Standard deviation of ``(shots, ...)`` readouts about a linear fit in
+    time, so that a slow drift during the calibration does not count as
+    noise. NaN readouts are ignored, the result is NaN with less than three
+    valid readouts.
+    """
+    t = np.arange(len(shots), dtype=float).reshape((-1,) + (1,) * (
+        shots.ndim - 1))
+    valid = ~np.isnan(shots)
+    y = np.where(valid, shots, 0.0)
+    n = valid.sum(axis=0)
+    st = np.sum(valid * t, axis=0)
+    stt = np.sum(valid * t**2, axis=0)
+    sy = y.sum(axis=0)
+    sty = np.sum(t * y, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (n * sty - st * sy) / (n * stt - st**2)
+        offset = (sy - slope * st) / n
+        resid = np.where(valid, shots - offset - slope * t, 0.0)
+        var = np.sum(resid**2, axis=0) / (n - 2)
+    return np.where(n >= 3, np.sqrt(var), np.nan)
+
+
+class OrbitResponse(object):
+
+    """
+    Result of :func:`measure_orbit_response`.
+
+    :ivar list monitors: monitor names (M)
+    :ivar list knobs: knob names (K)
+    :ivar np.ndarray kicks: ``(K,)`` kick size per knob
+    :ivar np.ndarray base: ``(K,)`` knob values before the measurement
+    :ivar np.ndarray orbit: ``(M, 2)`` mean x/y orbit of the reference
+        setting (NaN if it was not measured)
+    :ivar np.ndarray response: ``(M, 2, K)`` orbit change per unit knob
+        change, for x and y
+    :ivar np.ndarray error: ``(M, 2, K)`` standard error of `response`
+    :ivar np.ndarray shots: ``(S, N, M, 2)`` raw x/y readouts for each of
+        the `S` settings and `N` shots per setting
+    :ivar list settings: ``(knob_index, sign)`` of each setting, with
+        ``(None, 0)`` for the reference
+    :ivar dict stats: number of settings, executes and shots, and time
+    """
+
+    def __init__(self, monitors, knobs, kicks, base, orbit, response, error,
+                 shots, settings, stats):
+        self.monitors = monitors
+        self.knobs = knobs
+        self.kicks = kicks
+        self.base = base
+        self.orbit = orbit
+        self.response = response
+        self.error = error
+        self.shots = shots
+        self.settings = settings
+        self.stats = stats
+
+
+def _schedule(knobs, base, kicks, two_sided):
+    """
+    Plan the settings as list of ``((knob_index, sign), changes)``, where
+    `changes` are the writes to get there from the previous setting. The
+    restore of each knob is merged into the first kick of the next knob, so
+    there is only one execute per setting plus one for the final restore.
+    """
+    signs = (+1, -1) if two_sided else (+1,)
+    steps = [] if two_sided else [((None, 0), {})]
+    prev = None
+    for k, knob in enumerate(knobs):
+        for sign in signs:
+            changes = {knob: float(base[k] + sign * kicks[k])}
+            if prev is not None:
+                changes[knobs[prev]] = float(base[prev])
+                prev = None
+            steps.append(((k, sign), changes))
+        prev = k
+    return steps
+
+
+def measure_orbit_response(backend, monitors, knobs, kicks, shots=5,
+                           two_sided=True, settle=None, timeout=None):
+    """
+    Measure the orbit response matrix of `monitors` with respect to `knobs`.
+
+    Each knob is changed by ``+kick`` and ``-kick`` (or only ``+kick``,
+    with the reference orbit measured once, if not `two_sided`) from its
+    current value. All monitors are read in one batch for `shots` shots
+    per setting. Knobs are restored afterwards, also on errors.
+
+    :param backend: connected :class:`~hit_acs.plugin._HitACS`
+    :param kicks: kick size, either one for all knobs or one per knob
+    :param settle: called as ``settle(backend, monitors)`` after each
+        execute to wait until the beam is stable, e.g. a
+        :class:`SettlingDetector`, or a fixed time in seconds
+    :param timeout: maximum time (s) to read the shots of one setting
+    :returns: :class:`OrbitResponse`
+    """
+    knobs = list(knobs)
+    monitors = list(monitors)
+    kicks = np.broadcast_to(np.asarray(kicks, dtype=float), (len(knobs),))
+    values = backend.read_params(knobs)
+    missing = [knob for knob in knobs if knob not in values]
+    if missing:
+        raise RuntimeError("Cannot read knobs: {}".format(missing))
+    base = np.array([values[knob] for knob in knobs], dtype=float)
+    steps = _schedule(knobs, base, kicks, two_sided)
+    initial = dict(zip(knobs, base.tolist()))
+    _calibrate(backend, settle, monitors, timeout)
+
+    started = time.time()
+    executes = 0
+    current = {}
+    data = np.full((len(steps), shots, len(monitors), 2), np.nan)
+    try:
+        for i, (setting, changes) in enumerate(steps):
+            if changes:
+                for knob, value in changes.items():
+                    backend.write_param(knob, value)
+                current.update(changes)
+                backend.execute()
+                executes += 1
+                _settle(backend, settle, monitors)
+            data[i] = backend.read_shots(monitors, shots, timeout)[..., :2]
+    finally:
+        restore = {knob: initial[knob] for knob, value in current.items()
+                   if value != initial[knob]}
+        if restore:
+            for knob, value in restore.items():
+                backend.write_param(knob, value)
+            backend.execute()
+            executes += 1
+    elapsed = time.time() - started
+
+    settings = [setting for setting, changes in steps]
+    mean = np.nanmean(data, axis=1)
+    count = np.sum(~np.isnan(data), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sem = np.nanstd(data, axis=1, ddof=1) / np.sqrt(count)
+    orbit = np.full((len(monitors), 2), np.nan)
+    if two_sided:
+        plus = mean[0::2], sem[0::2]
+        minus = mean[1::2], sem[1::2]
+        scale = 2 * kicks
+    else:
+        orbit = mean[0]
+        plus = mean[1:], sem[1:]
+        minus = mean[:1], sem[:1]
+        scale = kicks
+    response = np.moveaxis(
+        (plus[0] - minus[0]) / scale[:, None, None], 0, -1)
+    error = np.moveaxis(
+        np.sqrt(plus[1]**2 + minus[1]**2) / scale[:, None, None], 0, -1)
+    stats = {
+        'settings': len(steps),
+        'executes': executes,
+        'shots': len(steps) * shots,
+        'time': elapsed,
+    }
+    logging.debug('Orbit response: {}'.format(stats))
+    return OrbitResponse(monitors, knobs, kicks, base, orbit, response,
+                         error, data, settings, stats)
+
+
+def _calibrate(backend, settle, monitors, timeout):
+    """Let `settle` measure the noise before the first change, if needed."""
+    if hasattr(settle, 'calibrate'):
+        settle.calibrate(backend, monitors, timeout)
+
+
+def _settle(backend, settle, monitors):
+    if settle is None:
+        return
+    if callable(settle):
+        settle(backend, monitors)
+    elif settle > 0:
+        time.sleep(settle)
@@ -0,0 +1,144 @@
+"""
+MEFI lookup tables for :class:`~hit_acs.beamoptikstub.BeamOptikStub`.
+
+A table maps the channel numbers of a MEFI combination (energy, focus,
+intensity) to the physical values, and (energy, focus) to the values of all
+parameters that depend on the setpoint. All data is stored in dense arrays,
+so that lookups are simple indexing operations.
+"""
+
+import numpy as np
+
+from .beamoptikdll import BeamOptikDLL, EFI
+
+
+__all__ = [
+    'MEFITable',
+]
+
+
+class MEFITable(object):
+
+    """
+    MEFI data of one vAcc.
+
+    :ivar np.ndarray energy: physical energy (MeV/u) per energy channel
+    :ivar np.ndarray focus: focus (m) per focus channel
+    :ivar np.ndarray intensity: intensity per intensity channel
+    :ivar list param_names: names of the parameters in :attr:`values`
+    :ivar np.ndarray values: ``(energies, foci, params)`` parameter values
+    :ivar tuple reference: ``(energy, focus)`` channels of the reference
+        parameter set
+
+    Channel numbers start at 1, as in the DLL API.
+    """
+
+    def __init__(self, energy, focus, intensity, param_names, values,
+                 reference=(1, 1)):
+        self.energy = np.asarray(energy, dtype=float)
+        self.focus = np.asarray(focus, dtype=float)
+        self.intensity = np.asarray(intensity, dtype=float)
+        self.param_names = list(param_names)
+        self.values = np.asarray(values).reshape(
+            len(self.energy), len(self.focus), len(self.param_names))
+        self.reference = tuple(int(c) for c in reference)
+
+    @classmethod
+    def generate(cls, params, config=None):
+        """
+        Generate a table around the reference parameter set `params`.
+        Configured by a dict (e.g. the ``mefi`` entry in the stub settings)
+        such as::
+
+            energy: [48.12, 221.06]     # range (MeV/u) or list of values
+            focus: [0.008, 0.010, 0.012, 0.015, 0.020, 0.030]   # (m)
+            intensity: [8.0e7, 3.2e9]   # range or list of values
+            ref_energy: null            # channel of the reference energy
+            ref_focus: 1                # channel of the reference optics
+            focus_gain: 0.02            # relative change of kl per channel
+
+        ``E_HEBT`` follows the energy and quadrupole strengths (``kl_*``)
+        are scaled with the focus channel. Only these parameters are stored,
+        all others are the same for all setpoints.
+
+        The setpoint at the reference channels is `params` itself, i.e. the
+        energy of the reference channel is set to the ``E_HEBT`` of
+        `params`. By default, this is the channel closest to it.
+        """
+        config = config or {}
+        energy = _channels(config.get('energy', [48.12, 221.06]), 255)
+        focus = _channels(config.get(
+            'focus', [0.008, 0.010, 0.012, 0.015, 0.020, 0.030]), 6)
+        intensity = _channels(
+            config.get('intensity', [8.0e7, 3.2e9]), 15, log=True)
+        ref_energy = config.get('ref_energy')
+        ref_focus = config.get('ref_focus', 1)
+        gain = config.get('focus_gain', 0.02)
+
+        e_hebt = [float(params[name]) for name in params
+                  if name.lower() == 'e_hebt']
+        if e_hebt:
+            if ref_energy is None:
+                ref_energy = int(np.argmin(abs(energy - e_hebt[0]))) + 1
+            energy[ref_energy-1] = e_hebt[0]
+        elif ref_energy is None:
+            ref_energy = 1
+
+        quads = [name for name in params if name.lower().startswith('kl_')]
+        base = np.array([float(params[name]) for name in quads])
+        scale = 1 + gain * (np.arange(1, len(focus)+1) - ref_focus)
+        values = np.empty((len(energy), len(focus), len(quads) + 1))
+        values[:, :, :-1] = base[None, None, :] * scale[None, :, None]
+        values[:, :, -1] = energy[:, None]
+        names = quads + ['E_HEBT']
+        return cls(energy, focus, intensity, names, values,
+                   (ref_energy, ref_focus))
+
+    @classmethod
+    def load(cls, filename):
+        """Load from a file written by :meth:`save`."""
+        with np.load(filename) as data:
+            reference = (data['reference'] if 'reference' in data.files
+                         else (1, 1))
+            return cls(data['energy'], data['focus'], data['intensity'],
+                       data['param_names'].tolist(), data['values'],
+                       reference)
+
+    def save(self, filename):
+        """Save all data to a ``.npz`` file."""
+        np.savez(
+            filename,
+            energy=self.energy,
+            focus=self.focus,
+            intensity=self.intensity,
+            param_names=np.array(self.param_names),
+            values=self.values,
+            reference=np.array(self.reference))
+
+    def _check(self, energy, focus, intensity):
+        if not (1 <= energy <= len(self.energy) and
+                1 <= focus <= len(self.focus) and
+                1 <= intensity <= len(self.intensity)):
+            BeamOptikDLL.check_return(7)    # General runtime error.
+
+    def physical(self, energy, focus, intensity, gantry_angle=0):
+        """Get physical EFI values for the given channels."""
+        self._check(energy, focus, intensity)
+        return EFI(float(self.energy[energy-1]),
+                   float(self.focus[focus-1]),
+                   float(self.intensity[intensity-1]),
+                   float(gantry_angle))
+
+    def params(self, energy, focus):
+        """Get parameter set for the given channels as dict."""
+        self._check(energy, focus, 1)
+        return dict(zip(self.param_names,
+                        self.values[energy-1, focus-1].tolist()))
+
+
+def _channels(spec, count, log=False):
+    """Get channel values from a list of values or a ``[min, max]`` range."""
+    if len(spec) == count or len(spec) != 2:
+        return np.asarray(spec, dtype=float)
+    space = np.geomspace if log else np.linspace
+    return space(spec[0], spec[1], count)
@@ -3,23 +3,66 @@ Utilities for reading .xml file with MWPC offsets.
 """
 
 import os
+import time
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime
 from glob import glob
 from xml.etree import ElementTree
 
-from madgui.util.unit import from_ui, from_config
+import numpy as np
 
 
 PREFIX_ROOM = {'Room1': 'T1', 'Room2': 'T2', 'Room3': 'T3', 'Room4': 'T4'}
 SUFFIX_MWPC = {'MWPC 1': 'DG1G', 'MWPC 2': 'DG2G', 'MWPC 3': 'DF1'}
 
+# The calibration files seen so far carry no documented date field. These
+# IDs and formats are guesses at what the metadata might contain; if none
+# of them match, the file's mtime is used (see `read_calibration_file`):
+TIMESTAMP_IDS = ('Timestamp', 'DateTime', 'Date')
+TIMESTAMP_FORMATS = (
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%d.%m.%Y %H:%M:%S',
+    '%Y-%m-%d %H:%M',
+    '%d.%m.%Y %H:%M',
+    '%Y-%m-%d',
+    '%d.%m.%Y',
+)
+
+Calibration = namedtuple('Calibration', ['time', 'room', 'offsets', 'path'])
+Calibration.__doc__ = """
+Content of one calibration file. ``offsets`` maps MWPC names to tuples
+``(old_x, new_x, old_y, new_y)``, ``time`` is a UNIX timestamp.
+"""
+
 
 def parse_datum(name, datum):
+    # imported here since madgui.util.unit pulls in pint, which is slow:
+    from madgui.util.unit import from_ui, from_config
     value = float(datum.text)
     unit = from_config(datum.attrib['Unit'])
     return from_ui(name, unit, value)
 
 
-def read_offsets_file(path):
+def parse_timestamp(metadata, default=None):
+    """Get the calibration time from the metadata as UNIX timestamp."""
+    texts = [metadata.get(key) for key in TIMESTAMP_IDS]
+    if metadata.get('Date') and metadata.get('Time'):
+        texts.insert(0, '{} {}'.format(metadata['Date'], metadata['Time']))
+    for text in filter(None, texts):
+        for fmt in TIMESTAMP_FORMATS:
+            try:
+                return time.mktime(
+                    datetime.strptime(text.strip(), fmt).timetuple())
+            except ValueError:
+                pass
+    return default
+
+
+def read_calibration_file(path):
+    """Read all data (old and new offsets, time, room) from a .xml file."""
     tree = ElementTree.parse(path)
     root = tree.getroot()
 
@@ -35,28 +78,261 @@ def read_offsets_file(path):
     # - 4 = new Y offset
     offsets = {
         row[0].text: (
+            parse_datum('x', row[1][0]),
             parse_datum('x', row[2][0]),
+            parse_datum('y', row[3][0]),
             parse_datum('y', row[4][0]))
         for row in calibration[1:]
     }
 
     room = metadata['TreatmentRoom']
     prefix = PREFIX_ROOM[room]
-    return {prefix+SUFFIX_MWPC[mwpc]: xy
-            for mwpc, xy in offsets.items()}
+    timestamp = parse_timestamp(metadata)
+    # The metadata format is not known (see TIMESTAMP_IDS), so the mtime is
+    # the expected case for now:
+    if timestamp is None:
+        logging.debug("No calibration date in {!r}, using mtime.".format(path))
+        timestamp = os.path.getmtime(path)
+    return Calibration(timestamp, room, {
+        prefix+SUFFIX_MWPC[mwpc]: values
+        for mwpc, values in offsets.items()
+    }, path)
 
 
-def find_offsets(path):
-    """Find and read .xml files MWPC offsets in `path`."""
+def read_offsets_file(path):
+    return {
+        name: (new_x, new_y)
+        for name, (old_x, new_x, old_y, new_y)
+        in read_calibration_file(path).offsets.items()
+    }
+
+
+def merge_offsets(calibrations):
+    """Merge the new offsets of all calibrations, the latest one wins."""
     offsets = {}
-    for path in glob(os.path.join(path, '*', '*.xml')):
-        try:
-            offsets.update(read_offsets_file(path))
-        except Exception:
-            pass
+    for calib in sorted(calibrations, key=lambda c: (c.time, c.path)):
+        offsets.update({
+            name: (new_x, new_y)
+            for name, (old_x, new_x, old_y, new_y) in calib.offsets.items()
+        })
     return offsets
 
 
+class OffsetHistory(object):
+
+    """
+    Index of all calibrations for point-in-time lookup of MWPC offsets.
+
+    For every MWPC, the calibrations are stored as a structured array sorted
+    by time. The offsets valid at time ``t`` are the new offsets of the last
+    calibration at or before ``t``, or the old offsets of the first
+    calibration if ``t`` precedes all of them. Lookups are done by binary
+    search and can be vectorized over many timestamps at once.
+    """
+
+    dtype = np.dtype([
+        ('time', 'f8'),
+        ('old_x', 'f8'),
+        ('new_x', 'f8'),
+        ('old_y', 'f8'),
+        ('new_y', 'f8'),
+        ('room', 'U8'),
+    ])
+
+    def __init__(self, calibrations):
+        rows = {}
+        for calib in sorted(calibrations, key=lambda c: (c.time, c.path)):
+            for name, values in calib.offsets.items():
+                rows.setdefault(name, []).append(
+                    (calib.time,) + tuple(values) + (calib.room,))
+        self.records = {
+            name: np.array(data, dtype=self.dtype)
+            for name, data in rows.items()
+        }
+
+    @classmethod
+    def from_path(cls, path):
+        """Create the index from all .xml files in `path`."""
+        cache = OffsetCache(path)
+        cache.update()
+        return cache.history()
+
+    def __contains__(self, name):
+        return name in self.records
+
+    def get(self, name, timestamp, default=(0, 0)):
+        """Get offsets ``(x, y)`` for the MWPC `name` valid at `timestamp`."""
+        rec = self.records.get(name)
+        if rec is None:
+            return default
+        i = np.searchsorted(rec['time'], timestamp, side='right')
+        if i == 0:
+            return (float(rec['old_x'][0]), float(rec['old_y'][0]))
+        return (float(rec['new_x'][i-1]), float(rec['new_y'][i-1]))
+
+    def lookup(self, name, timestamps):
+        """
+        Get offsets for the MWPC `name` at each of the given `timestamps`.
+        Returns an array of shape ``(len(timestamps), 2)``.
+        """
+        timestamps = np.asarray(timestamps, dtype=float)
+        result = np.zeros(timestamps.shape + (2,))
+        rec = self.records.get(name)
+        if rec is None:
+            return result
+        i = np.searchsorted(rec['time'], timestamps, side='right')
+        before = i == 0
+        j = np.maximum(i - 1, 0)
+        result[..., 0] = np.where(before, rec['old_x'][0], rec['new_x'][j])
+        result[..., 1] = np.where(before, rec['old_y'][0], rec['new_y'][j])
+        return result
+
+    def at(self, timestamp):
+        """Get offsets of all MWPCs valid at `timestamp` as dict."""
+        return {name: self.get(name, timestamp) for name in self.records}
+
+
+def find_offsets(path):
+    """Find and read .xml files MWPC offsets in `path`."""
+    cache = OffsetCache(path)
+    cache.update()
+    return cache.offsets
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size)
+
+
+def _try_read_calibration_file(path):
+    try:
+        return read_calibration_file(path), None
+    except Exception as e:
+        return None, e
+
+
+class OffsetCache(object):
+
+    """
+    Incrementally loads the MWPC offsets from all ``*/*.xml`` files in a
+    folder.
+
+    Files are only (re-)parsed if their mtime or size changed since the last
+    :meth:`update`. If many files changed at once, they are parsed in a
+    thread pool. Parse failures are logged and collected in :attr:`errors`.
+
+    The merged result (latest calibration wins) is kept in :attr:`offsets`.
+    This dict is updated in place and can therefore be shared with consumers
+    that should follow changes without being reconnected. An existing dict
+    to be filled can be passed as ``offsets``.
+    """
+
+    def __init__(self, path, parallel=16, max_workers=None, offsets=None):
+        self.path = path
+        self.parallel = parallel
+        self.max_workers = max_workers
+        self.offsets = {} if offsets is None else offsets
+        self.errors = {}
+        self._files = {}
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._stop = None
+
+    def update(self):
+        """
+        Rescan the folder and re-parse all new or modified files.
+
+        Returns the sorted list of files that were (re-)parsed or removed.
+        """
+        with self._lock:
+            current = {}
+            for filename in glob(os.path.join(self.path, '*', '*.xml')):
+                try:
+                    current[filename] = _stat_key(filename)
+                except OSError:     # removed in the meantime
+                    continue
+            changed = sorted(
+                filename for filename, key in current.items()
+                if self._files.get(filename, (None,))[0] != key)
+            removed = sorted(set(self._files) - set(current))
+            for filename in removed:
+                del self._files[filename]
+                self.errors.pop(filename, None)
+            results = self._parse_files(changed)
+            for filename, (calib, error) in zip(changed, results):
+                self._files[filename] = (current[filename], calib)
+                if error is None:
+                    self.errors.pop(filename, None)
+                else:
+                    self.errors[filename] = error
+                    logging.warning("Failed to read MWPC offsets from {!r}: {}"
+                                    .format(filename, error))
+            if changed or removed:
+                self._merge()
+            return sorted(changed + removed)
+
+    def calibrations(self):
+        """Get list of all successfully parsed calibrations."""
+        return [calib for key, calib in list(self._files.values()) if calib]
+
+    def history(self):
+        """Create an :class:`OffsetHistory` from the current calibrations."""
+        return OffsetHistory(self.calibrations())
+
+    def _parse_files(self, filenames):
+        if len(filenames) < self.parallel:
+            return [_try_read_calibration_file(f) for f in filenames]
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            return list(executor.map(_try_read_calibration_file, filenames))
+
+    def _merge(self):
+        merged = merge_offsets(self.calibrations())
+        # Update in place without ever showing an empty dict to readers:
+        for name in set(self.offsets) - set(merged):
+            del self.offsets[name]
+        self.offsets.update(merged)
+
+    @property
+    def watching(self):
+        """Whether the background watcher is running."""
+        return self._watcher is not None
+
+    def watch(self, interval=2.0, callback=None):
+        """
+        Start a background thread that polls the folder every ``interval``
+        seconds and updates :attr:`offsets` in place. ``callback(changes)``
+        is invoked with the list of changed files whenever anything changed.
+        """
+        if self._watcher is not None:
+            return
+        stop = self._stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try:
+                    changes = self.update()
+                except Exception as e:
+                    logging.warning("Failed to update MWPC offsets: {}"
+                                    .format(e))
+                    continue
+                if changes and callback is not None:
+                    callback(changes)
+
+        self._watcher = threading.Thread(
+            target=run, name='OffsetCache.watch')
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def unwatch(self):
+        """Stop the background watcher (if running)."""
+        if self._watcher is not None:
+            self._stop.set()
+            self._watcher.join()
+            self._watcher = None
+            self._stop = None
+
+
 def print_offsets(path):
     print(path+':')
     for mwpc, (x, y) in read_offsets_file(path).items():
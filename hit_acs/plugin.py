@@ -7,23 +7,24 @@ from __future__ import absolute_import
 
 import os
 import logging
-
-from importlib_resources import read_binary
-from pydicti import dicti
+import threading
+from functools import partial
 
 from .beamoptikdll import BeamOptikDLL, ExecOptions
-from .beamoptikstub import BeamOptikStub
 
-import madgui.util.unit as unit
+# Heavy modules (numpy, pint via madgui.util.unit, Qt, the stub) are
+# imported where they are needed to keep the plugin import fast:
 import madgui.online.api as api
-from madgui.util.misc import relpath as safe_relpath
+from madgui.util.misc import relpath as safe_relpath, cachedproperty
 from madgui.util.collections import Bool
-from madgui.util.qt import SingleWindow
 
-from .dvm_parameters import load_csv
-from .offsets import find_offsets
+from .util import TimeoutCache, ShotPrefetcher, Deferred, KeyRegistry
+from .trace import traced
+from . import trace
 
-import numpy as np
+# The DLL wrapper depends only on the standard library, so it gets the
+# tracer through a hook:
+BeamOptikDLL.tracer = trace.TRACER
 
 ENERGY_PARAM = {
     'lebt': 'E_SOURCE',
@@ -38,6 +39,7 @@ PERIODIC_TABLE = {
 }
 
 MEFI_PARAMS = ('beam_energy', 'beam_focus', 'beam_intensity', 'gantry_angle')
+_MEFI_INDEX = {name: i for i, name in enumerate(MEFI_PARAMS)}
 
 VACC_TABLE = {
     'T1': ([1, 6,  11], 'hht1.cpymad.yml'),
@@ -48,6 +50,9 @@ VACC_TABLE = {
 }
 
 def load_dvm_parameters():
+    from importlib_resources import read_binary
+    from pydicti import dicti
+    from .dvm_parameters import load_csv
     blob = read_binary('hit_acs', 'DVM-Parameter_v2.10.0-HIT.csv')
     parlist = load_csv(blob.splitlines(), 'utf-8')
     return dicti({p['name']: p for p in parlist})
@@ -55,10 +60,105 @@ def load_dvm_parameters():
 
 class _HitACS(api.Backend):
 
+    # Set by subclasses that load offsets from the runtime folder:
+    _offsets_path = None
+    _offset_cache = None
+    _watch_offsets = 0
+    _watch_service = None
+
     def __init__(self, lib, params, model=None, offsets=None, settings=None,
                  control=None):
+        """
+        `params` is the parameter table, or a function returning it. The
+        function and the initial scan of the offset folder (see
+        :meth:`_load_offsets`) are run in a background thread, unless the
+        ``background_init`` setting is false. :meth:`connect` and all methods
+        that need the parameter table wait for it to finish.
+        """
         self._lib = lib
-        self._params = dicti({
+        self._model = model
+        self._offsets = {} if offsets is None else offsets
+        self.connected = Bool(False)
+        self.settings = settings
+        self.control = control
+        self.vAcc = -1
+        config = settings or {}
+        # Spans are exported to the `trace` file on disconnect:
+        if config.get('trace'):
+            trace.enable(config.get('trace_events'))
+        # Names are normalized once here, so that the tables and caches can
+        # be plain dicts keyed by canonical (lowercase) names:
+        self._keys = KeyRegistry()
+        self._ready = Deferred(
+            lambda: self._load_data(params),
+            background=config.get('background_init', True))
+        # With a nonzero `pool_size`, reads are spread over additional
+        # interface instances, see `hit_acs.pool.InterfacePool`:
+        self._pool = None
+        self._pending_writes = set()
+        # Without a pool, the GUI and the background services (watch,
+        # snapshot, archive) share one instance, so all calls are serialized:
+        self._lib_lock = threading.RLock()
+        get_float = partial(self._call_writer, 'GetFloatValue')
+        get_sd = partial(self._call_writer, 'GetFloatValueSD')
+        if config.get('pool_size'):
+            from .pool import InterfacePool
+            self._pool = InterfacePool(
+                lib, lib.new_client, config['pool_size'],
+                config.get('pool_check_interval', 10.0))
+            get_float, get_sd = self._pooled_float, self._pooled_sd
+        # Read caches in front of the DLL. Writes and `execute` invalidate
+        # the affected entries, the timeout covers changes by other clients:
+        self._float_cache = TimeoutCache(
+            get_float,
+            timeout=config.get('param_cache_timeout', 0.5),
+            maxsize=config.get('read_cache_size', 4096))
+        # Monitor readouts change only once per shot, so all SD values are
+        # fetched together at the first read after each shot:
+        self._sd_prefetch = ShotPrefetcher(
+            get_sd,
+            shot_interval=config.get('shot_interval', 1.0),
+            phase=config.get('shot_phase', 0.0),
+            expire=config.get('shot_expire', 10))
+        # Memoized conversions (see `ui_factors` and `get_beam`):
+        self._ui_factor_cache = {}
+        self._beam = None
+
+    @property
+    def _params(self):
+        """Parameter table keyed by canonical names (waits for the background
+        initialization)."""
+        return self._ready.result()[0]
+
+    @property
+    def _param_keys(self):
+        """List of ``(name, key)`` for all parameters."""
+        return self._ready.result()[1]
+
+    @property
+    def _param_infos(self):
+        """:class:`ParamInfo` objects keyed by canonical names."""
+        return self._ready.result()[2]
+
+    @cachedproperty
+    def _ui_factors(self):
+        """``(index, factors)`` with the position of every canonical name in
+        :attr:`_param_keys`, and the array of ``ui_conv`` factors."""
+        import numpy as np
+        table = self._params
+        keys = self._param_keys
+        factors = np.array([
+            table[key].get('ui_conv') or 1.0 for name, key in keys
+        ], dtype=float)
+        return {key: i for i, (name, key) in enumerate(keys)}, factors
+
+    def _load_data(self, params):
+        if self._offsets_path is not None:
+            from .offsets import OffsetCache
+            cache = OffsetCache(self._offsets_path, offsets=self._offsets)
+            cache.update()
+            self._offset_cache = cache
+        table = {
             'beam_energy': dict(
                 name='beam_energy',
                 ui_name='beam_energy',
@@ -91,14 +191,35 @@ class _HitACS(api.Backend):
                 unit='°',
                 ui_unit='°',
                 ui_conv=1),
-        })
-        self._params.update(params)
-        self._model = model
-        self._offsets = {} if offsets is None else offsets
-        self.connected = Bool(False)
-        self.settings = settings
-        self.control = control
-        self.vAcc = -1
+        }
+        table.update(params() if callable(params) else params)
+        key = self._keys.key
+        names = [(name, key(name)) for name in table]
+        table = {k: table[name] for name, k in names}
+        infos = {k: api.ParamInfo(**data) for k, data in table.items()}
+        return table, names, infos
+
+    def _pooled_float(self, key):
+        # Changes that are not executed yet are only visible to the writer:
+        if key in self._pending_writes:
+            return self._pool.write('GetFloatValue', key)
+        return self._pool.call('GetFloatValue', key)
+
+    def _pooled_sd(self, key):
+        return self._pool.call('GetFloatValueSD', key)
+
+    def _call_writer(self, name, *args):
+        """Call the API method `name` on the writer instance (serialized with
+        all other calls on it). All calls that change or depend on the
+        vAcc/MEFI selection must go through here."""
+        if self._pool is None:
+            with self._lib_lock:
+                return getattr(self._lib, name)(*args)
+        return self._pool.write(name, *args)
+
+    def wait_ready(self, timeout=None):
+        """Wait until the parameter table and offsets are loaded."""
+        self._ready.result(timeout)
 
     @property
     def beamoptikdll(self):
@@ -109,50 +230,158 @@ class _HitACS(api.Backend):
 
     def connect(self):
         """Connect to online database (must be loaded)."""
-        status = self._lib.GetInterfaceInstance()
+        self.wait_ready()
+        status = self._call_writer('GetInterfaceInstance')
         logging.debug('Conection status: {}'.format(status))
+        if self._offset_cache and self._watch_offsets:
+            self._offset_cache.watch(self._watch_offsets)
+        if self._watch_service and self._watch_service.watches:
+            self._watch_service.start()
         self.connected.set(True)
 
     def disconnect(self):
         """Disconnect from online database."""
         (self.settings or {}).update(self.export_settings())
-        self._lib.FreeInterfaceInstance()
+        if self._offset_cache:
+            self._offset_cache.unwatch()
+        if self._watch_service:
+            self._watch_service.stop()
+        if self._pool:
+            self._pool.close()
+        self._call_writer('FreeInterfaceInstance')
+        if (self.settings or {}).get('trace'):
+            trace.export(self.settings['trace'])
         self.connected.set(False)
 
     def export_settings(self):
         """Updates the settings yaml file for future loggins"""
-        mefi = self._lib.GetMEFIValue()[1]
+        mefi = self._call_writer('GetMEFIValue')[1]
         settings = {
             'variant': self._lib._variant,
-            'vacc': self._lib.GetSelectedVAcc(),
+            'vacc': self._call_writer('GetSelectedVAcc'),
             'mefi': mefi and tuple(mefi),
         }
         if hasattr(self._lib, 'export_settings'):
             settings.update(self._lib.export_settings())
         return settings
 
+    @traced()
     def execute(self, options=ExecOptions.CalcDif):
         """Execute changes (commits prior set_value operations)."""
-        self._lib.ExecuteChanges(options)
+        self._call_writer('ExecuteChanges', options)
+        self._invalidate()
+
+    def _invalidate(self):
+        """Drop all cached values after changes to the control system."""
+        self._pending_writes.clear()
+        if self._pool:
+            self._pool.invalidate()
+        self._float_cache.invalidate()
+        self._sd_prefetch.invalidate()
+
+    def watch(self, callback, params=(), monitors=(), tolerance=0.0):
+        """
+        Call ``callback(params, monitors)`` with the changed values whenever
+        any of the given parameters or monitors changes by more than
+        `tolerance`. Returns a :class:`~hit_acs.watch.Watch` that can be
+        cancelled. All watches share one batched read per polling tick. The
+        polling interval adapts to the activity, within the limits of the
+        ``watch`` setting (see :class:`~hit_acs.watch.WatchService`).
+        Callbacks are invoked from a background thread.
+        """
+        if self._watch_service is None:
+            from .watch import WatchService
+            self._watch_service = WatchService(
+                self, **((self.settings or {}).get('watch') or {}))
+        watch = self._watch_service.add(callback, params, monitors, tolerance)
+        if self.connected():
+            self._watch_service.start()
+        return watch
+
+    def publish_snapshots(self, filename, monitors=(), interval=None):
+        """
+        Create a :class:`~hit_acs.snapshot.SnapshotPublisher` that publishes
+        all parameters of the parameter table and the given `monitors` into
+        the memory mapped file `filename`, for other local processes to read
+        with :class:`~hit_acs.snapshot.SnapshotReader`. If `interval` is
+        given, snapshots are published periodically in the background.
+        """
+        from .snapshot import SnapshotPublisher
+        publisher = SnapshotPublisher(
+            filename, [name for name, key in self._param_keys], monitors,
+            backend=self)
+        if interval is not None:
+            publisher.start(interval)
+        return publisher
+
+    def archive(self, path, params=None, monitors=(), interval=None,
+                **kwargs):
+        """
+        Create a :class:`~hit_acs.archive.ArchiveWriter` that logs the given
+        `params` (default all parameters of the parameter table), `monitors`,
+        vAcc and MEFI channels to the archive folder `path`. If `interval`
+        is given, records are appended periodically in the background. Other
+        arguments are passed to the writer.
+        """
+        from .archive import ArchiveWriter
+        if params is None:
+            params = [name for name, key in self._param_keys]
+        writer = ArchiveWriter(path, params, monitors, backend=self, **kwargs)
+        if interval is not None:
+            writer.start(interval)
+        return writer
+
+    def pool_stats(self):
+        """Return usage counters of the interface instance pool (empty if
+        the ``pool_size`` setting is zero)."""
+        return dict(self._pool.stats) if self._pool else {}
+
+    def cache_stats(self):
+        """Get counters of the parameter cache and the SD prefetcher."""
+        return {
+            'params': self._float_cache.stats(),
+            'sd': self._sd_prefetch.stats(),
+        }
 
     def param_info(self, knob):
         """Get parameter info for backend key."""
-        data = self._params.get(knob)
-        return data and api.ParamInfo(**data)
+        return self._param_infos.get(self._keys.key(knob))
 
+    @traced()
     def read_monitor(self, name):
         """
         Read out one monitor, return values as dict with keys
         posx/posy/envx/envy.
         """
+        return self.read_monitors([name])[1].get(name, {})
+
+    @traced()
+    def read_monitors(self, names):
+        """
+        Read out multiple monitors from the same shot. Return ``(epoch,
+        {name: values})`` where `epoch` increases with every new shot, and
+        `values` is a dict as returned by :meth:`read_monitor`.
+        """
+        keys = self._keys.keys(names)
+        sd_names = [
+            prefix + key
+            for key in keys
+            for prefix in ('posx_', 'posy_', 'widthx_', 'widthy_')
+        ]
+        epoch, values = self._sd_prefetch.read(sd_names)
+        return epoch, {
+            name: self._convert_monitor(name, key, values)
+            for name, key in zip(names, keys)
+        }
+
+    def _convert_monitor(self, name, key, values):
         # TODO: Handle usability of parameters individually
         try:
-            GetFloatValueSD = self._lib.GetFloatValueSD
-            posx = GetFloatValueSD('posx_' + name)
-            posy = GetFloatValueSD('posy_' + name)
-            envx = GetFloatValueSD('widthx_' + name)
-            envy = GetFloatValueSD('widthy_' + name)
-        except RuntimeError:
+            posx = values['posx_' + key]
+            posy = values['posy_' + key]
+            envx = values['widthx_' + key]
+            envy = values['widthy_' + key]
+        except KeyError:    # GetFloatValueSD failed
             return {}
         # TODO: move sanity check to later, so values will simply be
         # unchecked/grayed out, instead of removed completely
@@ -168,33 +397,174 @@ class _HitACS(api.Backend):
             'envy': envy / 1000,
         }
 
+    def read_shots(self, names, shots=1, timeout=None):
+        """
+        Read `shots` consecutive shots of the given monitors, waiting for the
+        next shot where necessary. Returns a ``(shots, monitors, 4)`` array
+        with columns posx/posy/envx/envy (see :meth:`read_monitor`), or NaN
+        where the readout failed. Raises ``RuntimeError`` if not all shots
+        could be read within `timeout` seconds.
+        """
+        import numpy as np
+        data = np.full((shots, len(names), 4), np.nan)
+        for i, shot in zip(range(shots), self.iter_shots(names, timeout)):
+            data[i] = shot
+        return data
+
+    def iter_shots(self, names, timeout=None):
+        """
+        Generate ``(monitors, 4)`` arrays as for :meth:`read_shots` for every
+        new shot, starting with the first shot after the last change (see
+        :meth:`execute`). Raises ``RuntimeError`` when the next shot would
+        arrive after `timeout` seconds (counted from the start).
+        """
+        import time
+        import numpy as np
+        cols = ('posx', 'posy', 'envx', 'envy')
+        deadline = None if timeout is None else time.time() + timeout
+        # Skip the shots that were taken before the last change:
+        last = self._sd_prefetch.changed_epoch
+        while True:
+            epoch, values = self.read_monitors(names)
+            if epoch <= last:
+                wait = self._sd_prefetch.next_shot_in()
+                if deadline is not None and time.time() + wait > deadline:
+                    raise RuntimeError("Timeout while waiting for shot.")
+                time.sleep(wait)
+                continue
+            last = epoch
+            shot = np.full((len(names), len(cols)), np.nan)
+            for m, name in enumerate(names):
+                readout = values[name]
+                if readout:
+                    shot[m] = [readout[col] for col in cols]
+            yield shot
+
+    @cachedproperty
+    def settling_detector(self):
+        """Default :class:`~hit_acs.measure.SettlingDetector`, configured by
+        the ``settling`` setting (dict of its arguments)."""
+        from .measure import SettlingDetector
+        return SettlingDetector(**((self.settings or {}).get('settling') or {}))
+
+    def wait_settled(self, monitors, detector=None):
+        """
+        Wait until the readouts of `monitors` are stable, e.g. after
+        :meth:`execute`. Returns a :class:`~hit_acs.measure.Settling` with
+        the time it took. The detector should be calibrated before the
+        change, see :meth:`~hit_acs.measure.SettlingDetector.calibrate`.
+        """
+        if detector is None:
+            detector = self.settling_detector
+        return detector.wait(self, monitors)
+
+    def measure_orbit_response(self, monitors, knobs, kicks, **kwargs):
+        """Measure the orbit response matrix, see
+        :func:`hit_acs.measure.measure_orbit_response`."""
+        from .measure import measure_orbit_response
+        return measure_orbit_response(self, monitors, knobs, kicks, **kwargs)
+
+    def scan(self, plan, monitors, **kwargs):
+        """Run a parameter scan and generate the results point by point,
+        see :func:`hit_acs.scan.run_scan`."""
+        from .scan import run_scan
+        return run_scan(self, plan, monitors, **kwargs)
+
+    def mefi_sweep(self, vacc, energy, focus, intensity=(1,), **kwargs):
+        """Record parameters for all given MEFI channel combinations, see
+        :func:`~hit_acs.sweep.run_mefi_sweep`."""
+        from .sweep import run_mefi_sweep
+        return run_mefi_sweep(self, vacc, energy, focus, intensity, **kwargs)
+
+    @traced()
     def read_params(self, param_names=None, warn=True):
         """Read all specified params (by default all). Return dict."""
         if param_names is None:
-            param_names = self._params
+            items = self._param_keys
             warn = False
+        else:
+            key = self._keys.key
+            items = [(param, key(param)) for param in param_names]
+        read = self._read_key
         return {
             param: value
-            for param in param_names
-            for value in [self.read_param(param, warn=warn)]
+            for param, key in items
+            for value in [read(key, warn)]
             if value is not None
         }
 
+    def read_param_vector(self, param_names=None):
+        """Read the specified params (by default all, in the order of the
+        parameter table) into an array, with NaN for failed reads."""
+        import numpy as np
+        if param_names is None:
+            keys = [key for name, key in self._param_keys]
+        else:
+            keys = self._keys.keys(param_names)
+        read = self._read_key
+        return np.array([read(key, False) for key in keys], dtype=float)
+
+    def ui_factors(self, param_names=None):
+        """
+        Return the array of factors from internal to UI units (``ui_conv``)
+        for the given parameter names (by default all, in the order of the
+        parameter table). Unknown parameters have a factor of 1. The arrays
+        are cached per list of names.
+        """
+        index, factors = self._ui_factors
+        if param_names is None:
+            return factors
+        param_names = tuple(param_names)
+        cache = self._ui_factor_cache
+        result = cache.get(param_names)
+        if result is None:
+            import numpy as np
+            pos = [index.get(key, -1) for key in self._keys.keys(param_names)]
+            result = np.append(factors, 1.0)[pos]
+            if len(cache) >= 64:
+                cache.clear()
+            cache[param_names] = result
+        return result
+
+    def to_ui(self, values, param_names=None):
+        """
+        Convert parameter values to UI units in one vectorized step. `values`
+        is either an array in the order of `param_names` (see
+        :meth:`ui_factors`), or a dict as returned by :meth:`read_params`,
+        in which case a dict is returned.
+        """
+        if isinstance(values, dict):
+            names = list(values)
+            converted = self.ui_factors(names) * [values[n] for n in names]
+            return dict(zip(names, converted.tolist()))
+        return self.ui_factors(param_names) * values
+
+    def from_ui(self, values, param_names=None):
+        """Convert parameter values from UI units, inverse of :meth:`to_ui`."""
+        if isinstance(values, dict):
+            names = list(values)
+            converted = [values[n] for n in names] / self.ui_factors(names)
+            return dict(zip(names, converted.tolist()))
+        return values / self.ui_factors(param_names)
+
     def read_param(self, param, warn=True):
         """Read parameter. Return numeric value."""
-        param = param.lower()
-        if param in MEFI_PARAMS:
-            return self._lib.GetMEFIValue()[0][MEFI_PARAMS.index(param)]
+        return self._read_key(self._keys.key(param), warn)
+
+    def _read_key(self, key, warn=True):
+        index = _MEFI_INDEX.get(key)
+        if index is not None:
+            return self._call_writer('GetMEFIValue')[0][index]
         try:
-            return self._lib.GetFloatValue(param)
+            return self._float_cache.get(key)
         except RuntimeError as e:
             if warn:
-                logging.warning("{} for {!r}".format(e, param))
+                logging.warning("{} for {!r}".format(e, key))
 
     def write_param(self, param, value):
         """Update parameter into control system."""
-        param = param.lower()
-        if param in MEFI_PARAMS:
+        param = self._keys.key(param)
+        if param in _MEFI_INDEX:
             cur_value = self.read_param(param)
             if value != cur_value:
                 logging.warning(
@@ -203,17 +573,32 @@ class _HitACS(api.Backend):
                     .format(param, value, cur_value))
             return
         try:
-            self._lib.SetFloatValue(param, value)
+            self._call_writer('SetFloatValue', param, value)
+            if self._pool:
+                self._pending_writes.add(param)
         except RuntimeError as e:
             logging.error("{} for {!r} = {}".format(e, param, value))
+        finally:
+            self._float_cache.invalidate(param)
 
+    @traced()
     def get_beam(self):
-        units  = unit.units
         e_para = ENERGY_PARAM.get(self._model().seq_name, 'E_HEBT')
-        z_num  = self._lib.GetFloatValue('Z_POSTSTRIP')
-        mass   = self._lib.GetFloatValue('A_POSTSTRIP') * units.u
-        charge = self._lib.GetFloatValue('Q_POSTSTRIP') * units.e
-        e_kin  = (self._lib.GetFloatValue(e_para) or 1) * units.MeV / units.u
+        get    = self._float_cache.get
+        raw    = (get('z_poststrip'), get('a_poststrip'), get('q_poststrip'),
+                  get(self._keys.key(e_para)) or 1)
+        # The unit arithmetic is only redone when the raw values change:
+        cached = self._beam
+        if cached is None or cached[0] != raw:
+            cached = self._beam = (raw, self._compute_beam(*raw))
+        return dict(cached[1])
+
+    def _compute_beam(self, z_num, a_num, q_num, e_kin):
+        import madgui.util.unit as unit
+        units  = unit.units
+        mass   = a_num * units.u
+        charge = q_num * units.e
+        e_kin  = e_kin * units.MeV / units.u
         return {
             'particle': PERIODIC_TABLE[round(z_num)],
             'charge':   unit.from_ui('charge', charge),
@@ -221,16 +606,26 @@ class _HitACS(api.Backend):
             'energy':   unit.from_ui('energy', mass * (e_kin + 1*units.c**2)),
         }
 
+    def _load_offsets(self, settings):
+        """Load MWPC offsets from the runtime folder. If the `watch_offsets`
+        setting is nonzero, the offsets will be refreshed in place at this
+        interval (in seconds) while connected. Returns the offsets dict, which
+        is filled during the background initialization."""
+        self._offsets_path = settings.get('runtime_path', '.')
+        self._watch_offsets = settings.get('watch_offsets', 0)
+        return {}
+
     def get_MEFI(self):
-        mefi = self._lib.GetMEFIValue()[1]
+        mefi = self._call_writer('GetMEFIValue')[1]
         return mefi and tuple(mefi)
 
+    @traced()
     def vAcc_to_model(self):
         """User defined vAcc to model"""
-        vAcc = self.vAcc = self._lib.GetSelectedVAcc()
+        vAcc = self.vAcc = self._call_writer('GetSelectedVAcc')
         _isStdVacc = False
 
-        if vAcc in np.arange(16):
+        if vAcc in range(16):
             _isStdVacc = True
             logging.info('Loading model with vAcc {}'.format(vAcc))
             for bL in VACC_TABLE:
@@ -250,26 +645,25 @@ class HitACS(_HitACS):
 
     def __init__(self, session, settings):
         """Connect to online database."""
-        params = load_dvm_parameters()
-        offsets = find_offsets(settings.get('runtime_path', '.'))
+        offsets = self._load_offsets(settings)
         lib = session.user_ns.beamoptikdll = BeamOptikDLL(
             variant=settings.get('variant', 'HIT'))
-        super().__init__(lib, params, session.model, offsets, settings,
-                         session.control)
+        super().__init__(lib, load_dvm_parameters, session.model, offsets,
+                         settings, session.control)
 
 
 class TestACS(_HitACS):
 
     def __init__(self, session, settings):
-        params = load_dvm_parameters()
-        offsets = find_offsets(settings.get('runtime_path', '.'))
+        from .beamoptikstub import BeamOptikStub
+        offsets = self._load_offsets(settings)
         # Don't pass `session.model()` to the stub. It should use an
         # independent simulation, which is cloned upon connection in
         # `on_model_changed`:
         lib = session.user_ns.beamoptikdll = BeamOptikStub(
             None, offsets, settings)
-        super().__init__(lib, params, session.model, offsets,
-                         control=session.control)
+        super().__init__(lib, load_dvm_parameters, session.model, offsets,
+                         settings, session.control)
         self.menu = None
         self.window = None
         self.set_window(session.window())
@@ -277,11 +671,13 @@ class TestACS(_HitACS):
 
         self.str_file = settings.get('str_file')
         self.sd_file = settings.get('sd_file')
+        self.state_file = settings.get('state_file')
 
     def load_float_values(self, filename):
         from madgui.util.export import read_str_file
         self.str_file = filename = os.path.abspath(filename)
         self._lib.set_float_values(read_str_file(filename))
+        self._invalidate()
 
     def load_sd_values(self, filename):
         from madgui.util.yaml import load_file
@@ -299,6 +695,21 @@ class TestACS(_HitACS):
             for elem, values in data['monitor'].items()
             for param, value in values.items()
         })
+        self._invalidate()
+
+    def load_state(self, filename):
+        """Restore the stub state from a checkpoint file."""
+        self.state_file = filename = os.path.abspath(filename)
+        self._lib.load_state(filename)
+        self._invalidate()
+        if self.window is not None:
+            self.jitter.set(self._lib.jitter)
+            self.auto_sd.set(self._lib.auto_sd)
+
+    def save_state(self, filename):
+        """Save the stub state to a checkpoint file."""
+        self.state_file = filename = os.path.abspath(filename)
+        self._lib.save_state(filename)
 
     def set_window(self, window):
         self.window = window
@@ -316,7 +727,7 @@ class TestACS(_HitACS):
                  checked=self.jitter),
             Item('Add &magnet aberrations', None,
                  'Add small deltas to all magnet strengths',
-                 self._lib._aberrate_strengths),
+                 self._aberrate_strengths),
             Separator,
             Item('Autoset readouts from model', None,
                  'Autoset monitor readout values from model twiss table',
@@ -339,20 +750,29 @@ class TestACS(_HitACS):
     def export_settings(self):
         return {
             'jitter': self.jitter(),
-            'shot_interval': self._lib.sd_cache.timeout,
+            'shot_interval': self._lib.shot_interval,
+            'seed': self._lib.seed,
             'auto_sd': self.auto_sd(),
             'str_file': self.str_file and safe_relpath(self.str_file, None),
             'sd_file': self.str_file and safe_relpath(self.sd_file, None),
+            'state_file': self.state_file and safe_relpath(
+                self.state_file, None),
         }
 
+    def _aberrate_strengths(self):
+        self._lib._aberrate_strengths()
+        self._invalidate()
+
     def _toggle_jitter(self):
         self.jitter.set(not self.jitter())
         self._lib.jitter = self.jitter()
+        self._invalidate()
 
     def _toggle_auto_sd(self):
         self.auto_sd.set(not self.auto_sd())
         self._lib.auto_sd = self.auto_sd()
         self._lib.update_sd_values()
+        self._invalidate()
 
     def _open_sd_values(self):
         from madgui.widget.filedialog import getOpenFileName
@@ -391,17 +811,30 @@ class TestACS(_HitACS):
         if self.menu:
             self.menu.setEnabled(connected)
 
+    @traced()
     def on_model_changed(self, model):
         clone = model and model.load_file(model.filename, stdout=False)
+        if clone and self.state_file:
+            # The checkpoint has the parameters and SD values, so don't
+            # compute the initial optics only to overwrite them:
+            self._lib.set_model(clone, compute=False)
+            self.load_state(self.state_file)
+            return
         self._lib.set_model(clone)
+        self._invalidate()
         if clone:
             if self.str_file:
                 self.load_float_values(self.str_file)
             if self.sd_file:
                 self.load_sd_values(self.sd_file)
 
-    @SingleWindow.factory
+    @cachedproperty
     def _edit_model_initial_conditions(self):
+        # Same as `SingleWindow.factory`, but without importing Qt early:
+        from madgui.util.qt import SingleWindow
+        return SingleWindow(self._create_model_params_dialog)
+
+    def _create_model_params_dialog(self):
         from madgui.widget.params import model_params_dialog
         return model_params_dialog(
             self._lib.model, parent=self.window, folder=self.window.folder)
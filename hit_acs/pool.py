@@ -0,0 +1,268 @@
+"""
+Pool of BeamOptikDLL interface instances for concurrent readers.
+
+Every wrapper object (:class:`~hit_acs.beamoptikdll.BeamOptikDLL` or
+:class:`~hit_acs.beamoptikstub.StubClient`) owns exactly one interface
+instance, which must only be used by one thread at a time. The pool creates
+additional wrappers on demand and hands each of them out to one reading
+thread at a time, while all writes, ``ExecuteChanges`` and the vAcc/MEFI
+selection go through one designated writer instance, so that the pending
+changes stay in one place. Calls on the writer are serialized by
+:meth:`InterfacePool.write`, so they must not bypass it.
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+__all__ = [
+    'InterfacePool',
+]
+
+
+INVALID_IID = "Invalid Interface ID."
+_CREATE = object()      # handed to a waiter instead of an instance
+
+
+class _Member(object):
+
+    """A reader instance with its bookkeeping."""
+
+    def __init__(self, lib):
+        self.lib = lib
+        self.generation = None      # of the last vAcc sync
+        self.checked = 0.0          # time of the last health check
+
+
+class InterfacePool(object):
+
+    """
+    Manages the `writer` interface instance and up to `size` reader
+    instances, which are created by calling `factory` (e.g. the
+    ``new_client`` method of a wrapper) and connected on first use.
+
+    Readers are synchronized to the vAcc and MEFI combination of the writer
+    (both are selected per instance) when they are created and after
+    :meth:`invalidate` (e.g. after ``ExecuteChanges`` or ``SelectMEFI``).
+    They are
+    health checked with ``GetDVMStatus`` on checkout at most every
+    `check_interval` seconds. Instances that fail a check or report
+    ``"Invalid Interface ID."`` are re-created, and the failed call is
+    retried once.
+    """
+
+    def __init__(self, writer, factory, size=4, check_interval=10.0):
+        self.writer = writer
+        self.factory = factory
+        self.size = size
+        self.check_interval = check_interval
+        self._cond = threading.Condition(threading.Lock())
+        self._write_lock = threading.RLock()
+        self._idle = []
+        self._waiters = deque()     # first come, first served
+        self._count = 0
+        self._generation = 0
+        self._selection = (None, None, None)    # (generation, vacc, mefi)
+        self.stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'created': 0,
+            'recreated': 0,
+            'checks': 0,
+        }
+
+    # writer
+
+    def write(self, name, *args):
+        """Call the API method `name` on the writer instance. The instance is
+        re-created and the call retried if the instance ID is invalid."""
+        with self._write_lock:
+            try:
+                return getattr(self.writer, name)(*args)
+            except RuntimeError as e:
+                if str(e) != INVALID_IID:
+                    raise
+                logging.warning("Re-creating writer interface instance")
+                self.writer.reconnect()
+                self.invalidate()
+                self._count_stat('recreated')
+                return getattr(self.writer, name)(*args)
+
+    # readers
+
+    @contextmanager
+    def reader(self, timeout=None):
+        """Context manager that checks out a reader instance and returns it
+        to the pool afterwards."""
+        member = self._checkout(timeout)
+        try:
+            yield member.lib
+        finally:
+            self._checkin(member)
+
+    def call(self, name, *args):
+        """Call the API method `name` on a reader instance. The instance is
+        re-created and the call retried if the instance ID is invalid."""
+        member = self._checkout()
+        try:
+            try:
+                return getattr(member.lib, name)(*args)
+            except RuntimeError as e:
+                if str(e) != INVALID_IID:
+                    raise
+            try:
+                self._recreate(member)
+            except BaseException:
+                # Don't hand out an instance that may be half re-created:
+                self._discard(member)
+                member = None
+                raise
+            return getattr(member.lib, name)(*args)
+        finally:
+            if member is not None:
+                self._checkin(member)
+
+    def invalidate(self):
+        """Resynchronize the vAcc and MEFI combination of all readers at
+        their next checkout."""
+        with self._cond:
+            self._generation += 1
+
+    def check(self):
+        """Health check all idle readers now."""
+        with self._cond:
+            members, self._idle = self._idle, []
+        for member in members:
+            member.checked = 0.0
+            try:
+                self._prepare(member)
+            except RuntimeError as e:
+                logging.error("Dropping interface instance: {}".format(e))
+                self._discard(member)
+            else:
+                self._checkin(member)
+
+    def close(self):
+        """Free all reader instances. The writer is left alone."""
+        with self._cond:
+            members, self._idle = self._idle, []
+            self._count -= len(members)
+        for member in members:
+            try:
+                member.lib.FreeInterfaceInstance()
+            except RuntimeError as e:
+                logging.debug("FreeInterfaceInstance: {}".format(e))
+
+    def _checkout(self, timeout=None):
+        with self._cond:
+            self.stats['checkouts'] += 1
+            member = waiter = None
+            if self._idle and not self._waiters:
+                member = self._idle.pop()
+            elif self._count < self.size:
+                self._count += 1
+            else:
+                self.stats['waits'] += 1
+                waiter = [None]
+                self._waiters.append(waiter)
+                # Returned instances are handed to the waiters in order:
+                if not self._cond.wait_for(lambda: waiter[0], timeout):
+                    self._waiters.remove(waiter)
+                    raise RuntimeError("No interface instance available")
+                member = waiter[0]
+                if member is _CREATE:
+                    member = None
+                    self._count += 1
+        if member is None:
+            try:
+                member = _Member(self._connect(self.factory()))
+            except BaseException:
+                self._discard(None)
+                raise
+            self._count_stat('created')
+        try:
+            self._prepare(member)
+        except BaseException:
+            self._discard(member)
+            raise
+        return member
+
+    def _checkin(self, member):
+        with self._cond:
+            if self._waiters:
+                self._waiters.popleft()[0] = member
+                self._cond.notify_all()
+            else:
+                self._idle.append(member)
+
+    def _discard(self, member):
+        """Drop a broken instance, and let the next waiter create one."""
+        with self._cond:
+            self._count -= 1
+            if self._waiters:
+                self._waiters.popleft()[0] = _CREATE
+                self._cond.notify_all()
+
+    def _prepare(self, member):
+        """Health check and selection sync, re-creating the instance if
+        needed."""
+        now = time.time()
+        if now - member.checked >= self.check_interval:
+            self._count_stat('checks')
+            try:
+                member.lib.GetDVMStatus()
+            except RuntimeError as e:
+                logging.warning("Interface instance failed health check: {}"
+                                .format(e))
+                self._recreate(member)
+            member.checked = now
+        self._sync(member)
+
+    def _sync(self, member, force=False):
+        """Select the vAcc and MEFI combination of the writer."""
+        generation, vacc, mefi = self._writer_selection()
+        if member.generation == generation and not force:
+            return
+        lib = member.lib
+        if force or lib.GetSelectedVAcc() != vacc:
+            lib.SelectVAcc(vacc)
+        if mefi is not None and (force or lib.GetMEFIValue()[1] != mefi):
+            lib.SelectMEFI(vacc, *mefi)
+        member.generation = generation
+
+    def _writer_selection(self):
+        with self._cond:
+            generation = self._generation
+            if self._selection[0] == generation:
+                return self._selection
+        with self._write_lock:
+            vacc = self.write('GetSelectedVAcc')
+            channels = self.write('GetMEFIValue')[1]
+        # Channel numbers start at 1, zeros mean that nothing is selected:
+        mefi = (tuple(channels) if channels and min(channels[:3]) > 0
+                else None)
+        with self._cond:
+            self._selection = (generation, vacc, mefi)
+        return self._selection
+
+    def _recreate(self, member):
+        try:
+            member.lib.FreeInterfaceInstance()
+        except RuntimeError:
+            pass
+        member.lib = self._connect(self.factory())
+        member.generation = None
+        member.checked = time.time()
+        self._count_stat('recreated')
+        self._sync(member, force=True)
+
+    def _count_stat(self, name):
+        with self._cond:
+            self.stats[name] += 1
+
+    def _connect(self, lib):
+        lib.GetInterfaceInstance()
+        return lib
@@ -0,0 +1,132 @@
+"""
+Synthetic ramp data for :class:`~hit_acs.beamoptikstub.BeamOptikStub`.
+
+Emulates the ramp data API of the DVM (``StartRampDataGeneration``,
+``GetRampDataValue``) by generating time series for all magnet parameters
+of a vAcc. The whole ramp is precomputed when the generation is started,
+so that individual values can be looked up by indexing.
+"""
+
+import itertools
+from collections import OrderedDict
+
+import numpy as np
+
+from .beamoptikdll import BeamOptikDLL
+
+
+__all__ = [
+    'RampData',
+    'RampDataGenerator',
+]
+
+
+class RampData(object):
+
+    """
+    Precomputed ramp for one order number.
+
+    :ivar dict index: lowercase parameter name -> row in :attr:`values`
+    :ivar np.ndarray values: ``(devices, samples)`` array of values
+    :ivar np.ndarray event_offsets: sample index of each event
+    """
+
+    def __init__(self, order_num, efi, names, values, event_offsets,
+                 resolution):
+        self.order_num = order_num
+        self.efi = efi
+        self.index = {name.lower(): i for i, name in enumerate(names)}
+        self.values = values
+        self.event_offsets = event_offsets
+        self.resolution = resolution
+
+    def get(self, event_num, delay, name):
+        """
+        Get value of the parameter `name` at `delay` (ms) after the event
+        `event_num`. Raises ``RuntimeError`` with the same error messages as
+        the DLL.
+        """
+        if not 0 <= event_num < len(self.event_offsets):
+            BeamOptikDLL.check_return(8)    # Ramp event not supported.
+        row = self.index.get(name.lower())
+        if row is None:
+            BeamOptikDLL.check_return(9)    # Ramp data not available.
+        col = self.event_offsets[event_num] + int(delay // self.resolution)
+        if not 0 <= col < self.values.shape[1]:
+            BeamOptikDLL.check_return(10)   # Invalid offset for ramp function.
+        return float(self.values[row, col])
+
+
+class RampDataGenerator(object):
+
+    """
+    Generates magnet ramps for the synchrotron cycle. Configured by a dict
+    (e.g. the ``ramp`` entry in the stub settings) such as::
+
+        events: [0, 100, 600, 1600, 2100]   # event times (ms)
+        tail: 400               # time after the last event (ms)
+        resolution: 1           # sample spacing (ms)
+        injection_level: 0.1    # value at injection relative to setpoint
+        lag: 5                  # mean delay of the magnets (ms)
+        lag_spread: 2           # stddev of the delay between magnets (ms)
+        prefixes: [kl, ax, ay, dax, day]
+        max_orders: 8           # older orders are evicted
+        seed: 0
+
+    The events are: injection, start of acceleration, flat top reached,
+    start of deceleration, back at injection level. Each magnet follows
+    this profile scaled to its setpoint, delayed by its individual lag.
+    """
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.events = np.array(
+            config.get('events', [0, 100, 600, 1600, 2100]), dtype=float)
+        self.tail = float(config.get('tail', 400))
+        self.resolution = float(config.get('resolution', 1))
+        self.injection_level = float(config.get('injection_level', 0.1))
+        self.lag = float(config.get('lag', 5))
+        self.lag_spread = float(config.get('lag_spread', 2))
+        self.prefixes = set(config.get(
+            'prefixes', ['kl', 'ax', 'ay', 'dax', 'day']))
+        self.max_orders = config.get('max_orders', 8)
+        self.rng = np.random.default_rng(config.get('seed'))
+        self.orders = OrderedDict()
+        self._order_nums = itertools.count(1)
+
+    def profile(self, times):
+        """Evaluate the normalized ramp profile at the given times (ms)."""
+        level = self.injection_level
+        knots_y = [level, level, 1.0, 1.0, level]
+        n = min(len(knots_y), len(self.events))
+        return np.interp(times, self.events[:n], knots_y[:n])
+
+    def start(self, params, efi=None):
+        """
+        Precompute ramps for all magnet parameters in `params` (dict of
+        setpoints). Returns the new order number.
+        """
+        names = [name for name in params
+                 if name.lower().split('_')[0] in self.prefixes]
+        setpoints = np.array([float(params[name]) for name in names])
+        duration = self.events[-1] + self.tail
+        times = np.arange(0, duration, self.resolution)
+        lags = np.maximum(0, self.rng.normal(
+            self.lag, self.lag_spread, size=len(names)))
+        values = setpoints[:, None] * self.profile(
+            times[None, :] - lags[:, None])
+        event_offsets = (self.events // self.resolution).astype(int)
+        order_num = next(self._order_nums)
+        self.orders[order_num] = RampData(
+            order_num, efi, names, values.astype(np.float32),
+            event_offsets, self.resolution)
+        while len(self.orders) > self.max_orders:
+            self.orders.popitem(last=False)
+        return order_num
+
+    def get(self, order_num, event_num, delay, name):
+        """Get value from a previously started order."""
+        ramp = self.orders.get(order_num)
+        if ramp is None:
+            BeamOptikDLL.check_return(9)    # Ramp data not available.
+        return ramp.get(event_num, delay, name)
@@ -0,0 +1,232 @@
+"""
+Parameter scans (e.g. quadrupole or steerer scans) with setpoints ordered
+to minimize magnet travel.
+
+A :class:`ScanPlan` is created from a grid of setpoints with
+:func:`plan_grid`, or from arbitrary points with :func:`plan_points`, and
+executed with :func:`run_scan`, which streams the monitor readouts of each
+point as soon as they are available.
+"""
+
+import time
+from collections import namedtuple
+
+import numpy as np
+
+
+__all__ = [
+    'ScanPlan',
+    'ScanPoint',
+    'plan_grid',
+    'plan_points',
+    'run_scan',
+]
+
+
+ScanPoint = namedtuple('ScanPoint', ['index', 'values', 'shots', 'time'])
+ScanPoint.__doc__ = """
+Result for one point of a scan: `index` of the point in the input (flat
+index into the grid for :func:`plan_grid`), the parameter `values` (dict),
+the ``(shots, monitors, 4)`` readouts as returned by
+:meth:`~hit_acs.plugin._HitACS.read_shots`, and the `time` of the readout.
+"""
+
+
+class ScanPlan(object):
+
+    """
+    Setpoints of a scan in execution order.
+
+    :ivar list params: parameter names (P)
+    :ivar np.ndarray points: ``(N, P)`` setpoints in execution order
+    :ivar np.ndarray index: ``(N,)`` position of each point in the input
+    :ivar np.ndarray rates: ``(P,)`` ramp rates (units per second)
+    """
+
+    def __init__(self, params, points, index, rates):
+        self.params = list(params)
+        self.points = np.asarray(points, dtype=float)
+        self.index = np.asarray(index, dtype=int)
+        self.rates = np.asarray(rates, dtype=float)
+
+    def __len__(self):
+        return len(self.points)
+
+    def move_times(self, start=None):
+        """
+        Estimated ramp time (s) before each point, assuming that all magnets
+        ramp in parallel. The first entry is the time from `start` (array or
+        dict of current values), or 0 if not given.
+        """
+        points = self.points
+        steps = np.abs(np.diff(points, axis=0)) / self.rates
+        first = 0.0
+        if start is not None:
+            first = np.max(np.abs(
+                points[0] - _vector(start, self.params)) / self.rates)
+        return np.concatenate(([first], steps.max(axis=1)))
+
+    def travel_time(self, start=None):
+        """Estimated total ramp time (s) of the scan."""
+        return float(self.move_times(start).sum())
+
+
+def _vector(values, params):
+    if isinstance(values, dict):
+        return np.array([values[param] for param in params], dtype=float)
+    return np.asarray(values, dtype=float)
+
+
+def _rates(params, ramp_rates):
+    ramp_rates = ramp_rates or {}
+    return np.array([ramp_rates.get(param, 1.0) for param in params],
+                    dtype=float)
+
+
+def _serpentine(shape):
+    """Generate grid indices in reflected (boustrophedon) order, such that
+    each step changes one index by one."""
+    if not shape:
+        yield ()
+        return
+    inner = list(_serpentine(shape[1:]))
+    for i in range(shape[0]):
+        for rest in (inner if i % 2 == 0 else reversed(inner)):
+            yield (i,) + rest
+
+
+def _nearest(points, rates, start=None):
+    """Greedy nearest neighbour order, with the distance being the ramp
+    time of the slowest parameter."""
+    remaining = np.ones(len(points), dtype=bool)
+    order = []
+    current = points[0] if start is None else start
+    for _ in range(len(points)):
+        cost = np.max(np.abs(points - current) / rates, axis=1)
+        cost[~remaining] = np.inf
+        j = int(np.argmin(cost))
+        order.append(j)
+        remaining[j] = False
+        current = points[j]
+    return np.array(order, dtype=int)
+
+
+def plan_grid(axes, order='serpentine', ramp_rates=None, start=None):
+    """
+    Plan a scan over the full grid of setpoints.
+
+    :param axes: list of ``(param, values)`` or an ordered dict
+    :param str order: ``'serpentine'``, ``'nearest'`` or ``'given'``
+    :param dict ramp_rates: ramp rate per parameter (units per second,
+        default 1)
+    :param start: current parameter values (dict), where the scan starts
+    :returns: :class:`ScanPlan`
+
+    In ``serpentine`` order, the axes are nested such that the axis with
+    the longest ramp (range divided by ramp rate) changes least often, and
+    every other axis reverses its direction at the end of each pass.
+    ``given`` enumerates the grid in the order of `axes`, with the last
+    axis changing fastest. The index of the points refers to this order.
+    """
+    axes = list(axes.items()) if isinstance(axes, dict) else list(axes)
+    params = [param for param, values in axes]
+    values = [np.asarray(vals, dtype=float) for param, vals in axes]
+    shape = tuple(len(vals) for vals in values)
+    rates = _rates(params, ramp_rates)
+    grid = np.stack(np.meshgrid(*values, indexing='ij'), axis=-1)
+    points = grid.reshape(-1, len(params))
+    if order == 'serpentine':
+        spans = np.array([np.ptp(vals) if len(vals) else 0.0
+                          for vals in values])
+        nesting = np.argsort(-spans / rates, kind='stable')
+        nested = np.array(list(_serpentine(tuple(
+            shape[a] for a in nesting))), dtype=int).reshape(-1, len(shape))
+        index = np.ravel_multi_index(
+            nested[:, np.argsort(nesting)].T, shape).reshape(-1)
+        if start is not None:
+            # start at the end of the path that is closer:
+            cost = np.max(np.abs(points[index[[0, -1]]] -
+                                 _vector(start, params)) / rates, axis=1)
+            if cost[1] < cost[0]:
+                index = index[::-1]
+    elif order == 'nearest':
+        index = _nearest(
+            points, rates, None if start is None else _vector(start, params))
+    elif order == 'given':
+        index = np.arange(len(points))
+    else:
+        raise ValueError("Unknown scan order: {!r}".format(order))
+    return ScanPlan(params, points[index], index, rates)
+
+
+def plan_points(params, points, order='nearest', ramp_rates=None,
+                start=None):
+    """
+    Plan a scan over arbitrary setpoints, given as ``(N, P)`` array (or
+    list of dicts), in ``'nearest'`` neighbour or ``'given'`` order. See
+    :func:`plan_grid` for the other arguments.
+    """
+    params = list(params)
+    points = np.array([_vector(point, params) for point in points])
+    rates = _rates(params, ramp_rates)
+    if order == 'nearest':
+        index = _nearest(
+            points, rates, None if start is None else _vector(start, params))
+    elif order == 'given':
+        index = np.arange(len(points))
+    else:
+        raise ValueError("Unknown scan order: {!r}".format(order))
+    return ScanPlan(params, points[index], index, rates)
+
+
+def run_scan(backend, plan, monitors, shots=1, settle=None, timeout=None,
+             wait_ramp=True):
+    """
+    Execute a scan and generate a :class:`ScanPoint` for every point.
+
+    The next point is written and executed right after the readouts of the
+    current point are complete, and only then is the result yielded, so
+    that processing by the consumer overlaps with the ramping of the
+    magnets. Before reading, the remaining ramp time (estimated from the
+    ramp rates, if `wait_ramp`) is waited for, and then `settle` is called
+    (see :func:`~hit_acs.measure.measure_orbit_response`).
+
+    All parameters are restored when the scan is finished or the generator
+    is closed.
+
+    :param backend: connected :class:`~hit_acs.plugin._HitACS`
+    """
+    from .measure import _calibrate, _settle
+    params = plan.params
+    initial = backend.read_params(params)
+    missing = [param for param in params if param not in initial]
+    if missing:
+        raise RuntimeError("Cannot read parameters: {}".format(missing))
+    move_times = plan.move_times(initial) if wait_ramp else None
+    points = plan.points.tolist()
+
+    def apply(i):
+        for param, value in zip(params, points[i]):
+            backend.write_param(param, value)
+        backend.execute()
+        return time.time() + (move_times[i] if wait_ramp else 0.0)
+
+    _calibrate(backend, settle, monitors, timeout)
+    try:
+        ready = apply(0) if points else None
+        for i in range(len(points)):
+            delay = ready - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            _settle(backend, settle, monitors)
+            data = backend.read_shots(monitors, shots, timeout)
+            result = ScanPoint(int(plan.index[i]),
+                               dict(zip(params, points[i])),
+                               data, time.time())
+            if i + 1 < len(points):
+                ready = apply(i + 1)
+            yield result
+    finally:
+        for param in params:
+            backend.write_param(param, initial[param])
+        backend.execute()
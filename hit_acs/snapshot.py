@@ -0,0 +1,418 @@
+"""
+Publication of the latest parameter values and monitor readouts to other
+processes via a memory mapped file.
+
+One process (usually the one connected to the control system) writes
+snapshots with a :class:`SnapshotPublisher`, any number of local processes
+read them with a :class:`SnapshotReader` without talking to the DLL.
+
+The file starts with a fixed header::
+
+    magic       8 bytes
+    seq         uint64, odd while a snapshot is being written
+    generation  uint64, incremented whenever the layout is (re-)created
+    time        float64, time of the last snapshot (seconds since epoch)
+    epoch       int64, shot counter of the monitor readouts
+    size        uint64, length of the JSON names block
+
+followed by the JSON list of parameter and monitor names, and the float64
+arrays of the parameter values and the ``(monitors, 4)`` readouts (columns
+posx/posy/envx/envy, as for :meth:`~hit_acs.plugin._HitACS.read_shots`),
+each aligned to 64 bytes. Missing values are NaN.
+
+Readers use the sequence counter as a seqlock: a snapshot is consistent if
+the counter was even and unchanged before and after copying the data.
+
+A new publisher rewrites an existing file in place (marked as being written
+by the sequence counter) rather than replacing it, because a mapped file
+cannot be replaced on Windows, and readers of a replaced file would keep
+seeing the old one. The file only ever grows, so that the mappings of
+existing readers stay valid. Readers notice the new generation and remap
+the file before reading the next snapshot.
+"""
+
+import os
+import json
+import mmap
+import time
+import struct
+import threading
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+
+__all__ = [
+    'Snapshot',
+    'SnapshotPublisher',
+    'SnapshotReader',
+]
+
+
+MAGIC = b'HITSNAP\x02'
+ALIGN = 64
+HEADER = struct.Struct('<8sQQdqQ')
+MONITOR_COLUMNS = ('posx', 'posy', 'envx', 'envy')
+
+
+def _align(offset):
+    return -(-offset // ALIGN) * ALIGN
+
+
+def _layout(size, num_params, num_monitors):
+    """Return offsets of the parameter array, monitor array and the total
+    file size for a names block of `size` bytes."""
+    params_start = _align(HEADER.size + size)
+    monitors_start = _align(params_start + 8 * num_params)
+    end = _align(monitors_start + 8 * 4 * num_monitors)
+    return params_start, monitors_start, max(end, ALIGN)
+
+
+Snapshot = namedtuple('Snapshot', [
+    'seq', 'time', 'epoch', 'params', 'monitors'])
+Snapshot.__doc__ = """
+Consistent snapshot as returned by :meth:`SnapshotReader.read`: sequence
+number, time and shot epoch of the snapshot, ``(params,)`` values and
+``(monitors, 4)`` readouts.
+"""
+
+
+def _prepare_file(filename, blob, end):
+    """
+    Write the header and the names block `blob` of a new layout with total
+    size `end` into `filename`, in place if it is already a snapshot file.
+    Returns the (even) sequence number before; the file is left marked as
+    being written.
+    """
+    head = b''
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            head = f.read(HEADER.size)
+    if len(head) < HEADER.size or head[:len(MAGIC)] != MAGIC:
+        # Nobody can have mapped it yet, so readers never see a partially
+        # initialized file if it is written elsewhere and moved in place:
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, 1, 1, 0.0, -1, len(blob)))
+            f.write(blob)
+            f.truncate(end)
+        os.replace(tmp, filename)
+        return 0
+    _, seq, generation, _, _, _ = HEADER.unpack(head)
+    seq += seq % 2          # left odd by a crashed publisher
+    with open(filename, 'r+b') as f:
+        # Let readers wait before anything else is changed:
+        f.write(MAGIC + struct.pack('<Q', seq + 1))
+        f.flush()
+        f.write(HEADER.pack(MAGIC, seq + 1, generation + 1, 0.0, -1,
+                            len(blob))[16:])
+        f.write(blob)
+        if os.fstat(f.fileno()).st_size < end:
+            f.truncate(end)
+    return seq
+
+
+class _Region(object):
+
+    """
+    Memory mapped snapshot file with numpy views on its fields.
+
+    If the file is being (re-)created while it is mapped for reading,
+    :attr:`complete` is false and the views may be missing.
+    """
+
+    def __init__(self, filename, writable):
+        mode = 'r+b' if writable else 'rb'
+        access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        with open(filename, mode) as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=access)
+        buf = self._mmap
+        magic, seq, _, _, _, size = HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError("Not a snapshot file: {!r}".format(filename))
+        self.seq = np.frombuffer(buf, '<u8', 1, 8)
+        self.generation = np.frombuffer(buf, '<u8', 1, 16)
+        self.time = np.frombuffer(buf, '<f8', 1, 24)
+        self.epoch = np.frombuffer(buf, '<i8', 1, 32)
+        self.param_values = self.monitor_values = None
+        try:
+            self._map_values(buf, size)
+        except (ValueError, KeyError, TypeError):
+            # Torn read of the names or a mapping of the smaller old file,
+            # unless the publisher did not touch the file in between:
+            if writable or seq % 2 or int(self.seq[0]) == seq:
+                self.close()
+                raise
+        self.complete = seq % 2 == 0 and int(self.seq[0]) == seq and (
+            self.param_values is not None)
+
+    def _map_values(self, buf, size):
+        names = json.loads(bytes(buf[HEADER.size:HEADER.size+size])
+                           .decode('utf-8'))
+        params, monitors = names['params'], names['monitors']
+        params_start, monitors_start, end = _layout(
+            size, len(params), len(monitors))
+        if end > len(buf):
+            raise ValueError("Snapshot file is truncated")
+        self.params = params
+        self.monitors = monitors
+        self.param_values = np.frombuffer(
+            buf, '<f8', len(params), params_start)
+        self.monitor_values = np.frombuffer(
+            buf, '<f8', 4 * len(monitors), monitors_start
+        ).reshape((len(monitors), 4))
+
+    def close(self):
+        # The views must be released before the mmap can be closed:
+        self.seq = self.generation = self.time = self.epoch = None
+        self.param_values = self.monitor_values = None
+        self._mmap.close()
+
+
+class SnapshotPublisher(object):
+
+    """
+    Writes snapshots into the file `filename`, which is (re-)created in place
+    with a layout for the given parameter and monitor names.
+
+    Snapshots can be published explicitly with :meth:`publish`, or read from
+    a :class:`~hit_acs.plugin._HitACS` backend with :meth:`update`, or
+    periodically in a background thread with :meth:`start`.
+    """
+
+    def __init__(self, filename, params, monitors=(), backend=None):
+        self.filename = filename
+        self.params = list(params)
+        self.monitors = list(monitors)
+        self.backend = backend
+        self._param_index = {name: i for i, name in enumerate(self.params)}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        blob = json.dumps({
+            'params': self.params,
+            'monitors': self.monitors,
+        }).encode('utf-8')
+        _, _, end = _layout(len(blob), len(self.params), len(self.monitors))
+        seq = _prepare_file(filename, blob, end)
+        region = self._region = _Region(filename, writable=True)
+        region.param_values[:] = np.nan
+        region.monitor_values[:] = np.nan
+        region.seq[0] = seq + 2
+
+    def close(self):
+        """Stop publishing and unmap the file. The file is kept, so that
+        readers can continue to see the last snapshot."""
+        self.stop()
+        if self._region is not None:
+            self._region.close()
+            self._region = None
+
+    def publish(self, params=None, monitors=None, epoch=-1, timestamp=None):
+        """
+        Write a new snapshot. `params` is a dict (names as passed to the
+        constructor, missing names are set to NaN) or an array in the order
+        of :attr:`params`. `monitors` is a dict of readouts as returned by
+        ``read_monitors`` or a ``(monitors, 4)`` array. Fields passed as
+        ``None`` keep their previous value.
+        """
+        if params is not None and isinstance(params, dict):
+            values = np.full(len(self.params), np.nan)
+            for name, value in params.items():
+                index = self._param_index.get(name)
+                if index is not None:
+                    values[index] = value
+            params = values
+        if monitors is not None and isinstance(monitors, dict):
+            readouts = np.full((len(self.monitors), 4), np.nan)
+            for i, name in enumerate(self.monitors):
+                readout = monitors.get(name)
+                if readout:
+                    readouts[i] = [readout[col] for col in MONITOR_COLUMNS]
+            monitors = readouts
+        region = self._region
+        with self._lock:
+            seq = int(region.seq[0])
+            region.seq[0] = seq + 1
+            if params is not None:
+                region.param_values[:] = params
+            if monitors is not None:
+                region.monitor_values[:] = monitors
+            region.epoch[0] = epoch
+            region.time[0] = time.time() if timestamp is None else timestamp
+            region.seq[0] = seq + 2
+        return seq + 2
+
+    def update(self):
+        """Read all parameters and monitors from the backend in one batch
+        each and publish them. Returns the new sequence number."""
+        backend = self.backend
+        params = backend.read_params(self.params, warn=False)
+        epoch, monitors = -1, None
+        if self.monitors:
+            epoch, monitors = backend.read_monitors(self.monitors)
+        return self.publish(params, monitors, epoch)
+
+    @property
+    def running(self):
+        """Whether the background thread is running."""
+        return self._thread is not None
+
+    def start(self, interval=1.0):
+        """Call :meth:`update` every `interval` seconds in a background
+        thread."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(interval,), name='SnapshotPublisher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread (if running)."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.is_set():
+            started = time.time()
+            try:
+                self.update()
+            except Exception:
+                logging.exception("Error while publishing snapshot")
+            self._stop.wait(max(0.0, interval - (time.time() - started)))
+
+
+class SnapshotReader(object):
+
+    """
+    Reads snapshots written by a :class:`SnapshotPublisher` from the file
+    `filename`.
+
+    :ivar list params: parameter names
+    :ivar list monitors: monitor names
+    """
+
+    def __init__(self, filename, timeout=1.0):
+        self.filename = filename
+        self._region = None
+        self._remap(timeout)
+
+    def _remap(self, timeout=1.0):
+        """(Re-)map the file, waiting while the publisher (re-)creates it."""
+        deadline = time.time() + timeout
+        while True:
+            region = _Region(self.filename, writable=False)
+            if region.complete:
+                break
+            region.close()
+            if time.time() > deadline:
+                raise RuntimeError("Snapshot file is being created for too "
+                                   "long: {!r}".format(self.filename))
+            time.sleep(0.001)
+        if self._region is not None:
+            self._region.close()
+        self._region = region
+        self._generation = int(region.generation[0])
+        self.params = region.params
+        self.monitors = region.monitors
+        # Names are matched case-insensitively, as by the backend:
+        self._param_index = {
+            name.lower(): i for i, name in enumerate(self.params)}
+        self._monitor_index = {
+            name.lower(): i for i, name in enumerate(self.monitors)}
+
+    def close(self):
+        """Unmap the file."""
+        if self._region is not None:
+            self._region.close()
+            self._region = None
+
+    @property
+    def seq(self):
+        """Sequence number of the latest snapshot (0 if none was written
+        yet)."""
+        return int(self._region.seq[0]) & ~1
+
+    def read(self, out=None, timeout=1.0):
+        """
+        Return a consistent :class:`Snapshot`. The arrays are copied into
+        `out` (a :class:`Snapshot` returned by a previous call) if given, so
+        that polling does not allocate. Retries while the publisher is
+        writing, and raises ``RuntimeError`` after `timeout` seconds. If the
+        file was re-created, it is remapped first (and `out` is only used
+        if the sizes still match).
+        """
+        region = self._region
+        params, monitors = self._buffers(out)
+        deadline = None
+        while True:
+            seq = int(region.seq[0])
+            if seq % 2 == 0 and int(region.generation[0]) != self._generation:
+                self._remap(timeout)
+                region = self._region
+                params, monitors = self._buffers(out)
+                continue
+            if seq % 2 == 0:
+                params[:] = region.param_values
+                monitors[:] = region.monitor_values
+                stamp = float(region.time[0])
+                epoch = int(region.epoch[0])
+                if int(region.seq[0]) == seq:
+                    return Snapshot(seq, stamp, epoch, params, monitors)
+            if deadline is None:
+                deadline = time.time() + timeout
+            elif time.time() > deadline:
+                raise RuntimeError("Snapshot is being written for too long")
+            time.sleep(0)
+
+    def _buffers(self, out):
+        shape = (len(self.params),), (len(self.monitors), 4)
+        if out is None or (out.params.shape, out.monitors.shape) != shape:
+            return np.empty(shape[0]), np.empty(shape[1])
+        return out.params, out.monitors
+
+    def wait(self, seq, timeout=None, poll=0.01, out=None):
+        """Wait for a snapshot newer than `seq` and return it. Raises
+        ``RuntimeError`` if there is none after `timeout` seconds."""
+        deadline = None if timeout is None else time.time() + timeout
+        while self.seq <= seq:
+            if deadline is not None and time.time() > deadline:
+                raise RuntimeError("No new snapshot")
+            time.sleep(poll)
+        return self.read(out)
+
+    def read_params(self, names=None):
+        """Return the latest parameter values as dict, omitting NaN."""
+        snapshot = self.read()
+        names = self.params if names is None else names
+        index = self._param_index
+        return {
+            name: value
+            for name in names
+            if name.lower() in index
+            for value in [float(snapshot.params[index[name.lower()]])]
+            if not np.isnan(value)
+        }
+
+    def read_monitors(self, names=None):
+        """Return ``(epoch, {name: values})`` as for ``read_monitors`` of the
+        backend, with empty dicts for missing readouts."""
+        snapshot = self.read()
+        names = self.monitors if names is None else names
+        index = self._monitor_index
+        result = {}
+        for name in names:
+            i = index.get(name.lower())
+            row = None if i is None else snapshot.monitors[i]
+            result[name] = (
+                {} if row is None or np.isnan(row).any() else
+                dict(zip(MONITOR_COLUMNS, row.tolist())))
+        return snapshot.epoch, result
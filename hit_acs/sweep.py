@@ -0,0 +1,166 @@
+"""
+Sweeps over MEFI channel combinations, e.g. to characterize the machine
+across energies.
+"""
+
+import os
+import time
+import logging
+import itertools
+
+import numpy as np
+
+from .checkpoint import write_checkpoint, read_checkpoint
+
+
+__all__ = [
+    'MEFISweep',
+    'run_mefi_sweep',
+]
+
+
+PENDING, DONE, FAILED = 0, 1, -1
+
+
+class MEFISweep(object):
+
+    """
+    Result of :func:`run_mefi_sweep`, with one entry per combination of the
+    `energy`, `focus` and `intensity` channels (E, F, I).
+
+    :ivar int vacc: virtual accelerator
+    :ivar list params: parameter names (P)
+    :ivar np.ndarray efi: ``(E, F, I, 4)`` physical EFI values as returned by
+        ``SelectMEFI`` (energy, focus, intensity, gantry angle)
+    :ivar np.ndarray values: ``(E, F, I, P)`` parameter values
+    :ivar np.ndarray status: ``(E, F, I)`` with 1 for done, -1 for failed
+        and 0 for pending combinations
+    :ivar dict stats: number of combinations done/failed in this run, time
+    """
+
+    def __init__(self, vacc, energy, focus, intensity, gantry_angle, params):
+        self.vacc = vacc
+        self.energy = list(energy)
+        self.focus = list(focus)
+        self.intensity = list(intensity)
+        self.gantry_angle = gantry_angle
+        self.params = list(params)
+        shape = (len(self.energy), len(self.focus), len(self.intensity))
+        self.efi = np.full(shape + (4,), np.nan)
+        self.values = np.full(shape + (len(self.params),), np.nan)
+        self.status = np.zeros(shape, dtype=np.int8)
+        self.stats = {}
+
+    @property
+    def shape(self):
+        return self.status.shape
+
+    def _header(self):
+        return {
+            'type': 'mefi_sweep',
+            'vacc': self.vacc,
+            'energy': self.energy,
+            'focus': self.focus,
+            'intensity': self.intensity,
+            'gantry_angle': self.gantry_angle,
+            'params': self.params,
+        }
+
+    def save(self, filename):
+        """Write a checkpoint file (atomically)."""
+        tmp = filename + '.tmp'
+        write_checkpoint(tmp, self._header(), {
+            'efi': self.efi.ravel(),
+            'values': self.values.ravel(),
+            'status': self.status.ravel(),
+        })
+        os.replace(tmp, filename)
+
+    def restore(self, filename):
+        """Load the results of a checkpoint written by :meth:`save` for the
+        same sweep. Raises ``ValueError`` if it is for a different sweep."""
+        header, arrays = read_checkpoint(filename)
+        if header != self._header():
+            raise ValueError(
+                "Checkpoint {!r} is for a different sweep".format(filename))
+        self.efi[...] = arrays['efi'].reshape(self.efi.shape)
+        self.values[...] = arrays['values'].reshape(self.values.shape)
+        self.status[...] = arrays['status'].reshape(self.shape)
+
+
+def run_mefi_sweep(backend, vacc, energy, focus, intensity=(1,),
+                   params=None, gantry_angle=0, checkpoint=None,
+                   checkpoint_interval=10.0):
+    """
+    Select every combination of the given `energy`, `focus` and `intensity`
+    channels of `vacc`, and record the physical EFI values and the values
+    of `params` (default all parameters of the parameter table).
+
+    Combinations for which ``SelectMEFI`` fails are marked as failed and
+    not retried. If `checkpoint` is a file name, the results are saved there
+    every `checkpoint_interval` seconds and when the sweep ends (also by an
+    exception or ``KeyboardInterrupt``), and a sweep started with an
+    existing checkpoint continues where it stopped. The previously selected
+    vAcc and MEFI combination are restored afterwards.
+
+    :param backend: connected :class:`~hit_acs.plugin._HitACS`
+    :returns: :class:`MEFISweep`
+    """
+    if params is None:
+        params = [name for name, key in backend._param_keys]
+    sweep = MEFISweep(vacc, energy, focus, intensity, gantry_angle, params)
+    if checkpoint and os.path.exists(checkpoint):
+        sweep.restore(checkpoint)
+    call = backend._call_writer
+    old_vacc = call('GetSelectedVAcc')
+    old_mefi = call('GetMEFIValue')[1]
+    started = saved = time.time()
+    done = failed = 0
+    try:
+        call('SelectVAcc', vacc)
+        shape = sweep.shape
+        for index in itertools.product(*map(range, shape)):
+            if sweep.status[index] != PENDING:
+                continue
+            e, f, i = (sweep.energy[index[0]], sweep.focus[index[1]],
+                       sweep.intensity[index[2]])
+            try:
+                efi = call('SelectMEFI', vacc, e, f, i, gantry_angle)
+            except RuntimeError as exc:
+                logging.warning("SelectMEFI({}, {}, {}, {}) failed: {}"
+                                .format(vacc, e, f, i, exc))
+                sweep.status[index] = FAILED
+                failed += 1
+                continue
+            finally:
+                backend._invalidate()
+            sweep.efi[index] = efi
+            sweep.values[index] = backend.read_param_vector(params)
+            sweep.status[index] = DONE
+            done += 1
+            if checkpoint and time.time() - saved >= checkpoint_interval:
+                sweep.save(checkpoint)
+                saved = time.time()
+    finally:
+        if checkpoint:
+            sweep.save(checkpoint)
+        _restore_mefi(backend, old_vacc, old_mefi)
+        sweep.stats = {
+            'done': done,
+            'failed': failed,
+            'time': time.time() - started,
+        }
+    return sweep
+
+
+def _restore_mefi(backend, vacc, mefi):
+    call = backend._call_writer
+    try:
+        call('SelectVAcc', vacc)
+        if mefi and min(mefi[:3]) > 0:
+            call('SelectMEFI', vacc, *mefi)
+    except RuntimeError as exc:
+        logging.error("Cannot restore vAcc {} MEFI {}: {}".format(
+            vacc, mefi, exc))
+    finally:
+        backend._invalidate()
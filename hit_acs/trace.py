@@ -0,0 +1,181 @@
+"""
+Opt-in tracing of backend operations and DLL calls.
+
+Spans are recorded as complete events into a bounded in-memory buffer, and
+can be exported as Chrome trace-event JSON, which can be opened in
+``chrome://tracing`` or https://ui.perfetto.dev. Spans nest by time within
+each thread, so the viewer shows e.g. the ``GetFloatValue`` calls below the
+``read_params`` that caused them.
+
+Tracing is disabled by default, in which case :func:`span` and
+:func:`traced` cost only a flag check::
+
+    from hit_acs import trace
+    trace.enable()
+    ...
+    trace.export('session.json')
+"""
+
+import os
+import json
+import time
+import threading
+import functools
+from collections import deque
+
+
+__all__ = [
+    'Tracer',
+    'enable',
+    'disable',
+    'export',
+    'span',
+    'traced',
+]
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+
+    __slots__ = ('tracer', 'name', 'cat', 'args', 'start')
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = self.tracer.clock()
+        return self
+
+    def __exit__(self, *exc):
+        tracer = self.tracer
+        tracer.events.append((
+            self.name, self.cat, self.start, tracer.clock() - self.start,
+            threading.current_thread().ident, self.args))
+        return False
+
+
+class Tracer(object):
+
+    """
+    Collects spans in a ring buffer of at most `max_events` events (the
+    oldest are dropped). Times are taken from `clock`, by default
+    ``time.perf_counter`` (or ``time.time`` where it is not available).
+    """
+
+    def __init__(self, max_events=1000000, clock=None):
+        if clock is None:
+            clock = getattr(time, 'perf_counter', time.time)
+        self.enabled = False
+        self.clock = clock
+        self.origin = clock()
+        self.events = deque(maxlen=max_events)
+
+    def enable(self, max_events=None):
+        """Start recording."""
+        if max_events is not None and max_events != self.events.maxlen:
+            self.events = deque(self.events, maxlen=max_events)
+        self.enabled = True
+
+    def disable(self):
+        """Stop recording. Recorded events are kept."""
+        self.enabled = False
+
+    def clear(self):
+        """Drop all recorded events."""
+        self.events.clear()
+
+    def span(self, name, cat='hit_acs', **args):
+        """Context manager that records a span if enabled."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, cat, args or None)
+
+    def trace_events(self):
+        """Return the recorded spans as list of trace-event dicts."""
+        pid = os.getpid()
+        origin = self.origin
+        result = []
+        for name, cat, start, duration, tid, args in list(self.events):
+            event = {
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': (start - origin) * 1e6,
+                'dur': duration * 1e6,
+                'pid': pid,
+                'tid': tid,
+            }
+            if args:
+                event['args'] = {k: _jsonable(v) for k, v in args.items()}
+            result.append(event)
+        return result
+
+    def export(self, filename):
+        """Write the recorded spans as Chrome trace-event JSON file."""
+        with open(filename, 'w') as f:
+            json.dump({
+                'traceEvents': self.trace_events(),
+                'displayTimeUnit': 'ms',
+            }, f)
+
+
+def _jsonable(value):
+    if isinstance(value, (int, float, str, bool, type(None))):
+        return value
+    return repr(value)
+
+
+#: The tracer used by the hit_acs modules.
+TRACER = Tracer()
+
+
+def enable(max_events=None):
+    """Start recording spans with the global tracer."""
+    TRACER.enable(max_events)
+
+
+def disable():
+    """Stop recording spans with the global tracer."""
+    TRACER.disable()
+
+
+def export(filename):
+    """Export the spans of the global tracer, see :meth:`Tracer.export`."""
+    TRACER.export(filename)
+
+
+def span(name, cat='hit_acs', **args):
+    """Context manager that records a span with the global tracer."""
+    if not TRACER.enabled:
+        return _NULL_SPAN
+    return _Span(TRACER, name, cat, args or None)
+
+
+def traced(name=None, cat='hit_acs'):
+    """Decorator that records a span for every call of the function, named
+    after the function's qualified name by default."""
+    def decorate(func):
+        label = name or getattr(func, '__qualname__', func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return func(*args, **kwargs)
+            with _Span(TRACER, label, cat, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -5,10 +5,16 @@ Utilities for unicode IO.
 import csv
 import sys
 import time
+import threading
+from collections import OrderedDict
 
 
 __all__ = [
     'csv_unicode_reader',
+    'TimeoutCache',
+    'ShotPrefetcher',
+    'Deferred',
+    'KeyRegistry',
 ]
 
 
@@ -25,31 +31,463 @@ else:
         return csv.reader(lines, **kwargs)
 
 
+class _Pending(object):
+
+    """A value that is currently being computed by another thread."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.stale = False      # invalidated while being computed
+
+
 class TimeoutCache(object):
 
     """
-    Cache that cycles every ``timeout`` seconds.
+    Thread-safe read-through cache with per-entry expiry and LRU eviction.
 
-    The invalidation interval is global, not per-entry.
+    Entries expire ``timeout`` seconds after they were computed (the
+    timeout can be overridden per entry). If ``maxsize`` is given, the least
+    recently used entries are evicted to keep the cache bounded. Concurrent
+    misses for the same key are computed only once, the other threads wait
+    for the result (single-flight). Exceptions are propagated and never
+    cached. A value whose entry is invalidated or set while it is being
+    computed is returned to the waiting callers, but not stored.
 
     ``timeout=0`` means no caching,
     ``timeout=-1`` means infinite caching.
     """
 
-    def __init__(self, get, timeout=1.0):
+    def __init__(self, get, timeout=1.0, maxsize=None, clock=time.time):
         self._get = get
-        self._beg = time.time()
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pending = {}
         self.timeout = timeout
-        self.values = {}
+        self.maxsize = maxsize
+        self.values = OrderedDict()     # name -> (expires, value)
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0          # misses served by another thread's compute
+        self.evictions = 0
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __contains__(self, name):
+        with self._lock:
+            return self._lookup(name, self._clock()) is not None
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, name, timeout=None):
+        """Get cached value or compute it using the getter function."""
+        if timeout is None:
+            timeout = self.timeout
+        if timeout == 0:
+            with self._lock:
+                self.misses += 1
+            return self._get(name)
+        with self._lock:
+            entry = self._lookup(name, self._clock())
+            if entry is not None:
+                self.hits += 1
+                return entry[1]
+            pending = self._pending.get(name)
+            owner = pending is None
+            if owner:
+                pending = self._pending[name] = _Pending()
+                self.misses += 1
+            else:
+                self.waits += 1
+        if not owner:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+        try:
+            pending.value = value = self._get(name)
+        except BaseException as e:
+            pending.error = e
+            with self._lock:
+                del self._pending[name]
+            pending.event.set()
+            raise
+        with self._lock:
+            if not pending.stale:
+                self._store(name, value, timeout)
+            del self._pending[name]
+        pending.event.set()
+        return value
+
+    def set(self, name, value, timeout=None):
+        """Store a value, e.g. after writing it to the underlying source."""
+        with self._lock:
+            self._mark_stale(name)
+            self._store(name, value, self.timeout if timeout is None else
+                        timeout)
+
+    def invalidate(self, name=None):
+        """Remove one entry, or all entries if `name` is ``None``."""
+        with self._lock:
+            self._mark_stale(name)
+            if name is None:
+                self.values.clear()
+            else:
+                self.values.pop(name, None)
+
+    clear = invalidate
+
+    def stats(self):
+        """Return dict with hit/miss/wait/eviction counters and current
+        size."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'evictions': self.evictions,
+                'size': len(self.values),
+            }
+
+    def _mark_stale(self, name=None):
+        """Prevent storing results of computations that are in progress."""
+        if name is None:
+            for pending in self._pending.values():
+                pending.stale = True
+        else:
+            pending = self._pending.get(name)
+            if pending is not None:
+                pending.stale = True
+
+    def _lookup(self, name, now):
+        entry = self.values.get(name)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] <= now:
+            del self.values[name]
+            return None
+        # mark as most recently used:
+        self.values[name] = self.values.pop(name)
+        return entry
+
+    def _store(self, name, value, timeout):
+        if timeout == 0:
+            return
+        expires = None if timeout < 0 else self._clock() + timeout
+        self.values.pop(name, None)
+        self.values[name] = (expires, value)
+        maxsize = self.maxsize
+        if maxsize is not None:
+            while len(self.values) > maxsize:
+                self.values.popitem(last=False)
+                self.evictions += 1
+
+
+class ShotPrefetcher(object):
+
+    """
+    Serves reads from a snapshot that is refreshed once per accelerator shot.
+
+    Time is divided into epochs of ``shot_interval`` seconds, aligned to the
+    shot clock by ``phase`` (the time of any shot). The first read in a new
+    epoch fetches all registered names in one batch, every other read
+    during the same epoch is served from that snapshot. Unknown names are
+    registered on first access. Each snapshot is tagged with an increasing
+    :attr:`epoch` counter so that consumers can distinguish fresh data from
+    repeated data. After :meth:`invalidate`, values are fetched again, but
+    the epoch only advances with the next shot; :attr:`changed_epoch` is the
+    last epoch that was taken before the latest invalidation.
+
+    Names that were not read during the last ``expire`` snapshots are
+    dropped from the batch (``None`` keeps them forever).
+
+    ``RuntimeError`` raised by the getter (as by the DLL wrapper) is stored
+    and re-raised on access, as if the getter had been called directly.
+    """
+
+    def __init__(self, get, shot_interval=1.0, phase=0.0, clock=time.time,
+                 expire=10):
+        self._get = get
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._names = OrderedDict()     # name -> epoch of the last read
+        self._values = {}
+        self._errors = {}
+        self._shot = None
+        self._changed_shot = None
+        self._refetch = False
+        self._thread = None
+        self._stop = None
+        self.shot_interval = shot_interval
+        self.phase = phase
+        self.expire = expire
+        self.epoch = 0
+        self.changed_epoch = 0
+        self.fetches = 0
+        self.reads = 0
+
+    @property
+    def names(self):
+        """List of registered names."""
+        return list(self._names)
+
+    def register(self, names):
+        """Add names to be fetched with every snapshot."""
+        with self._lock:
+            for name in names:
+                self._names[name] = self.epoch
+
+    def unregister(self, names):
+        """Stop fetching the given names."""
+        with self._lock:
+            for name in names:
+                self._names.pop(name, None)
+                self._values.pop(name, None)
+                self._errors.pop(name, None)
+
+    def shot(self, now=None):
+        """Number of the shot at time `now` (since `phase`)."""
+        if now is None:
+            now = self._clock()
+        if self.shot_interval <= 0:
+            return now
+        return int((now - self.phase) // self.shot_interval)
+
+    def next_shot_in(self, now=None):
+        """Seconds until the next shot (0 if every read is a new shot)."""
+        if self.shot_interval <= 0:
+            return 0.0
+        if now is None:
+            now = self._clock()
+        return self.shot_interval - (
+            (now - self.phase) % self.shot_interval)
+
+    def invalidate(self):
+        """Fetch the values again on the next read (e.g. after changes).
+        The current shot still counts as taken before the change."""
+        with self._lock:
+            self._values.clear()
+            self._errors.clear()
+            self._refetch = True
+            shot = self.shot()
+            if shot == self._shot:
+                self.changed_epoch = self.epoch
+            else:
+                self._changed_shot = shot
+
+    def get(self, name):
+        """Return ``(epoch, value)`` for `name` from the current snapshot."""
+        with self._lock:
+            self._update()
+            self._ensure(name)
+            error = self._errors.get(name)
+            if error is not None:
+                raise error
+            return self.epoch, self._values[name]
+
+    def read(self, names):
+        """
+        Return ``(epoch, {name: value})`` for multiple names from the same
+        snapshot. Names for which the getter failed are omitted.
+        """
+        with self._lock:
+            self._update()
+            for name in names:
+                self._ensure(name)
+            values = self._values
+            return self.epoch, {
+                name: values[name] for name in names if name in values}
 
     def __getitem__(self, name):
-        now = time.time()
-        beg = self._beg
-        timeout = self.timeout
-        values = self.values
-        if now - beg > timeout > 0:
-            self._beg = now - (now - beg) % timeout
-            values.clear()
-        if name not in values or timeout == 0:
-            values[name] = self._get(name)
-        return values[name]
+        return self.get(name)[1]
+
+    def snapshot(self):
+        """Return ``(epoch, values)`` for all registered names."""
+        with self._lock:
+            self._update()
+            return self.epoch, dict(self._values)
+
+    def stats(self):
+        """Return number of snapshots, underlying fetches, and reads."""
+        with self._lock:
+            return {
+                'epoch': self.epoch,
+                'fetches': self.fetches,
+                'reads': self.reads,
+                'names': len(self._names),
+            }
+
+    def start(self):
+        """
+        Start a background thread that fetches each snapshot right at the
+        epoch boundary, so that reads never have to wait for the getter.
+        """
+        if self._thread is not None or self.shot_interval <= 0:
+            return
+        stop = self._stop = threading.Event()
+
+        def run():
+            while True:
+                if stop.wait(self.next_shot_in()):
+                    break
+                with self._lock:
+                    self._update()
+
+        self._thread = threading.Thread(target=run, name='ShotPrefetcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread (if running)."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self._stop = None
+
+    def _update(self):
+        shot = self.shot()
+        new = shot != self._shot
+        if not new and not self._refetch:
+            return
+        self._values.clear()
+        self._errors.clear()
+        if new and self.expire is not None:
+            oldest = self.epoch - self.expire
+            for name in [n for n, e in self._names.items() if e < oldest]:
+                del self._names[name]
+        for name in self._names:
+            self._fetch(name)
+        self._refetch = False
+        if new:
+            self._shot = shot
+            self.epoch += 1
+            if shot == self._changed_shot:
+                self.changed_epoch = self.epoch
+
+    def _ensure(self, name):
+        self.reads += 1
+        self._names[name] = self.epoch
+        if name not in self._values and name not in self._errors:
+            self._fetch(name)
+
+    def _fetch(self, name):
+        self.fetches += 1
+        try:
+            self._values[name] = self._get(name)
+        except RuntimeError as e:
+            self._errors[name] = e
+
+
+class Deferred(object):
+
+    """
+    Computes ``func()`` in a background thread, started immediately. The
+    result is retrieved with :meth:`result`, which waits only if the
+    computation is not yet finished. With ``background=False``, ``func`` is
+    called synchronously instead.
+    """
+
+    def __init__(self, func, background=True):
+        self._func = func
+        self._pending = _Pending()
+        if background:
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+        else:
+            self._run()
+
+    def _run(self):
+        pending = self._pending
+        try:
+            pending.value = self._func()
+        except Exception as e:
+            pending.error = e
+        finally:
+            pending.event.set()
+
+    def ready(self):
+        """Check whether the computation has finished."""
+        return self._pending.event.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the computation to finish and return its value. Raises
+        the exception of ``func``, or ``RuntimeError`` on timeout."""
+        pending = self._pending
+        if not pending.event.wait(timeout):
+            raise RuntimeError("Deferred initialization timed out.")
+        if pending.error is not None:
+            raise pending.error
+        return pending.value
+
+
+class KeyRegistry(object):
+
+    """
+    Case-insensitive name registry. Every name is normalized only once: the
+    registry remembers each spelling it has seen and maps it to a canonical
+    key (lowercase string) and an integer id. Hot paths can then use plain
+    dicts keyed by canonical keys, or arrays indexed by id, instead of
+    case-insensitive dicts that lowercase on every access.
+
+    :ivar list names: canonical key for each id
+    """
+
+    def __init__(self, names=()):
+        self.names = []
+        self._ids = {}          # canonical key -> id
+        self._keys = {}         # any spelling -> canonical key
+        self._lock = threading.Lock()
+        for name in names:
+            self.id(name)
+
+    def key(self, name):
+        """Get the canonical key for `name`."""
+        try:
+            return self._keys[name]
+        except KeyError:
+            return self.names[self._register(name)]
+
+    def id(self, name):
+        """Get the integer id for `name`, registering it if necessary."""
+        try:
+            return self._ids[self._keys[name]]
+        except KeyError:
+            return self._register(name)
+
+    def get(self, name, default=None):
+        """Get the id for `name` without registering it."""
+        key = self._keys.get(name)
+        if key is None:
+            key = name.lower()
+        return self._ids.get(key, default)
+
+    def keys(self, names):
+        """Get the canonical keys for multiple names."""
+        key = self.key
+        return [key(name) for name in names]
+
+    def ids(self, names):
+        """Get the integer ids for multiple names."""
+        get_id = self.id
+        return [get_id(name) for name in names]
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __len__(self):
+        return len(self.names)
+
+    def _register(self, name):
+        key = name.lower()
+        with self._lock:
+            i = self._ids.get(key)
+            if i is None:
+                i = self._ids[key] = len(self.names)
+                self.names.append(key)
+            self._keys[name] = self._keys[key] = key
+        return i
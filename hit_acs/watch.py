@@ -0,0 +1,197 @@
+"""
+Change notifications for parameters and monitors with adaptive polling.
+
+All registered watches are served by one :class:`WatchService` per backend,
+which reads the union of the watched names in one batch per tick. The
+polling interval shrinks to ``min_interval`` while values change, and backs
+off up to ``max_interval`` while everything is static.
+"""
+
+import logging
+import threading
+
+
+__all__ = [
+    'Watch',
+    'WatchService',
+]
+
+
+MONITOR_COLUMNS = ('posx', 'posy', 'envx', 'envy')
+
+
+class Watch(object):
+
+    """
+    A set of watched parameters and monitors with a callback. Returned by
+    :meth:`WatchService.add`.
+
+    ``callback(params, monitors)`` is called with the dicts of changed
+    parameter values and monitor readouts (as returned by ``read_monitor``)
+    whenever any value differs from the last reported value by more than
+    the tolerance. The first call reports all values.
+
+    :ivar tolerance: absolute tolerance, either a number or a dict mapping
+        parameter/monitor names to numbers (default 0 for missing names)
+    """
+
+    def __init__(self, service, callback, params=(), monitors=(),
+                 tolerance=0.0):
+        self.service = service
+        self.callback = callback
+        self.params = list(params)
+        self.monitors = list(monitors)
+        self.tolerance = tolerance
+        self.values = {}
+
+    def cancel(self):
+        """Stop watching."""
+        self.service.remove(self)
+
+    def _tolerance(self, name):
+        tolerance = self.tolerance
+        if isinstance(tolerance, dict):
+            return tolerance.get(name, 0.0)
+        return tolerance
+
+    def _changed(self, key, value, tolerance):
+        old = self.values.get(key)
+        return old is None or abs(value - old) > tolerance
+
+    def _check(self, params, monitors):
+        """Return the changes since the last report as ``(params, monitors)``
+        and remember them as reported."""
+        changed_params = {
+            name: params[name] for name in self.params
+            if name in params and self._changed(
+                name, params[name], self._tolerance(name))
+        }
+        changed_monitors = {}
+        for name in self.monitors:
+            readout = monitors.get(name)
+            tolerance = self._tolerance(name)
+            if readout and any(
+                    self._changed((name, col), readout[col], tolerance)
+                    for col in MONITOR_COLUMNS):
+                changed_monitors[name] = readout
+        self.values.update(changed_params)
+        self.values.update(
+            ((name, col), readout[col])
+            for name, readout in changed_monitors.items()
+            for col in MONITOR_COLUMNS)
+        return changed_params, changed_monitors
+
+
+class WatchService(object):
+
+    """
+    Polls the watched values of a :class:`~hit_acs.plugin._HitACS` backend
+    and dispatches changes to the watches.
+
+    The polling runs in a background thread (see :meth:`start`), which also
+    invokes the callbacks. Alternatively, :meth:`poll` can be called from a
+    GUI timer, using its return value as next interval.
+    """
+
+    def __init__(self, backend, min_interval=0.2, max_interval=5.0,
+                 backoff=1.5):
+        self.backend = backend
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.watches = []
+        self.ticks = 0
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._running = False
+
+    def add(self, callback, params=(), monitors=(), tolerance=0.0):
+        """Register a new :class:`Watch`. The next poll happens right away,
+        so that the callback receives the initial values."""
+        watch = Watch(self, callback, params, monitors, tolerance)
+        with self._lock:
+            self.watches.append(watch)
+            self.interval = self.min_interval
+        self._wake.set()
+        return watch
+
+    def remove(self, watch):
+        """Unregister a watch."""
+        with self._lock:
+            if watch in self.watches:
+                self.watches.remove(watch)
+
+    def poll(self):
+        """
+        Read all watched values in one batch, invoke the callbacks of the
+        watches with changes, and adapt the interval. Returns the interval
+        until the next poll.
+        """
+        with self._lock:
+            watches = list(self.watches)
+        if not watches:
+            return self.max_interval
+        params = sorted({name for w in watches for name in w.params})
+        monitors = sorted({name for w in watches for name in w.monitors})
+        param_values = monitor_values = {}
+        if params:
+            param_values = self.backend.read_params(params, warn=False)
+        if monitors:
+            monitor_values = self.backend.read_monitors(monitors)[1]
+        self.ticks += 1
+        moving = False
+        for watch in watches:
+            changed = watch._check(param_values, monitor_values)
+            if changed[0] or changed[1]:
+                moving = True
+                try:
+                    watch.callback(*changed)
+                except Exception:
+                    logging.exception("Error in watch callback")
+        with self._lock:
+            if moving:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(
+                    self.interval * self.backoff, self.max_interval)
+            return self.interval
+
+    @property
+    def running(self):
+        """Whether the background thread is running."""
+        return self._thread is not None
+
+    def start(self):
+        """Start polling in a background thread."""
+        if self._thread is not None:
+            return
+        self._running = True
+        self._wake.clear()
+        self._thread = threading.Thread(target=self._run, name='WatchService')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread (if running)."""
+        if self._thread is None:
+            return
+        self._running = False
+        self._wake.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        interval = 0
+        while True:
+            self._wake.wait(interval)
+            self._wake.clear()
+            if not self._running:
+                break
+            try:
+                interval = self.poll()
+            except Exception:
+                logging.exception("Error while polling watched values")
+                interval = self.max_interval
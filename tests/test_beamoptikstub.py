@@ -0,0 +1,32 @@
+from hit_acs.beamoptikstub import BeamOptikStub
+
+
+def make_stub():
+    stub = BeamOptikStub(None, None, {'seed': 0})
+    stub.set_float_values({'kl_{}'.format(i): float(i) for i in range(100)})
+    stub.GetInterfaceInstance()
+    return stub
+
+
+def test_save_state_to_loaded_file(tmpdir):
+    filename = str(tmpdir.join('state.chk'))
+    make_stub().save_state(filename)
+
+    stub = BeamOptikStub(None, None, {'seed': 0})
+    stub.load_state(filename)
+    # Enough changes to move the arrays within the file:
+    for i in range(50):
+        stub.SetFloatValue('kl_{}'.format(i), i + 0.5)
+    stub.ExecuteChanges()
+    stub.SetFloatValue('kl_2', 7.0)
+    stub.save_state(filename)
+    assert stub.GetFloatValue('kl_1') == 1.5
+    assert stub.GetFloatValue('kl_99') == 99.0
+    assert stub.GetFloatValue('E_HEBT') == 203.48
+
+    restored = BeamOptikStub(None, None, {'seed': 0})
+    restored.load_state(filename)
+    assert restored.GetFloatValue('kl_1') == 1.5
+    assert restored.GetFloatValue('kl_2') == 7.0
+    assert restored.GetFloatValue('kl_99') == 99.0
+    assert restored.GetFloatValue('E_HEBT') == 203.48
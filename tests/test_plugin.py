@@ -0,0 +1,57 @@
+import pytest
+
+pytest.importorskip('madgui')
+
+from madgui.util.collections import Boxed       # noqa: E402
+
+from hit_acs import plugin                      # noqa: E402
+
+
+class Namespace(object):
+    pass
+
+
+class Session(object):
+
+    def __init__(self):
+        self.user_ns = Namespace()
+        self.model = Boxed(None)
+        self.control = None
+
+    def window(self):
+        return None
+
+
+def make_backend(**settings):
+    settings.setdefault('seed', 0)
+    settings.setdefault('background_init', False)
+    return plugin.TestACS(Session(), settings)
+
+
+def test_settings_are_passed_to_backend():
+    backend = make_backend(pool_size=2, param_cache_timeout=0,
+                           shot_interval=0.25, read_cache_size=16)
+    assert backend._pool is not None
+    assert backend._pool.size == 2
+    assert backend._float_cache.timeout == 0
+    assert backend._float_cache.maxsize == 16
+    assert backend._sd_prefetch.shot_interval == 0.25
+
+
+def test_stub_changes_invalidate_caches(tmpdir):
+    backend = make_backend(param_cache_timeout=60)
+    backend._lib.set_float_values({'kl_a': 1.0})
+    backend.connect()
+    assert backend.read_param('kl_a') == 1.0
+    backend._aberrate_strengths()
+    aberrated = backend._lib.GetFloatValue('kl_a')
+    assert aberrated != 1.0
+    assert backend.read_param('kl_a') == aberrated
+
+    filename = str(tmpdir.join('state.ckpt'))
+    backend.save_state(filename)
+    backend._lib.set_float_values({'kl_a': 2.0})
+    backend._invalidate()
+    assert backend.read_param('kl_a') == 2.0
+    backend.load_state(filename)
+    assert backend.read_param('kl_a') == aberrated
@@ -0,0 +1,103 @@
+import time
+import threading
+
+import pytest
+
+pytest.importorskip('madgui')
+
+from hit_acs.beamoptikstub import BeamOptikStub     # noqa: E402
+from hit_acs.plugin import _HitACS                  # noqa: E402
+
+
+def make_stub():
+    stub = BeamOptikStub(None, None, {'seed': 0})
+    stub.set_float_values({'kl_a': 1.0, 'kl_b': 2.0})
+    return stub
+
+
+def make_backend(pool_size, stub=None):
+    settings = {'seed': 0, 'pool_size': pool_size, 'background_init': False,
+                'param_cache_timeout': 0}
+    stub = make_stub() if stub is None else stub
+    backend = _HitACS(stub, {}, settings=settings)
+    backend.connect()
+    return backend, stub
+
+
+def test_pooled_sweep_follows_mefi():
+    backend, stub = make_backend(2)
+    # Record the MEFI selection of the instance that serves each read:
+    selections = []
+    get_float = stub.GetFloatValue
+
+    def checked_get_float(name, *args):
+        writer = stub._instances[stub._iid].EFIA
+        selections.append((stub.EFIA, writer))
+        return get_float(name, *args)
+    checked_get_float.api_meth = True
+    stub.GetFloatValue = checked_get_float
+
+    params = ['kl_a', 'kl_b', 'e_hebt']
+    sweep = backend.mefi_sweep(1, [1, 2, 3], [1, 2], params=params)
+    stub.GetFloatValue = get_float
+    assert backend.pool_stats()['created'] > 0
+    assert all(reader == writer for reader, writer in selections)
+
+    reference, _ = make_backend(0)
+    expected = reference.mefi_sweep(1, [1, 2, 3], [1, 2], params=params)
+    assert (sweep.status == 1).all()
+    assert (sweep.values == expected.values).all()
+    assert (sweep.efi == expected.efi).all()
+
+
+def test_sweep_selects_through_writer_lock():
+    backend, stub = make_backend(2)
+    write_lock = backend._pool._write_lock
+    # Calls on the writer instance must be serialized by the pool:
+    unlocked = []
+
+    def check_locked(name):
+        meth = getattr(stub, name)
+
+        def checked(*args):
+            if stub._current_iid() == stub._iid and not write_lock._is_owned():
+                unlocked.append(name)
+            return meth(*args)
+        checked.api_meth = True
+        setattr(stub, name, checked)
+
+    for name in ('SelectVAcc', 'SelectMEFI', 'GetMEFIValue'):
+        check_locked(name)
+    backend.mefi_sweep(1, [1, 2], [1], params=['kl_a'])
+    backend.get_MEFI()
+    backend.export_settings()
+    assert unlocked == []
+
+
+def test_unpooled_calls_are_serialized():
+    stub = make_stub()
+    # Background services read from other threads through the same instance:
+    state = {'active': 0, 'overlaps': 0}
+    get_float = stub.GetFloatValue
+
+    def checked_get_float(name, *args):
+        state['active'] += 1
+        if state['active'] > 1:
+            state['overlaps'] += 1
+        time.sleep(0.001)
+        state['active'] -= 1
+        return get_float(name, *args)
+    checked_get_float.api_meth = True
+    stub.GetFloatValue = checked_get_float
+    backend, _ = make_backend(0, stub)
+
+    def read():
+        for i in range(20):
+            backend._float_cache.invalidate()
+            backend.read_params(['kl_a', 'kl_b'])
+    threads = [threading.Thread(target=read) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert state['overlaps'] == 0
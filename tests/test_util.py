@@ -0,0 +1,45 @@
+from hit_acs.util import ShotPrefetcher
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.5
+
+    def __call__(self):
+        return self.now
+
+
+def test_prefetcher_register_then_get():
+    prefetcher = ShotPrefetcher(str.upper, clock=Clock())
+    prefetcher.get('a')
+    prefetcher.register(['b'])
+    assert prefetcher.get('b') == (1, 'B')
+    prefetcher.register(['c'])
+    assert prefetcher.read(['a', 'c']) == (1, {'a': 'A', 'c': 'C'})
+
+
+def test_prefetcher_invalidate_keeps_epoch():
+    clock = Clock()
+    values = {'a': 1}
+    prefetcher = ShotPrefetcher(values.get, clock=clock)
+    assert prefetcher.get('a') == (1, 1)
+    values['a'] = 2
+    prefetcher.invalidate()
+    # Refetched, but still the shot from before the change:
+    assert prefetcher.get('a') == (1, 2)
+    assert prefetcher.changed_epoch == 1
+    clock.now += 1
+    assert prefetcher.get('a') == (2, 2)
+    assert prefetcher.changed_epoch == 1
+
+
+def test_prefetcher_invalidate_without_current_snapshot():
+    clock = Clock()
+    prefetcher = ShotPrefetcher(str.upper, clock=clock)
+    prefetcher.get('a')
+    clock.now += 5
+    prefetcher.invalidate()
+    # The first snapshot of this shot is still from before the change:
+    assert prefetcher.get('a') == (2, 'A')
+    assert prefetcher.changed_epoch == 2